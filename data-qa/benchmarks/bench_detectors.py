@@ -0,0 +1,256 @@
+################################################################################### Imports
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+import context_broker_client_utils as aquaspice_utils
+import auxiliar_functions as aux_func
+import detectors
+import hampel_functions as hampel_func
+import z_score_functions as zscore_func
+import watercps_functions as wcps_func
+import streaming_analysis
+
+###################################################################################
+
+# Benchmarks of the per-reading cost of the detectors and of the window manager, on synthetic series (seeded, reproducible).
+# Each case (window size, query points, stations, properties) fills the histories, then streams readings through the
+# detector and manage_sliding_window_dataframe, timing every call, and scores the whole series with the offline kernel of the
+# detector (one call per series). Results are written as JSON, and compared with a previous run if --baseline is given
+# (exit code 1 on regression).
+#
+# Usage: python benchmarks/bench_detectors.py --windows 180,500 --query-points 4000 --stations 1,10 --output results.json
+
+START_DATE = datetime.datetime(2023, 1, 1, tzinfo = datetime.timezone.utc)
+CADENCY = datetime.timedelta(minutes = 15)
+
+def synthetic_series(rng, n):
+    '''
+    Daily cycle plus noise, with ~2% of spikes (so the IQR confirmation path is exercised)
+    '''
+    t = np.arange(n)
+    values = 1000 + 80 * np.sin(t / 96 * 2 * np.pi) + rng.normal(0, 10, n)
+    spikes = rng.random(n) < 0.02
+    values[spikes] += rng.choice([-1, 1], spikes.sum()) * rng.uniform(300, 900, spikes.sum())
+    return np.round(values, 3)
+
+def build_config(window, query_points, properties):
+    '''
+    Configuration of a benchmark case (thresholds of data_qa_params.json, one sliding window for every property)
+    '''
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "config", "data_qa_params.json"), "r") as f:
+        config = json.load(f)
+
+    config["query_points"] = query_points
+    config["property_sliding_window"] = {property_name: window for property_name in properties}
+    config["watercps_error_flagging"] = {"harbour_docks": {property_name: {"min_value": 100, "max_value": 3000, "delta_value": 500} for property_name in properties}}
+    config["analysis"] = [{"algorithm": algorithm,
+                           "subscription_id": "urn:ngsi-ld:Subscription:benchmark_" + algorithm,
+                           "entityType": "MeasurementStation",
+                           "analyzedProperties": properties,
+                           "anomalyTypeId": "_anomaly_" + algorithm,
+                           "notCorrectedProperties": ["location"]} for algorithm in ["z_score", "hampel_filter", "watercps_threshold"]]
+    return config
+
+def prepare_state(config, stations, rng, readings):
+    '''
+    Create the in-memory windows of every station (histories of query_points samples) and the readings to stream
+    Returns {station_id: {property: values}} (history followed by the streamed readings) and the dates
+    '''
+    for state in [streaming_analysis.entities_data, streaming_analysis.hampel_filter_measurements,
+                  streaming_analysis.watercps_measurements, streaming_analysis.station_series, streaming_analysis.anomaly_status]:
+        state.clear()
+
+    n = config["query_points"] + readings
+    dates = [(START_DATE + i * CADENCY).strftime("%Y-%m-%dT%H:%M:%S.000Z") for i in range(n)]
+    epochs = np.array([aux_func.date_to_epoch(date) for date in dates[:config["query_points"]]])
+    series = {}
+
+    for station_id in stations:
+        series[station_id] = {property_name: synthetic_series(rng, n) for property_name in config["analysis"][0]["analyzedProperties"]}
+
+        for analysis in config["analysis"]:
+            streaming_analysis.create_history(station_id, analysis, start_from_0 = True)
+            measurements, prefix = streaming_analysis.algorithm_measurements(analysis["algorithm"])
+
+            for property_name, property_measurements in measurements[prefix + station_id.split(":")[4]].items():
+                property_measurements["data"].load(series[station_id][property_name][:config["query_points"]], epochs)
+
+                if "stats" in property_measurements:
+                    property_measurements["stats"].recompute(property_measurements["data"])
+                else:
+                    detectors.DETECTORS[analysis["algorithm"]].update(property_measurements)
+
+    return series, dates
+
+def detector_call(algorithm, config, station_id, property_name, value):
+    '''
+    Score one reading with the detector of an algorithm
+    '''
+    if algorithm == "z_score":
+        return zscore_func.outlier_function_z_score(config, station_id, property_name, config["z_score_threshold"], value, streaming_analysis.entities_data)
+    elif algorithm == "hampel_filter":
+        return hampel_func.outlier_function_hampel_filter(config, station_id, property_name, value, streaming_analysis.hampel_filter_measurements)
+    elif algorithm == "watercps_threshold":
+        return wcps_func.outlier_function_watercps(config["watercps_error_flagging"], station_id, property_name, value, streaming_analysis.watercps_measurements)
+
+def timing_summary(name, case, timings):
+    '''
+    Statistics of the call durations (microseconds)
+    '''
+    timings = np.asarray(timings) / 1000
+    return dict(case,
+                benchmark = name,
+                calls = len(timings),
+                mean_us = round(float(np.mean(timings)), 3),
+                p50_us = round(float(np.percentile(timings, 50)), 3),
+                p90_us = round(float(np.percentile(timings, 90)), 3),
+                p99_us = round(float(np.percentile(timings, 99)), 3),
+                calls_per_second = round(1e6 / float(np.mean(timings)), 1))
+
+def run_case(window, query_points, num_stations, num_properties, readings, seed):
+    '''
+    Run every benchmark for one combination of parameters
+    '''
+    rng = np.random.default_rng(seed)
+    properties = [f"property_{i}" for i in range(num_properties)]
+    stations = [f"urn:ngsi-ld:MeasurementStation:AquaSpice:station{i}" for i in range(num_stations)]
+    case = {"window": window, "query_points": query_points, "stations": num_stations, "properties": num_properties}
+
+    config = build_config(window, query_points, properties)
+    aquaspice_utils.config = config
+
+    results = []
+
+    for analysis in config["analysis"]:
+        series, dates = prepare_state(config, stations, rng, readings)
+        detector_timings = []
+        window_timings = []
+        iqr_timings = []
+        iqr_array_timings = []
+
+        for i in range(query_points, query_points + readings):
+            for station_id, property_name in itertools.product(stations, properties):
+                value = series[station_id][property_name][i]
+
+                start = time.perf_counter_ns()
+                detector_call(analysis["algorithm"], config, station_id, property_name, value)
+                detector_timings.append(time.perf_counter_ns() - start)
+
+                # IQR failsafe, over the sorted index (as the detectors use it) and over the raw history
+                if analysis["algorithm"] == "z_score":
+                    measurements = streaming_analysis.entities_data["z_score_measurement_" + station_id.split(":")[4]][property_name]
+
+                    start = time.perf_counter_ns()
+                    measurements["iqr_index"].sync(measurements["data"])
+                    aux_func.iqr_method(measurements["iqr_index"], value, config["iqr_threshold"]["default"])
+                    iqr_timings.append(time.perf_counter_ns() - start)
+
+                    start = time.perf_counter_ns()
+                    aux_func.iqr_method(measurements["data"].last(), value, config["iqr_threshold"]["default"])
+                    iqr_array_timings.append(time.perf_counter_ns() - start)
+
+                start = time.perf_counter_ns()
+                streaming_analysis.manage_sliding_window_dataframe(station_id, property_name, analysis["algorithm"], value, dates[i])
+                window_timings.append(time.perf_counter_ns() - start)
+
+        # Offline kernel over the whole series (history and streamed readings) of each (station, property)
+        detector = streaming_analysis.analysis_detector(analysis)
+        epochs = np.array([aux_func.date_to_epoch(date) for date in dates])
+        offline_timings = []
+
+        for station_id, property_name in itertools.product(stations, properties):
+            start = time.perf_counter_ns()
+            detector.score_series(property_name, series[station_id][property_name], epochs)
+            offline_timings.append(time.perf_counter_ns() - start)
+
+        results.append(timing_summary(f"detector_{analysis['algorithm']}", case, detector_timings))
+        results.append(timing_summary(f"manage_sliding_window_{analysis['algorithm']}", case, window_timings))
+        results.append(timing_summary(f"offline_{analysis['algorithm']}", case, offline_timings))
+
+        if iqr_timings:
+            results.append(timing_summary("iqr_method_sorted_index", case, iqr_timings))
+            results.append(timing_summary("iqr_method_array", case, iqr_array_timings))
+
+    return results
+
+def compare(results, baseline, tolerance):
+    '''
+    Return the benchmarks whose mean cost increased more than `tolerance` (fraction) with respect to the baseline results
+    '''
+    key = lambda r: (r["benchmark"], r["window"], r["query_points"], r["stations"], r["properties"])
+    previous = {key(r): r for r in baseline["results"]}
+    regressions = []
+
+    for result in results:
+        if key(result) in previous:
+            ratio = result["mean_us"] / previous[key(result)]["mean_us"]
+            if ratio > 1 + tolerance:
+                regressions.append(dict(result, baseline_mean_us = previous[key(result)]["mean_us"], ratio = round(ratio, 3)))
+
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True, cwd = os.path.dirname(os.path.realpath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks of the DataQA detectors and window manager (per-reading cost)")
+    parser.add_argument("--windows", default = "180,500", help = "property_sliding_window values (comma separated)")
+    parser.add_argument("--query-points", default = "4000", help = "query_points values (comma separated)")
+    parser.add_argument("--stations", default = "1,10", help = "number of stations (comma separated)")
+    parser.add_argument("--properties", default = "3", help = "number of properties per station (comma separated)")
+    parser.add_argument("--readings", type = int, default = 500, help = "readings streamed per station and property")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "write the results to this file (default: stdout)")
+    parser.add_argument("--baseline", help = "results of a previous run, regressions are reported (exit code 1)")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "allowed increase of the mean cost with respect to the baseline (fraction)")
+    parser.add_argument("--log-level", default = "INFO", help = "log level of the modules (the log is discarded)")
+    args = parser.parse_args()
+
+    grid = [[int(x) for x in values.split(",")] for values in [args.windows, args.query_points, args.stations, args.properties]]
+    results = []
+
+    # The cost of logging is included, the log itself is discarded
+    with open(os.devnull, "w") as devnull:
+        aux_func.setup_logging({}, args.log_level, devnull)
+
+        for window, query_points, num_stations, num_properties in itertools.product(*grid):
+            results += run_case(window, query_points, num_stations, num_properties, args.readings, args.seed)
+
+        aux_func.logger.remove()
+
+    output = {"meta": {"date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                       "commit": git_commit(),
+                       "python": platform.python_version(),
+                       "numpy": np.__version__,
+                       "machine": platform.machine(),
+                       "readings": args.readings,
+                       "log_level": args.log_level,
+                       "seed": args.seed},
+              "results": results}
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            output["regressions"] = compare(results, json.load(f), args.tolerance)
+        exit_code = 1 if output["regressions"] else 0
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent = 4)
+    else:
+        print(json.dumps(output, indent = 4))
+
+    sys.exit(exit_code)
@@ -1,33 +1,100 @@
 ################################################################################### Imports
 import numpy as np
+import pandas as pd
 from datetime import datetime, timezone
+from functools import lru_cache
+from loguru import logger
 import os
+import queue
+import re
+import sys
+import time
 
 import context_broker_client_utils as aquaspice_utils
+import metrics
+import sliding_window as sw
 
 working_dir = os.path.dirname(os.path.realpath(__file__))
 
-def iqr_method(observations, data_sample, iqr_threshold = 2):
+# ISO 8601 dates of the readings (e.g. 2023-01-01T00:15:00.000Z): hour prefix, minutes, seconds, fraction and UTC offset (see date_to_epoch)
+ISO_DATE = re.compile(r"(\d{4}-\d{2}-\d{2}T\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?(Z|[+-]\d{2}:?\d{2})?$")
+
+# Data gap (minutes between the observations of a station) resetting the in-memory windows (see calculate_date_distance)
+RESET_GAP_MINUTES = 240
+
+# Log level of each `kind` of logMessage
+LOG_LEVELS = {"debug": "DEBUG", "info": "INFO", "warning": "WARNING", "error": "ERROR"}
+
+def iqr_quartiles(observations):
+    '''
+    Return Q1 and Q3 of the observations, computed once and shared by the default and failsafe thresholds.
+    observations can be an array or a sliding_window.SortedWindow (read in O(1) from the sorted index)
+    '''
+    if isinstance(observations, sw.SortedWindow):
+        return observations.percentile(25), observations.percentile(75)
+
+    return np.percentile(observations, 25), np.percentile(observations, 75)
+
+def iqr_method(observations, data_sample, iqr_threshold = 2, quartiles = None):
     '''
     Implements IQR Method
     Default threshold = 1.5
+    quartiles = (Q1, Q3) already computed with iqr_quartiles (observations are then not used)
     '''
-    q1 = np.percentile(observations, 25) # Q1
-    q3 = np.percentile(observations, 75) # Q3
+    q1, q3 = quartiles if quartiles is not None else iqr_quartiles(observations)
     iqr = q3 - q1 
     
     # Observations > Q3 + 1.5 * IQR or Q1 - 1.5 * IQR
     if (data_sample > (q3 + (iqr_threshold * iqr))) or (data_sample < (q1 - (iqr_threshold * iqr))):
-        logMessage("---> IQR decided True")
+        logMessage("---> IQR decided True", kind = "debug")
         return True
     else:
-        logMessage("---> IQR decided False")
+        logMessage("---> IQR decided False", kind = "debug")
         return False
 
+def iqr_confirm(series, positions, data_samples, iqr_threshold, window):
+    '''
+    IQR failsafe of several outlier candidates at once: quartiles of the `window` samples preceding each candidate in the series
+    (positions), confirmed if the default or the failsafe threshold (iqr_threshold of the config) considers it an outlier.
+    Returns a boolean array aligned with positions
+    '''
+    quartiles = sw.trailing_apply(series, positions, window, lambda windows, rows: np.percentile(windows, [25, 75], axis = 1).T)
+    q1, q3 = quartiles[:, 0], quartiles[:, 1]
+    iqr = q3 - q1
+
+    confirmed = np.zeros(len(positions), dtype = bool)
+    for threshold in [iqr_threshold["default"], iqr_threshold["failsafe"]]:
+        confirmed |= (data_samples > (q3 + (threshold * iqr))) | (data_samples < (q1 - (threshold * iqr)))
+
+    return confirmed
+
+def series_segments(values, dates = None, history = None):
+    '''
+    Split a series (e.g. a year of history, analysed offline) at the resets the in-memory windows would go through if its samples
+    were streamed: gaps of RESET_GAP_MINUTES or more between the dates (epoch ms, no resets if None).
+    Returns a list of (series, offset, start, end): the samples in memory (`history` for the first segment, nothing after a reset)
+    followed by values[start:end], which start at series[offset]
+    '''
+    values = np.asarray(values, dtype = np.float64)
+    history = np.empty(0) if history is None else np.asarray(history, dtype = np.float64)
+    starts = [0]
+
+    if dates is not None:
+        # Same distance as calculate_date_distance (whole minutes between the observations, in seconds)
+        seconds = np.asarray(dates, dtype = np.int64) // 1000
+        starts += (np.flatnonzero(np.diff(seconds) // 60 >= RESET_GAP_MINUTES) + 1).tolist()
+
+    ends = starts[1:] + [len(values)]
+    segments = [(np.concatenate([history, values[:ends[0]]]), len(history), 0, ends[0])]
+
+    for start, end in zip(starts[1:], ends[1:]):
+        segments.append((values[start:end], 0, start, end))
+
+    return segments
+
 def return_observedAt(reading, properties):
     '''
-    Func to return the first observedAt that is found
-    # Use time_index if available?
+    Func to return the observedAt of a reading (the last one found among the properties), as epoch seconds (None if there is none)
     '''
     observedAt = None
     
@@ -36,86 +103,331 @@ def return_observedAt(reading, properties):
             observedAt = reading[property]["observedAt"]
         except:
             pass
-        
-    return str(observedAt).split(".")[0] + "Z"
 
+    if observedAt is None:
+        return None
+
+    return date_to_epoch(observedAt) // 1000
+
+def has_observedAt(reading, properties):
+    '''
+    Whether a reading has an observedAt in any of the properties (readings without one cannot be placed in the series)
+    '''
+    return any(isinstance(reading.get(property), dict) and (reading[property].get("observedAt") is not None) for property in properties)
 
 def _produce_anomaly(id, entityType, anomalyTypeId, anomaly_start_date, last_anomaly_date, subject):
     """
     Insert a new anomaly sample in the context broker
     """
 
-    print("--> Produce anomaly triggered", flush = True)
+    logMessage("--> Produce anomaly triggered", kind = "debug")
+    body = [build_anomaly(id, entityType, anomalyTypeId, anomaly_start_date, last_anomaly_date, subject)]
+    # print(body)
+    aquaspice_utils.enqueue_upsert(body)
+
+def build_anomaly(id, entityType, anomalyTypeId, anomaly_start_date, last_anomaly_date, subject):
+    """
+    Return the anomaly entity (NGSI-LD)
+    """
+    return {
+        "id": "urn:ngsi-ld:AquaSpice:" + str(entityType) + "Corrected:" + str(anomalyTypeId) + ":" + id,
+        "type": "Anomaly",
+        "name": "value-anomaly",
+        "description": "Something is wrong with: " + str(subject),
+        "dateObserved": {
+            "type": "Property",
+            "value": {"@type": "DateTime", "@value": last_anomaly_date},
+        },
+        "validFrom": {
+            "type": "Property",
+            "value": {"@type": "DateTime", "@value": anomaly_start_date},
+        },
+        "validTo": {
+            "type": "Property",
+            "value": {"@type": "DateTime", "@value": last_anomaly_date},
+        },
+        "dateCreated": {
+            "type": "Property",
+            "value": {"type": "DateTime", "value": get_datetime_now()},
+        },
+        "dateIssued": {
+            "type": "Property",
+            "value": {"type": "DateTime", "value": get_datetime_now()},
+        },
+        "@context": [
+            "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld"
+        ]
+    }
+
+def build_corrected_reading(id, entityType, reading, corrected_variables, analysis, is_outlier, reason_watercps):
+    """
+    Return the corrected reading entity (raw and corrected values, or error flags for watercps)
+    """
+    if (str(entityType) == "measurementStation") or (str(entityType) == "measurementstation"):
+        entityType = "MeasurementStation"
+
+    # Get correct flag
+    flag = "Flagged" if analysis["algorithm"] == "watercps_threshold" else "Corrected"
+
+    logMessage("--> Started produce_corrected_reading", kind = "debug")
     body = [
         {
-            "id": "urn:ngsi-ld:AquaSpice:" + str(entityType) + "Corrected:" + str(anomalyTypeId) + ":" + id,
-            "type": "Anomaly",
-            "name": "value-anomaly",
-            "description": "Something is wrong with: " + str(subject),
-            "dateObserved": {
-                "type": "Property",
-                "value": {"@type": "DateTime", "@value": last_anomaly_date},
-            },
-            "validFrom": {
-                "type": "Property",
-                "value": {"@type": "DateTime", "@value": anomaly_start_date},
-            },
-            "validTo": {
+            "id": "urn:ngsi-ld:AquaSpice:" + str(entityType) + str(flag) + ":" + id,
+            "type":  str(entityType) + str(flag)
+        }
+    ]
+
+    for property_name in analysis["notCorrectedProperties"]:
+        if property_name in reading:
+            body[0][property_name] = reading[property_name]
+        
+    # Exclude properties that are not relevant (id, type, notCorrectedProperties...)
+    properties_to_iterate = [str(x) for x in reading.keys() if (x in analysis["analyzedProperties"]) and (not x in analysis["notCorrectedProperties"])]
+    
+    logMessage("Analysis: {}", "debug", lambda: analysis["algorithm"])
+    logMessage("Properties to iterate: {}", "debug", lambda: properties_to_iterate)
+    logMessage("analyzedProperties: {}", "debug", lambda: analysis["analyzedProperties"])
+
+    # Add corresponding properties to the corrected reading, propertyRaw and propertyCorrected
+    if analysis["algorithm"] == "watercps_threshold":
+        for property_name in properties_to_iterate:
+            body[0][str(property_name)] = {
                 "type": "Property",
-                "value": {"@type": "DateTime", "@value": last_anomaly_date},
-            },
-            "dateCreated": {
+                "value": reading[property_name]["value"],
+                "observedAt": reading[property_name]["observedAt"]
+            }
+
+            body[0][str(property_name) + "_error"] = {
                 "type": "Property",
-                "value": {"type": "DateTime", "value": get_datetime_now()},
-            },
-            "dateIssued": {
+                "value": str(is_outlier[property_name]),  # Yes or No
+                "observedAt": reading[property_name]["observedAt"]
+            }
+
+            body[0][str(property_name) + "_error_reason"] = {
                 "type": "Property",
-                "value": {"type": "DateTime", "value": get_datetime_now()},
-            },
-            "@context": [
+                "value": str(reason_watercps[property_name]),  # Can be reason_max, min, and delta.
+                "observedAt": reading[property_name]["observedAt"]
+            }
+    else:
+        for property_name in properties_to_iterate:
+            body[0][str(property_name) + "Raw"] = {
+                "type" : "Property",
+                "value" : reading[property_name]["value"],
+                "observedAt" : reading[property_name]["observedAt"]
+            }
+
+            body[0][str(property_name) + "Corrected"] = {
+                "type" : "Property",
+                "value" : corrected_variables[property_name]["value"],
+                "observedAt" : reading[property_name]["observedAt"]
+            }
+
+    body[0]["@context"] =  [
                 "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld"
             ]
-        }
-    ]
-    # print(body)
-    aquaspice_utils.upsert_context_broker(body)
 
+    return body[0]
 
 def calculate_date_distance(last_observedAt_received, last_date_received, subscriptionId, station_id, current_date):
     '''
-    Calculate distance between dates
+    Calculate distance between dates (epoch seconds, see return_observedAt)
     '''
     try:
         last_date = last_observedAt_received[subscriptionId][station_id]
 
-        format = "%Y-%m-%dT%H:%M:%SZ"
-
-        difference = datetime.strptime(current_date, format) - datetime.strptime(last_date, format)
+        minutes = int((current_date - last_date) / 60)
 
-        minutes = int(difference.total_seconds() / 60)
-
-        print(f"### Debug date: current_date: {current_date} last date received {last_date}, diff: {minutes} minutes", flush=True)
+        logMessage("### Debug date: current_date: {} last date received {}, diff: {} minutes", "debug", lambda: current_date, lambda: last_date, lambda: minutes)
 
         # If it has a data gap greater than {x} minutes, order a reset in the in-memory dicts
-        if minutes >= 240:
+        if minutes >= RESET_GAP_MINUTES:
             # Do something, reset in memory dicts?
             return True
         else:
             return False
 
     except Exception as e:
-        print(f"Exception on calculating date distance: {e}", flush = True)
+        logMessage(f"Exception on calculating date distance: {e}", kind = "error")
         pass
 
+@lru_cache(maxsize = 4096)
+def short_id(station_id):
+    """
+    Return the short id of a station (last part of urn:ngsi-ld:<type>:<project>:<id>, used to name the in-memory dicts)
+    """
+    return station_id.split(":")[4]
+
+@lru_cache(maxsize = 4096)
+def _hour_epoch(prefix):
+    """
+    Return the epoch (seconds, UTC) of the hour of a date ("YYYY-MM-DDTHH" prefix, shared by the readings of the same hour)
+    """
+    return int(datetime(int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]), int(prefix[11:13]), tzinfo = timezone.utc).timestamp())
+
+@lru_cache(maxsize = 1024)
+def _iso_epoch(date):
+    """
+    Return the epoch (milliseconds, UTC) of an ISO 8601 date, None if it is not one (the properties of a reading, and the
+    readings of the stations sampled at the same time, share their dates)
+    """
+    match = ISO_DATE.match(date)
+    if match is None:
+        return None
+
+    hour, minutes, seconds, fraction, offset = match.groups()
+    minutes = int(minutes)
+    seconds = int(seconds or 0)
+
+    if (minutes >= 60) or (seconds >= 60):
+        return None
+
+    epoch = _hour_epoch(hour) + minutes * 60 + seconds
+
+    # Dates without offset are UTC
+    if offset and (offset != "Z"):
+        epoch -= (1 if offset[0] == "+" else -1) * (int(offset[1:3]) * 3600 + int(offset[-2:]) * 60)
+
+    return epoch * 1000 + (int(fraction[:3].ljust(3, "0")) if fraction else 0)
+
+def date_to_epoch(date):
+    """
+    Return the epoch (milliseconds, UTC) of a date (ISO string, datetime or pd.Timestamp)
+    ISO 8601 strings are parsed directly (cached), other dates go through pandas
+    """
+    if isinstance(date, str):
+        epoch = _iso_epoch(date)
+        if epoch is not None:
+            return epoch
+
+    date = pd.Timestamp(date)
+
+    if date.tzinfo is None:
+        date = date.tz_localize("UTC")
+
+    return date.value // 10**6
+
+def epoch_to_date(seconds):
+    """
+    Return the UTC date (same format as get_datetime_now) of an epoch in seconds
+    """
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
 def get_datetime_now():
     """
     Return current date with correct format
     """
     return datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
 
-def logMessage(message, kind = "info"):
+def notification_error(notification):
+    '''
+    Return the reason why a notification is malformed (None if it can be queued)
+    '''
+    if not isinstance(notification, dict):
+        return "the body is not a JSON object"
+    if not isinstance(notification.get("subscriptionId"), str):
+        return "missing subscriptionId"
+    if not isinstance(notification.get("data"), list):
+        return "missing data"
+    if not all(isinstance(reading, dict) and ("id" in reading) for reading in notification["data"]):
+        return "readings without id"
+    return None
+
+def enqueue_notification(work_queue, subscriptionId, readings, **labels):
+    '''
+    Queue a notification to be analysed after its acknowledgement (queue.Queue or multiprocessing queue), applying the load
+    shedding policy (ingest_shed_policy) when the queue is full:
+    "reject" waits up to ingest_enqueue_timeout seconds and rejects the notification, "drop_oldest" discards the oldest queued
+    notifications (the freshest data is kept). Returns False if the notification was rejected.
+    labels are added to the metrics (e.g. the worker of the queue)
+    '''
+    return enqueue_shards(subscriptionId, [(work_queue, readings, labels)])
+
+def enqueue_shards(subscriptionId, shards):
+    '''
+    Queue the readings of a notification split among several queues (shards: list of (work_queue, readings, metric labels)),
+    see enqueue_notification. The notification is only rejected if none of its shards could be queued: the broker would send
+    the whole notification again, so once a shard is queued the shards that do not fit are dropped (counted in the shed metric)
+    instead of having the queued readings analysed twice. Returns False if the notification was rejected
+    '''
+    policy = aquaspice_utils.config.get("ingest_shed_policy", "reject")
+    timeout = aquaspice_utils.config.get("ingest_enqueue_timeout", 1)
+    received_at = time.time()
+
+    # Shards that could not be queued, and the number of items discarded for each one
+    full = []
+
+    for work_queue, readings, labels in shards:
+        queued, shed = _put_with_policy(work_queue, (subscriptionId, readings, received_at), policy, timeout)
+
+        if not queued:
+            full.append((shed, labels))
+        elif shed > 0:
+            metrics.INGEST_SHED.inc(shed, reason = "dropped", **labels)
+            logMessage(f"---X Ingestion queue full ({policy}), {shed} notification(s) dropped", kind = "error")
+
+    accepted = len(full) < len(shards) or not shards
+
+    for shed, labels in full:
+        metrics.INGEST_SHED.inc(shed, reason = "dropped" if accepted else "rejected", **labels)
+
+    if full:
+        logMessage(f"---X Ingestion queue full ({policy}), {len(full)} of {len(shards)} shard(s) of a notification {'dropped' if accepted else 'rejected'}", kind = "error")
+
+    return accepted
+
+def _put_with_policy(work_queue, item, policy, timeout):
+    '''
+    Returns (queued, shed): whether the item was queued and the number of items discarded
+    '''
+    if policy != "drop_oldest":
+        try:
+            work_queue.put(item, timeout = timeout)
+            return True, 0
+        except queue.Full:
+            return False, 1
+
+    shed = 0
+    while True:
+        try:
+            work_queue.put_nowait(item)
+            return True, shed
+        except queue.Full:
+            pass
+
+        try:
+            oldest = work_queue.get_nowait()
+        except queue.Empty:
+            continue
+
+        # Never discard the stop request of the consumer
+        if oldest is None:
+            work_queue.put(None)
+            return False, shed + 1
+
+        shed += 1
+
+def setup_logging(config, level = None, sink = None):
     '''
-    Implement logger if necessary
+    Configure the logger: default level (config "log_level", or `level`), level per module (config "log_levels", by file name)
+    and background writing to `sink` (stdout by default): messages are queued and written by a separate thread
     '''
+    default_level = logger.level(level or config.get("log_level", "INFO")).no
+    module_levels = {module: logger.level(module_level).no for module, module_level in config.get("log_levels", {}).items()}
+
+    def level_filter(record):
+        return record["level"].no >= module_levels.get(record["module"], default_level)
 
-    print('[' + str(datetime.now()) + '] ' + str(message), flush = True)
+    logger.remove()
+    logger.add(sink or sys.stdout,
+               # Messages below every configured level are discarded before being built
+               level = min([default_level] + list(module_levels.values())),
+               filter = level_filter,
+               format = "[{time:YYYY-MM-DD HH:mm:ss.SSSSSS}] {level: <7} {module}: {message}",
+               enqueue = True)
+
+def logMessage(message, kind = "info", *args, **kwargs):
+    '''
+    Log a message with the level of `kind` (debug, info, warning, error).
+    args / kwargs are functions returning the values of the {} placeholders of the message, only called if the message is logged
+    '''
+    logger.opt(depth = 1, lazy = True).log(LOG_LEVELS.get(kind, "INFO"), message, *args, **kwargs)
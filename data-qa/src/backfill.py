@@ -0,0 +1,541 @@
+################################################################################### Imports
+import argparse
+import glob
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+import flask
+import numpy as np
+import pandas as pd
+
+import context_broker_client_utils as aquaspice_utils
+import auxiliar_functions as aux_func
+import detectors
+import metrics
+
+###################################################################################
+
+# Backfill jobs: run the analysis of a subscription over a past period (e.g. after tuning the thresholds, or for stations
+# added later) and write the corrected readings back to the context broker.
+# A job walks the history of its stations in QuantumLeap (query_historical_all_data, pages of `backfill_page_size` samples per
+# station), scores each page with the offline kernels of the detector (Detector.score_series, same decisions as streaming the
+# samples) and sends the corrected readings as batched upserts, at most `backfill_rate` entities per second. The corrected
+# entity of a station is updated once per sample, so the stations are processed in groups of `backfill_batch_size`: each
+# upsert holds one sample of every station of the group. Anomalies are not produced (the ongoing anomalies are kept).
+# After each round (one page of every station of the group) the job writes a checkpoint to `backfill_dir/<job id>.json`
+# (offset in QuantumLeap and last date of each station), so an interrupted job resumes where it stopped: the windows are
+# rebuilt from QuantumLeap. Jobs run one at a time, in background (HTTP endpoints, see blueprint) or in the foreground (CLI).
+#
+# Usage: python backfill.py "<config files>" --subscription <subscription id> --from <date> --to <date> [--stations "<id>;<id>"]
+#        python backfill.py "<config files>" --resume <job id>
+
+blueprint = flask.Blueprint("backfill", __name__)
+
+# Jobs of this process ({job_id: job}), and the queue of the background worker (started on the first job, see start_worker)
+jobs = {}
+jobs_lock = threading.Lock()
+job_queue = None
+
+# Running jobs whose cancellation was requested
+cancel_requests = set()
+
+# States of a job ("queued" and "running" jobs are resumed on startup, see resume_jobs)
+FINISHED = ("completed", "failed", "cancelled")
+
+class RateLimiter:
+    '''
+    Paces the upserts to `rate` entities per second (unlimited if 0)
+    '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = time.monotonic()
+
+    def wait(self, amount):
+        '''
+        Wait until `amount` entities can be sent
+        '''
+        if self.rate <= 0:
+            return
+
+        now = time.monotonic()
+        if self._next > now:
+            time.sleep(self._next - now)
+
+        self._next = max(self._next, now) + amount / self.rate
+
+def iso_date(epoch):
+    '''
+    Return the ISO 8601 date (UTC, milliseconds) of an epoch in milliseconds, as used in the QuantumLeap queries
+    '''
+    return pd.Timestamp(int(epoch), unit = "ms", tz = "UTC").strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+def find_analysis(subscription_id):
+    '''
+    Return the analysis of a subscription (None if it is not configured)
+    '''
+    for analysis in aquaspice_utils.config["analysis"]:
+        if analysis["subscription_id"] == subscription_id:
+            return analysis
+    return None
+
+def station_urn(analysis, station_id):
+    return f'urn:ngsi-ld:AquaSpice:{analysis["entityType"]}:{aux_func.short_id(station_id)}'
+
+############### Jobs ###############
+
+def new_job(subscription_id, from_date, to_date, stations = None):
+    '''
+    Create a job (not queued). stations: list or ";"-separated ids, the "entityIds" of the analysis by default.
+    Raises ValueError if the request is not valid
+    '''
+    analysis = find_analysis(subscription_id)
+    if analysis is None:
+        raise ValueError(f"Unknown subscription: {subscription_id}")
+    if analysis["algorithm"] not in detectors.DETECTORS:
+        raise ValueError(f"Unknown algorithm: {analysis['algorithm']}")
+
+    if stations is None:
+        stations = analysis.get("entityIds")
+    if isinstance(stations, str):
+        stations = [x for x in stations.split(";") if x]
+    if not stations:
+        raise ValueError("No stations (not given and no entityIds in the analysis)")
+
+    try:
+        start, end = aux_func.date_to_epoch(from_date), aux_func.date_to_epoch(to_date)
+    except Exception:
+        raise ValueError(f"Invalid period: {from_date} - {to_date}")
+    if start >= end:
+        raise ValueError(f"Empty period: {from_date} - {to_date}")
+
+    return {
+        "job_id": str(uuid.uuid4()),
+        "subscription_id": subscription_id,
+        "from": iso_date(start),
+        "to": iso_date(end),
+        "status": "queued",
+        "error": None,
+        "created": aux_func.get_datetime_now(),
+        "updated": aux_func.get_datetime_now(),
+        # Seconds spent running (every run of the job)
+        "elapsed": 0.0,
+        "samples": 0,
+        "outliers": 0,
+        "entities_sent": 0,
+        # Position of each station: next offset in QuantumLeap and date of the last sample analysed (epoch ms)
+        "stations": {station_id: {"offset": 0, "last_date": None, "done": False} for station_id in stations}
+    }
+
+def job_status(job):
+    '''
+    Return the state of a job with its progress (share of the period analysed) and throughput
+    '''
+    with jobs_lock:
+        status = {key: value for key, value in job.items() if key != "stations"}
+        positions = list(job["stations"].values())
+
+    start, end = aux_func.date_to_epoch(job["from"]), aux_func.date_to_epoch(job["to"])
+    done = [1.0 if x["done"] else 0.0 if x["last_date"] is None else min(1.0, (x["last_date"] - start) / (end - start)) for x in positions]
+
+    status["progress"] = {
+        "stations": len(positions),
+        "stations_done": sum(x["done"] for x in positions),
+        "percent": round(100 * sum(done) / len(done), 1) if done else 100.0
+    }
+    status["throughput"] = {
+        "samples_per_second": round(job["samples"] / job["elapsed"], 1) if job["elapsed"] > 0 else 0.0,
+        "entities_per_second": round(job["entities_sent"] / job["elapsed"], 1) if job["elapsed"] > 0 else 0.0
+    }
+
+    return status
+
+def checkpoint_path(job_id):
+    return os.path.join(aquaspice_utils.config.get("backfill_dir", "./backfill"), f"{job_id}.json")
+
+def save_checkpoint(job):
+    '''
+    Write the checkpoint of a job (replaced atomically, not written if backfill_dir is empty)
+    '''
+    if not aquaspice_utils.config.get("backfill_dir", "./backfill"):
+        return
+
+    path = checkpoint_path(job["job_id"])
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+
+    with jobs_lock:
+        job["updated"] = aux_func.get_datetime_now()
+        content = json.dumps(job)
+
+    with open(path + ".tmp", "w") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+
+def load_checkpoints():
+    '''
+    Load the jobs of the checkpoints in backfill_dir (jobs already known are kept)
+    '''
+    directory = aquaspice_utils.config.get("backfill_dir", "./backfill")
+    if not directory:
+        return
+
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        try:
+            with open(path, "r") as f:
+                job = json.load(f)
+        except (OSError, ValueError) as e:
+            aux_func.logMessage(f"---X Unreadable backfill checkpoint {path}: {e}", kind = "error")
+            continue
+
+        with jobs_lock:
+            jobs.setdefault(job["job_id"], job)
+
+def set_status(job, status, error = None):
+    with jobs_lock:
+        job["status"] = status
+        job["error"] = error
+
+def submit_job(job):
+    '''
+    Save a job and queue it for the background worker
+    '''
+    with jobs_lock:
+        jobs[job["job_id"]] = job
+
+    save_checkpoint(job)
+    start_worker()
+    job_queue.put(job["job_id"])
+
+    aux_func.logMessage(f"--> Backfill {job['job_id']} queued ({job['subscription_id']}, {len(job['stations'])} stations, {job['from']} - {job['to']})")
+
+def cancel_job(job_id):
+    '''
+    Cancel a job (a running job stops after its current round). Returns the job, None if it does not exist
+    '''
+    job = jobs.get(job_id)
+    if job is None:
+        return None
+
+    if job["status"] == "queued":
+        set_status(job, "cancelled")
+        save_checkpoint(job)
+    elif job["status"] == "running":
+        cancel_requests.add(job_id)
+
+    return job
+
+def resume_jobs():
+    '''
+    Queue the unfinished jobs of the checkpoints (on startup)
+    '''
+    load_checkpoints()
+
+    pending = sorted((job for job in list(jobs.values()) if job["status"] not in FINISHED), key = lambda job: job["created"])
+
+    for job in pending:
+        set_status(job, "queued")
+        submit_job(job)
+
+    if pending:
+        aux_func.logMessage(f"--> {len(pending)} backfill jobs resumed")
+
+def start_worker():
+    '''
+    Start the background thread running the queued jobs (one at a time)
+    '''
+    global job_queue
+
+    with jobs_lock:
+        if job_queue is not None:
+            return
+        job_queue = queue.Queue()
+
+    threading.Thread(target = _worker, name = "backfill", daemon = True).start()
+
+def _worker():
+    while True:
+        job = jobs.get(job_queue.get())
+
+        if (job is not None) and (job["status"] == "queued"):
+            run_job(job)
+
+############### Analysis ###############
+
+def run_job(job):
+    '''
+    Run (or resume) a job until every station is analysed, writing a checkpoint after each round.
+    The analysis is done by rounds: one page of the history of every station of the group (first `backfill_batch_size`
+    stations not done yet), scored and sent before the checkpoint moves on
+    '''
+    config = aquaspice_utils.config
+    group_size = config.get("backfill_batch_size", 100)
+    page_size = config.get("backfill_page_size", 100)
+    limiter = RateLimiter(config.get("backfill_rate", 0))
+
+    started = time.monotonic()
+    elapsed = job["elapsed"]
+
+    set_status(job, "running")
+    save_checkpoint(job)
+    aux_func.logMessage(f"--> Backfill {job['job_id']} started")
+
+    try:
+        analysis = find_analysis(job["subscription_id"])
+        if analysis is None:
+            raise ValueError(f"Unknown subscription: {job['subscription_id']}")
+
+        detector = detectors.DETECTORS[analysis["algorithm"]](config, analysis, {})
+
+        # Samples in memory of each station of the group (rebuilt from QuantumLeap when a station starts or the job resumes)
+        contexts = {}
+
+        while True:
+            if job["job_id"] in cancel_requests:
+                cancel_requests.discard(job["job_id"])
+                set_status(job, "cancelled")
+                break
+
+            group = [station_id for station_id, position in job["stations"].items() if not position["done"]][:group_size]
+            if not group:
+                set_status(job, "completed")
+                break
+
+            entities = []
+            positions = {}
+            outliers = 0
+
+            for station_id in group:
+                if station_id not in contexts:
+                    contexts[station_id] = _station_context(job, detector, analysis, station_id)
+
+                station_entities, positions[station_id], contexts[station_id], station_outliers = _station_page(job, detector, analysis, station_id, contexts[station_id], page_size)
+                entities += station_entities
+                outliers += station_outliers
+
+            _send(entities, group_size, limiter)
+
+            # The round is only recorded once its readings are sent
+            with jobs_lock:
+                job["stations"].update(positions)
+                job["samples"] += len(entities)
+                job["outliers"] += outliers
+                job["entities_sent"] += len(entities)
+                job["elapsed"] = elapsed + time.monotonic() - started
+
+            for station_id in group:
+                if positions[station_id]["done"]:
+                    del contexts[station_id]
+
+            metrics.BACKFILL_SAMPLES.inc(len(entities), algorithm = detector.algorithm)
+            save_checkpoint(job)
+
+            aux_func.logMessage("--> Backfill {}: {}", "debug", lambda: job["job_id"], lambda: job_status(job))
+
+    except Exception as e:
+        aux_func.logMessage(f"---X Backfill {job['job_id']} failed: {e}", kind = "error")
+        set_status(job, "failed", str(e))
+
+    with jobs_lock:
+        job["elapsed"] = elapsed + time.monotonic() - started
+
+    save_checkpoint(job)
+
+    status = job_status(job)
+    aux_func.logMessage(f"--> Backfill {job['job_id']} {status['status']}: {status['samples']} samples, {status['outliers']} outliers, "
+                        f"{status['throughput']['samples_per_second']} samples/s")
+
+    return status
+
+def _station_context(job, detector, analysis, station_id):
+    '''
+    Return the samples in memory of a station at its position in the job ({property: values}): the history before the period
+    (as loaded by the streaming analysis), followed by the samples already analysed since the last reset
+    '''
+    position = job["stations"][station_id]
+    start = aux_func.date_to_epoch(job["from"])
+    # (up to the last sample analysed, or just before the period)
+    end = start - 1 if position["last_date"] is None else position["last_date"]
+
+    history = aquaspice_utils.query_historical_data_paginated(station_urn(analysis, station_id), detector.config["query_points"], detector.properties, to_date = iso_date(end))
+    if history is None:
+        # (QuantumLeap answers 404 when there are no samples)
+        aux_func.logMessage(f"--> No history of {station_id} before {iso_date(end)}, windows start empty", kind = "warning")
+        history = {"dates": np.empty(0, dtype = np.int64), "values": {x: np.empty(0) for x in detector.properties}}
+
+    dates = history["dates"]
+    before = dates < start
+
+    # Samples analysed (timestamps with every property, as in the pages), the windows restart after their last reset
+    analysed = (~before) & (dates <= end) & ~np.any([np.isnan(history["values"][x]) for x in detector.properties], axis = 0)
+    analysed_dates = dates[analysed]
+    resets = np.flatnonzero(np.diff(analysed_dates // 1000) // 60 >= aux_func.RESET_GAP_MINUTES)
+
+    if len(resets) > 0:
+        analysed[dates < analysed_dates[resets[-1] + 1]] = False
+        before[:] = False
+
+    return {x: history["values"][x][(before & ~np.isnan(history["values"][x])) | analysed] for x in detector.properties}
+
+def _station_page(job, detector, analysis, station_id, context, page_size):
+    '''
+    Score the next page of a station. Returns its corrected readings, the new position of the station, the samples in memory
+    after the page and the number of outliers
+    '''
+    position = dict(job["stations"][station_id])
+
+    page = aquaspice_utils.query_historical_all_data(station_urn(analysis, station_id), position["offset"], page_size,
+                                                     attrs = detector.properties, from_date = job["from"], to_date = job["to"])
+
+    # (QuantumLeap answers 404 when there are no more samples)
+    index = page["index"] if page is not None else []
+    position["offset"] += len(index)
+    position["done"] = len(index) < page_size
+
+    if len(index) == 0:
+        return [], position, context, 0
+
+    timestamps = pd.to_datetime(index, utc = True)
+    observedAt = np.asarray(timestamps.strftime("%Y-%m-%dT%H:%M:%S.%f").str[:-3] + "Z")
+    attributes = {attribute["attrName"]: attribute["values"] for attribute in page["attributes"]}
+    values = {x: np.array(attributes.get(x, [None] * len(index)), dtype = np.float64) for x in detector.properties}
+
+    # Only the timestamps with every analysed property (as the notifications)
+    rows = np.flatnonzero(~np.any([np.isnan(values[x]) for x in detector.properties], axis = 0))
+    if len(rows) == 0:
+        return [], position, context, 0
+
+    dates = timestamps.asi8[rows] // 10**6
+    values = {x: values[x][rows] for x in detector.properties}
+
+    # Windows reset after a data gap with the previous page (as calculate_date_distance)
+    if (position["last_date"] is not None) and ((dates[0] // 1000 - position["last_date"] // 1000) // 60 >= aux_func.RESET_GAP_MINUTES):
+        context = {x: np.empty(0) for x in detector.properties}
+
+    scores = {}
+    for property_name in detector.properties:
+        scores[property_name] = detector.score_series(property_name, values[property_name], dates, context[property_name])
+
+    # Samples in memory after the page (since the last reset, at most query_points)
+    context = {x: aux_func.series_segments(values[x], dates, context[x])[-1][0][-detector.config["query_points"]:] for x in detector.properties}
+    position["last_date"] = int(dates[-1])
+
+    entities = []
+    outliers = 0
+
+    for i, row in enumerate(rows):
+        reading = {"id": station_id, "type": analysis["entityType"]}
+        is_outlier, corrected, reason = {}, {}, {}
+
+        for property_name in detector.properties:
+            flags, corrected_values, reasons = scores[property_name]
+            reading[property_name] = {"type": "Property", "value": float(values[property_name][i]), "observedAt": observedAt[row]}
+            is_outlier[property_name] = flags[i]
+            corrected[property_name] = {"value": float(corrected_values[i])}
+            reason[property_name] = reasons[i]
+            outliers += (flags[i] == True) or (flags[i] == "Yes")
+
+        entities.append(aux_func.build_corrected_reading(aux_func.short_id(station_id), analysis["entityType"], reading, corrected, analysis, is_outlier, reason))
+
+    return entities, position, context, int(outliers)
+
+def _send(entities, batch_size, limiter):
+    '''
+    Upsert the corrected readings of a round: the updates of a station keep their order, each upsert holds at most one
+    update of every station (at most batch_size entities), paced by the rate limiter. Raises RuntimeError if an upsert fails
+    '''
+    for body in aquaspice_utils.split_unique_ids(entities):
+        for start in range(0, len(body), batch_size):
+            batch = body[start:start + batch_size]
+            limiter.wait(len(batch))
+
+            if not aquaspice_utils.upsert_entities(batch):
+                raise RuntimeError(f"Upsert of {len(batch)} corrected readings failed")
+
+############### HTTP endpoints ###############
+
+@blueprint.route("/backfill", methods=["POST"])
+def create_job_endpoint():
+    '''
+    Start a backfill job ({"subscription_id", "from", "to", "stations" (optional)}), answers 202 with the job
+    '''
+    body = flask.request.get_json(silent = True)
+
+    if (not isinstance(body, dict)) or any(key not in body for key in ["subscription_id", "from", "to"]):
+        return flask.jsonify(isError=True, message="Expected a JSON object with subscription_id, from and to", statusCode=400), 400
+
+    try:
+        job = new_job(body["subscription_id"], body["from"], body["to"], body.get("stations"))
+    except ValueError as e:
+        return flask.jsonify(isError=True, message=str(e), statusCode=400), 400
+
+    submit_job(job)
+
+    return flask.jsonify(job_status(job)), 202
+
+@blueprint.route("/backfill", methods=["GET"])
+def list_jobs_endpoint():
+    '''
+    State of every job
+    '''
+    return flask.jsonify(jobs=[job_status(job) for job in list(jobs.values())]), 200
+
+@blueprint.route("/backfill/<job_id>", methods=["GET"])
+def job_endpoint(job_id):
+    '''
+    State of a job (progress and throughput)
+    '''
+    job = jobs.get(job_id)
+    if job is None:
+        return flask.jsonify(isError=True, message=f"Unknown job: {job_id}", statusCode=404), 404
+
+    return flask.jsonify(job_status(job)), 200
+
+@blueprint.route("/backfill/<job_id>", methods=["DELETE"])
+def cancel_job_endpoint(job_id):
+    '''
+    Cancel a job
+    '''
+    job = cancel_job(job_id)
+    if job is None:
+        return flask.jsonify(isError=True, message=f"Unknown job: {job_id}", statusCode=404), 404
+
+    return flask.jsonify(job_status(job)), 200
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Run a backfill job in the foreground (analysis of a past period, corrected readings sent to the context broker)")
+    parser.add_argument("config_file", help = "the config file path[s] (separated by ';')")
+    parser.add_argument("--subscription", help = "subscription id of the analysis")
+    parser.add_argument("--from", dest = "from_date", help = "start of the period (ISO 8601)")
+    parser.add_argument("--to", dest = "to_date", help = "end of the period (ISO 8601)")
+    parser.add_argument("--stations", help = "station ids, separated by ';' (default: entityIds of the analysis)")
+    parser.add_argument("--resume", metavar = "JOB_ID", help = "resume the job of a checkpoint")
+    args = parser.parse_args()
+
+    # Default configuration until the config files are loaded
+    aux_func.setup_logging({})
+    aquaspice_utils.init(args.config_file)
+    aux_func.setup_logging(aquaspice_utils.config)
+
+    if args.resume:
+        load_checkpoints()
+        job = jobs.get(args.resume)
+        if job is None:
+            parser.error(f"no checkpoint for job {args.resume}")
+    else:
+        if not (args.subscription and args.from_date and args.to_date):
+            parser.error("--subscription, --from and --to are required (or --resume)")
+        try:
+            job = new_job(args.subscription, args.from_date, args.to_date, args.stations)
+        except ValueError as e:
+            parser.error(str(e))
+
+        jobs[job["job_id"]] = job
+
+    status = run_job(job)
+    print(json.dumps(status, indent = 4))
+
+    sys.exit(0 if status["status"] == "completed" else 1)
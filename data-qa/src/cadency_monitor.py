@@ -0,0 +1,62 @@
+################################################################################### Imports
+import heapq
+import threading
+import time
+
+###################################################################################
+
+class CadencyMonitor:
+    '''
+    Missing-data monitor. Keeps the time (epoch seconds) of the last reading of each station, and a min-heap with one entry
+    per station keyed by the start of the silence being checked: the deadline of an entry is its key plus the threshold, so a
+    check only visits the stations whose deadline expired (readings only update the last time, O(1)).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Last reading of each station (epoch seconds) and entity type (for the anomaly)
+        self._last_seen = {}
+        self._entity_type = {}
+        # (key, station_id), one entry per station
+        self._heap = []
+
+    def __len__(self):
+        return len(self._last_seen)
+
+    def touch(self, station_id, entity_type, when = None):
+        '''
+        Record a reading of a station (now if `when` is None)
+        '''
+        when = int(time.time()) if when is None else int(when)
+
+        with self._lock:
+            if station_id not in self._last_seen:
+                heapq.heappush(self._heap, (when, station_id))
+            elif when <= self._last_seen[station_id]:
+                return
+
+            self._last_seen[station_id] = when
+            self._entity_type[station_id] = entity_type
+
+    def expired(self, now, threshold):
+        '''
+        Return the stations without readings for more than `threshold` seconds, as (station_id, entity_type, last reading) tuples.
+        A silent station is reported once per threshold period
+        '''
+        now = int(now)
+        alerts = []
+
+        with self._lock:
+            while self._heap and (self._heap[0][0] + threshold <= now):
+                key, station_id = heapq.heappop(self._heap)
+                last_seen = self._last_seen[station_id]
+
+                if last_seen > key:
+                    # Readings received since the entry was pushed, check again from the last one
+                    heapq.heappush(self._heap, (last_seen, station_id))
+                else:
+                    alerts.append((station_id, self._entity_type[station_id], last_seen))
+                    # Next report one threshold later (at most one report per check)
+                    heapq.heappush(self._heap, (max(key + threshold, now), station_id))
+
+        return alerts
@@ -1,37 +1,96 @@
 ################################################################################### Imports
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
+import atexit
+import collections
+from concurrent.futures import Future
 import json
+import numpy as np
+import pandas as pd
+import queue
+import threading
+import time
+from loguru import logger
+
+import metrics
 
 config = None
 token = None
 
-def load_config():
+# Shared HTTP client (connection pooling / keep-alive), see create_session
+session = None
+
+# Shared cache of historical queries: (urn, lastN) -> (expiry time, response), and the queries in progress (single-flight)
+history_cache = collections.OrderedDict()
+history_in_flight = {}
+history_cache_lock = threading.Lock()
+
+# Background upsert sender (queue of entities, and counters to report its state)
+upsert_queue = None
+upsert_sender_stats = {"sent": 0, "failed": 0, "rejected": 0, "batches": 0}
+
+def load_config(config_file = None):
+    '''
+    Load the config file[s] (separated by ';'), taken from the command line if config_file is None
+    '''
     global config
     # Load config
-    parser = argparse.ArgumentParser(description='')
-    parser.add_argument('config_file', metavar='config_file', help='the config file path')
-    args = parser.parse_args()
+    if config_file is None:
+        parser = argparse.ArgumentParser(description='')
+        parser.add_argument('config_file', metavar='config_file', help='the config file path')
+        config_file = parser.parse_args().config_file
     config = {}
     
-    print(f'Using config file[s] {args.config_file}')
+    logger.info(f'Using config file[s] {config_file}')
     
-    for file_path in args.config_file.split(';'):
-        print(f'Reading {file_path}')
+    for file_path in config_file.split(';'):
+        logger.info(f'Reading {file_path}')
         with open(file_path, "r") as f:
             content = json.load(f)
-            print(content)   
+            logger.opt(lazy = True).debug("{}", lambda: content)
             config = {**config, **content}
             
-    print("Final config:")
-    print(config) 
+    logger.opt(lazy = True).debug("Final config: {}", lambda: config)
     
-def query_quantumleap(path):
-    global config
+def create_session():
+    '''
+    Create the HTTP client shared by every call to the context broker and QuantumLeap.
+    Connections are pooled and kept alive. Idempotent requests (GET, DELETE...) are retried with exponential backoff
+    '''
+    global session
+
+    retry = Retry(total = config.get("http_retries", 3),
+                  backoff_factor = config.get("http_backoff_factor", 0.5),
+                  status_forcelist = [429, 500, 502, 503, 504],
+                  allowed_methods = Retry.DEFAULT_ALLOWED_METHODS,
+                  raise_on_status = False)
+    adapter = HTTPAdapter(pool_connections = config.get("http_pool_size", 10),
+                          pool_maxsize = config.get("http_pool_size", 10),
+                          max_retries = retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+def http_request(method, url, **kwargs):
+    '''
+    Send a request with the shared HTTP client (configured timeouts)
+    '''
+    if session is None:
+        create_session()
+
+    kwargs.setdefault("timeout", (config.get("http_connect_timeout", 5), config.get("http_read_timeout", 30)))
 
+    return session.request(method, url, **kwargs)
+
+def query_quantumleap(path):
     url = config["rtm_platform_services_urls"]["historical"] + f'/v2/{path}'
-    print(url)
-    response = requests.get(url = url,
+    logger.debug(url)
+    response = http_request("GET", url = url,
                             headers={'Authorization': 'Bearer ' + access_token})
         
     return response
@@ -44,29 +103,25 @@ def request_create_subscription(subscription_id, body):
     For more info, read: https://documenter.getpostman.com/view/513743/fiware-subscriptions/RW1dHeTR#intro  and specially
     https://documenter.getpostman.com/view/513743/fiware-subscriptions/RW1dHeTR#89da7ed6-4c05-4360-810b-a80e7ee213aa
     '''
-    global config
-
     #Delete subscription (if exists)
-    print("------ Delete sub ------")
-    response = requests.delete(url = config["rtm_platform_services_urls"]['broker']+'/ngsi-ld/v1/subscriptions/' + subscription_id,
+    logger.info("------ Delete sub ------")
+    response = http_request("DELETE", url = config["rtm_platform_services_urls"]['broker']+'/ngsi-ld/v1/subscriptions/' + subscription_id,
     headers = { 'Authorization': 'Bearer ' + access_token})
-    print(response)
-    print("------ Create sub ------")
+    logger.info(str(response))
+    logger.info("------ Create sub ------")
     #Create new subscription
-    print(json.dumps(body, indent=4),flush=True)
+    logger.opt(lazy = True).debug("{}", lambda: json.dumps(body, indent=4))
 
-    response = requests.post(url=config["rtm_platform_services_urls"]["broker"] + '/ngsi-ld/v1/subscriptions',
+    response = http_request("POST", url=config["rtm_platform_services_urls"]["broker"] + '/ngsi-ld/v1/subscriptions',
                              headers = {"content-type": "application/ld+json",  'Authorization': 'Bearer ' + access_token}, data=json.dumps(body))
-    print(response)
-    print(response.text)
-    print('--> Subscription created', flush = True)
+    logger.info(str(response))
+    logger.info(response.text)
+    logger.info('--> Subscription created')
 
 def create_subscription(analysis):
     '''
     Function responsible of creating the subscription, based on the defined analysis (entitytype, ids, properties...)
     '''
-    global config
-
     # Create json list to specify which Ids/entities are part of this subscription
     entity_json_list = []
 
@@ -105,17 +160,15 @@ def create_subscription(analysis):
 
     del entity_json_list
 
-    print("--> Subscription created")
+    logger.info("--> Subscription created")
 
 
 def upsert_context_broker(body):
-    global config
-    
     url = config["rtm_platform_services_urls"]["broker"] + '/ngsi-ld/v1/entityOperations/upsert'
-    print(f"--> Started upsert_context_broker (url: {url})", flush = True)
+    logger.debug(f"--> Started upsert_context_broker (url: {url})")
     
     #print(json.dumps(body))
-    response = requests.post(url = url, headers = {
+    response = http_request("POST", url = url, headers = {
      'Authorization': 'Bearer ' + access_token,
     "content-type": "application/ld+json"            
     }, data=json.dumps(body))
@@ -124,18 +177,170 @@ def upsert_context_broker(body):
     if response.status_code == 401:
         get_token()
         
-        response = requests.post(url = url, headers = {
+        response = http_request("POST", url = url, headers = {
         'Authorization': 'Bearer ' + access_token,
         "content-type": "application/ld+json"            
         }, data=json.dumps(body))
         
     if(response.ok == False):
-        print(f"---X Error while executing upsert_context_broker. Response code: {response.status_code}, Response text: {response.text}", flush = True)
+        logger.error(f"---X Error while executing upsert_context_broker. Response code: {response.status_code}, Response text: {response.text}")
     else:
-        print(f"---> Success on upsert_context_broker. Response code: {response.status_code}, Response text: {response.text}", flush = True)
+        logger.opt(lazy = True).debug("---> Success on upsert_context_broker. Response code: {}, Response text: {}", lambda: response.status_code, lambda: response.text)
+
+    return response.ok
+
+def split_unique_ids(entities):
+    '''
+    Split a list of entities in consecutive upsert bodies where each id appears once (keeping the order of updates)
+    '''
+    bodies = []
+    last_body = {}
+
+    for entity in entities:
+        # The entity goes in the body following its previous update
+        index = last_body.get(entity["id"], -1) + 1
+
+        if index == len(bodies):
+            bodies.append([])
+
+        bodies[index].append(entity)
+        last_body[entity["id"]] = index
+
+    return bodies
+
+def start_upsert_sender():
+    '''
+    Start the background thread sending the queued entities as batched upserts.
+    A batch is flushed when it reaches `upsert_batch_size` entities or after `upsert_flush_interval` seconds
+    '''
+    global upsert_queue
+
+    upsert_queue = queue.Queue(maxsize = config.get("upsert_queue_size", 10000))
+
+    threading.Thread(target = _upsert_sender, name = "upsert_sender", daemon = True).start()
+    atexit.register(stop_upsert_sender)
+
+    logger.info(f"--> Upsert sender started (queue size: {upsert_queue.maxsize})")
+
+def stop_upsert_sender(timeout = 10):
+    '''
+    Wait until the queued entities are sent (on shutdown)
+    '''
+    if upsert_queue is None:
+        return
+
+    deadline = time.monotonic() + timeout
+
+    try:
+        upsert_queue.put(None, timeout = timeout)
+    except queue.Full:
+        return
+
+    while (upsert_queue.unfinished_tasks > 0) and (time.monotonic() < deadline):
+        time.sleep(0.05)
+
+def enqueue_upsert(entities):
+    '''
+    Queue entities to be upserted by the background sender (sent synchronously if the sender is not started).
+    Applies backpressure: waits up to `upsert_enqueue_timeout` seconds when the queue is full, then rejects the entities.
+    Returns False if entities were rejected
+    '''
+    if upsert_queue is None:
+        upsert_entities(entities)
+        return True
+
+    for i, entity in enumerate(entities):
+        try:
+            upsert_queue.put(entity, timeout = config.get("upsert_enqueue_timeout", 1))
+        except queue.Full:
+            upsert_sender_stats["rejected"] += len(entities) - i
+            metrics.UPSERTED_ENTITIES.inc(len(entities) - i, status = "rejected")
+            logger.error(f"---X Upsert queue full ({upsert_queue.maxsize}), {len(entities) - i} entities rejected (total rejected: {upsert_sender_stats['rejected']})")
+            return False
+
+    return True
+
+def upsert_entities(entities):
+    '''
+    Upsert entities now, without the queue (several upserts if an entity id is repeated), returns False if an upsert failed
+    '''
+    ok = True
+
+    for body in split_unique_ids(entities):
+        ok = _send_upsert(body) and ok
+
+    return ok
+
+def upsert_queue_status():
+    '''
+    Return the state of the upsert sender (queued entities and counters)
+    '''
+    return {"queued": upsert_queue.qsize() if upsert_queue is not None else 0,
+            "capacity": upsert_queue.maxsize if upsert_queue is not None else 0,
+            **upsert_sender_stats}
+
+def _upsert_sender():
+    '''
+    Background loop: collects queued entities and flushes them by size or by time
+    '''
+    batch_size = config.get("upsert_batch_size", 100)
+    flush_interval = config.get("upsert_flush_interval", 1)
+
+    batch = []
+    deadline = None
+    running = True
+
+    while running:
+        try:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            entity = upsert_queue.get(timeout = timeout)
+
+            if entity is None:
+                running = False
+            else:
+                batch.append(entity)
+                if deadline is None:
+                    deadline = time.monotonic() + flush_interval
+        except queue.Empty:
+            pass
+
+        if batch and ((len(batch) >= batch_size) or (time.monotonic() >= deadline) or (running == False)):
+            _flush_upserts(batch)
+            for _ in batch:
+                upsert_queue.task_done()
+            batch = []
+            deadline = None
+
+        if running == False:
+            upsert_queue.task_done()
+
+def _flush_upserts(batch):
+    '''
+    Send a batch of entities (several upserts if an entity id is repeated)
+    '''
+    for body in split_unique_ids(batch):
+        ok = _send_upsert(body)
+
+        upsert_sender_stats["sent" if ok else "failed"] += len(body)
+        upsert_sender_stats["batches"] += 1
+
+def _send_upsert(body):
+    '''
+    Upsert a list of entities (timed and counted in the metrics), returns False if it failed
+    '''
+    with metrics.UPSERT_SECONDS.time():
+        try:
+            ok = upsert_context_broker(body)
+        except Exception as e:
+            logger.error(f"---X Exception on batched upsert: {e}")
+            ok = False
+
+    metrics.UPSERTED_ENTITIES.inc(len(body), status = "sent" if ok else "failed")
+
+    return ok
 
 def get_token():
-    global access_token, config
+    global access_token
 
     if config["external"] == False:
         access_token = ""
@@ -151,54 +356,169 @@ def get_token():
     
     url = config["rtm_platform_services_urls"]["secure"] + "/oauth2/token"
     
-    response = requests.request("POST", url, headers=headers,auth=(config["app_id"],config["app_secret"]), data=payload)
+    response = http_request("POST", url, headers=headers,auth=(config["app_id"],config["app_secret"]), data=payload)
 
     if(response.ok == True):
-        print(f"--> Response from token: {response}", flush = True)
-        print(f'--> Access token acquired = {response.json()["access_token"]}', flush = True)
+        logger.info(f"--> Response from token: {response}")
+        logger.opt(lazy = True).debug("--> Access token acquired = {}", lambda: response.json()["access_token"])
 
         access_token = response.json()["access_token"]
     else:
-        print(f"---X Error while accepting token: {response.text}", flush = True)
+        logger.error(f"---X Error while accepting token: {response.text}")
 
 def query_historical_data_lastN(urn, lastN):
     '''
     Query historical data. Based on the last N samples.
+    Responses are shared: concurrent or back-to-back calls with the same (urn, lastN) share one fetch and one parse
+    (cache with a TTL of `history_cache_ttl` seconds and at most `history_cache_size` responses, least recently used evicted first)
     '''
-    global config
+    key = (urn, lastN)
 
-    type = (
-            config["rtm_platform_public_url"]
-            + f"/schemas/AquaSPICE/{entityType}/schema.json"
-    )
-    print(f"--> Query historical data with n = {lastN} for urn = {urn}", flush = True)
-    response = query_quantumleap(
-        f"entities/{urn}?lastN={lastN}&type={type}"
-    )
-    if response.ok == False:
-        print(f"---X Failed to get historical data for {urn}: {response.reason}", flush = True)
-        return None
-    else:
-        print(f"---> Query historical data at {urn} successful ({lastN} samples retrieved).", flush = True)
-        return response.json()
+    with history_cache_lock:
+        cached = history_cache.get(key)
+
+        if (cached is not None) and (cached[0] > time.monotonic()):
+            history_cache.move_to_end(key)
+            logger.debug(f"--> Query historical data with n = {lastN} for urn = {urn} (cached)")
+            return cached[1]
+
+        # Join the query in progress, if any
+        in_flight = history_in_flight.get(key)
+        owner = in_flight is None
+
+        if owner:
+            in_flight = history_in_flight[key] = Future()
+
+    if owner == False:
+        return in_flight.result()
+
+    response = None
+    try:
+        response = _query_historical_data_lastN(urn, lastN)
+        in_flight.set_result(response)
+    except Exception as e:
+        in_flight.set_exception(e)
+        raise
+    finally:
+        with history_cache_lock:
+            del history_in_flight[key]
+
+            # Failed queries are not cached
+            if response is not None:
+                history_cache[key] = (time.monotonic() + config.get("history_cache_ttl", 300), response)
+                history_cache.move_to_end(key)
 
+                while len(history_cache) > config.get("history_cache_size", 256):
+                    history_cache.popitem(last = False)
 
-def query_historical_all_data(urn, offset, limit):
+    return response
+
+def _query_historical_data_lastN(urn, lastN):
+    '''
+    Query historical data. Based on the last N samples, only the attributes analysed for the entity type (paginated QuantumLeap requests)
+    '''
+    # urn = urn:ngsi-ld:AquaSpice:{entityType}:{id}
+    entityType = urn.split(":")[3]
+
+    logger.info(f"--> Query historical data with n = {lastN} for urn = {urn}")
+
+    return query_historical_data_paginated(urn, lastN, analysed_attributes(entityType))
+
+def analysed_attributes(entityType):
+    '''
+    Return the properties analysed for an entity type (by any of the configured analysis)
+    '''
+    attributes = []
+
+    for analysis in config["analysis"]:
+        if analysis["entityType"] == entityType:
+            attributes += [x for x in analysis["analyzedProperties"] if (x != "location") and (x not in attributes)]
+
+    return attributes
+
+def query_historical_data_paginated(urn, lastN, attributes, to_date = None):
+    '''
+    Query the last N samples of some attributes (up to `to_date` if given), walking QuantumLeap with offset/limit pages (query_historical_all_data).
+    With lastN, QuantumLeap pages go from the newest samples to the oldest, each page sorted by date.
+    Pages are written straight into preallocated arrays (filled from the end), so only one page of JSON is held at a time.
+    Returns {"dates": epoch (ms) array, "values": {attribute: values array}}, None if the query fails
+    '''
+    page_size = config.get("history_page_size", 1000)
+
+    dates = np.zeros(lastN, dtype = np.int64)
+    values = {attribute: np.full(lastN, np.nan) for attribute in attributes}
+
+    end = lastN
+    offset = 0
+    pages = 0
+
+    while end > 0:
+        limit = min(page_size, end)
+        page = query_historical_all_data(urn, offset, limit, attrs = attributes, lastN = lastN, to_date = to_date)
+
+        if page is None:
+            if offset == 0:
+                return None
+            break
+
+        pages += 1
+
+        num_samples = min(len(page["index"]), end)
+        if num_samples == 0:
+            break
+
+        start = end - num_samples
+        dates[start:end] = pd.to_datetime(page["index"][-num_samples:], utc = True).values.astype("datetime64[ms]").astype(np.int64)
+
+        for attribute in page["attributes"]:
+            if attribute["attrName"] in values:
+                # (null values become NaN)
+                values[attribute["attrName"]][start:end] = np.array(attribute["values"][-num_samples:], dtype = np.float64)
+
+        del page
+        end = start
+        offset += num_samples
+
+        # Last page
+        if num_samples < limit:
+            break
+
+    logger.info(f"---> Query historical data at {urn} successful ({lastN - end} samples retrieved, {pages} pages).")
+
+    return {"dates": dates[end:], "values": {attribute: array[end:] for attribute, array in values.items()}}
+
+def query_historical_all_data(urn, offset, limit, attrs = None, lastN = None, from_date = None, to_date = None):
     '''
     Query historical data. Possible to include offset and limit.
+    attrs = list of attributes to retrieve (all of them if None)
+    lastN = only the last N samples (offset/limit are then counted from the newest sample)
+    from_date, to_date = only the samples of a period (ISO 8601 dates)
     '''
+    # urn = urn:ngsi-ld:AquaSpice:{entityType}:{id}
+    entityType = urn.split(":")[3]
+
+    path = f'entities/{urn}?type={config["rtm_platform_public_url"]}/schemas/AquaSPICE/{entityType}/schema.json&offset={offset}&limit={limit}'
+
+    if attrs:
+        path += "&attrs=" + ",".join(attrs)
+    if lastN:
+        path += f"&lastN={lastN}"
+    if from_date:
+        path += f"&fromDate={from_date}"
+    if to_date:
+        path += f"&toDate={to_date}"
 
-    response = query_quantumleap(
-        f'entities/{urn}?&type={entityType_path}/schema.json&offset={offset}&limit={limit}')
+    response = query_quantumleap(path)
 
     if response.ok == False:
-        print(f"---X Failed to get historical data for {urn}: {response.reason}", flush = True)
+        logger.error(f"---X Failed to get historical data for {urn}: {response.reason}")
         return None
     else:
-        print(f"---> Query historical data at {urn} successful ({limit} samples retrieved).", flush = True)
+        logger.debug(f"---> Query historical data at {urn} successful ({limit} samples retrieved).")
         return response.json()
 
 
-def init():    
-    load_config()
+def init(config_file = None):
+    load_config(config_file)
+    create_session()
     get_token()
\ No newline at end of file
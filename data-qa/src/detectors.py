@@ -0,0 +1,190 @@
+################################################################################### Imports
+import numpy as np
+
+import auxiliar_functions as aux_func
+import hampel_functions as hampel_func
+import z_score_functions as zscore_func
+import watercps_functions as wcps_func
+
+###################################################################################
+
+# Detectors of the analysis plan (see streaming_analysis.analysis_plan): one object per analysis of the config, built when the
+# configuration is loaded, with its properties, windows and thresholds already resolved. Algorithms are looked up in DETECTORS,
+# so a new one only needs a Detector subclass decorated with @register("<algorithm>").
+
+# Registered detectors ({algorithm: Detector subclass})
+DETECTORS = {}
+
+def register(algorithm):
+    '''
+    Class decorator adding a detector to the registry
+    '''
+    def decorator(cls):
+        cls.algorithm = algorithm
+        DETECTORS[algorithm] = cls
+        return cls
+
+    return decorator
+
+class Detector:
+    '''
+    Detector of one analysis (entry of the "analysis" list of the config).
+    `measurements` is the in-memory dict of the algorithm ({prefix + short station id: {property: {...}}}), shared by the
+    analyses of the same algorithm
+    '''
+    algorithm = None
+    # Prefix of the keys of the in-memory dict (followed by the short station id)
+    prefix = None
+
+    def __init__(self, config, analysis, measurements):
+        self.config = config
+        self.analysis = analysis
+        self.measurements = measurements
+        self.properties = [x for x in analysis["analyzedProperties"] if x != "location"]
+
+    def station(self, station_id):
+        '''
+        Return the in-memory dict of a station (None if its windows are not created yet)
+        '''
+        return self.measurements.get(self.prefix + aux_func.short_id(station_id))
+
+    def create(self, station_id, anomaly_status, station_series, start_from_0 = False):
+        '''
+        Create the windows of a station (history queried unless start_from_0)
+        '''
+        raise NotImplementedError
+
+    def score(self, station_ids, property_name, values):
+        '''
+        Score the newest sample of several stations, returns the outlier flags and reasons aligned with station_ids
+        '''
+        raise NotImplementedError
+
+    def score_all(self, station_ids, stations, values):
+        '''
+        Score the newest sample of every property of several stations (stations: their in-memory dicts, values: {property: values
+        aligned with station_ids}), returns {property: (outlier flags, reasons)}. One call of score per property by default
+        '''
+        return {property_name: self.score(station_ids, property_name, values[property_name]) for property_name in self.properties}
+
+    def score_series(self, property_name, values, dates = None, history = None):
+        '''
+        Score a whole series offline (bulk QA of the history), same decisions as streaming it through score and correction.
+        history: samples in memory before the series, dates: epoch ms (windows reset at the data gaps).
+        Returns the outlier flags, corrected values and reasons aligned with values
+        '''
+        raise NotImplementedError
+
+    def correction(self, property_measurements, property_name):
+        '''
+        Corrected value of an outlier
+        '''
+        raise NotImplementedError
+
+    @staticmethod
+    def first_execution(property_measurements):
+        '''
+        Whether the windows are empty (the first sample starts them)
+        '''
+        return property_measurements["num_data"] is None
+
+    @staticmethod
+    def update(property_measurements):
+        '''
+        Update the derived statistics after a sample is appended
+        '''
+        property_measurements["num_data"] = len(property_measurements["data"])
+
+@register("z_score")
+class ZScoreDetector(Detector):
+    prefix = "z_score_measurement_"
+
+    def __init__(self, config, analysis, measurements):
+        super().__init__(config, analysis, measurements)
+        self.threshold = config["z_score_threshold"]
+        # Thresholds of the IQR confirmation of the candidates (default, failsafe)
+        self.iqr_thresholds = (config["iqr_threshold"]["default"], config["iqr_threshold"]["failsafe"])
+
+    def create(self, station_id, anomaly_status, station_series, start_from_0 = False):
+        zscore_func.z_score_module(self.config, station_id, self.analysis, self.measurements, anomaly_status, station_series, start_from_0)
+
+    def score(self, station_ids, property_name, values):
+        outliers = zscore_func.outlier_function_z_score_batch(station_ids, property_name, self.threshold, self.iqr_thresholds, values, self.measurements)
+        return outliers, ["None"] * len(station_ids)
+
+    def score_series(self, property_name, values, dates = None, history = None):
+        return zscore_func.outlier_function_z_score_series(self.config, property_name, self.threshold, values, dates, history)
+
+    def correction(self, property_measurements, property_name):
+        return round(property_measurements["stats"].mean, 2)
+
+    @staticmethod
+    def first_execution(property_measurements):
+        return property_measurements["stats"].count == 0
+
+    @staticmethod
+    def update(property_measurements):
+        # Update metrics with the sample entering (and the one leaving) the sliding window
+        property_measurements["stats"].sync(property_measurements["data"])
+
+@register("hampel_filter")
+class HampelDetector(Detector):
+    prefix = "hampel_filter_"
+
+    def __init__(self, config, analysis, measurements):
+        super().__init__(config, analysis, measurements)
+        self.sliding_window = {x: config["property_sliding_window"][x] for x in self.properties}
+        self.threshold = config["hampel_filter_threshold"]
+        # Thresholds of the IQR confirmation of the candidates (default, failsafe)
+        self.iqr_thresholds = (config["iqr_threshold"]["default"], config["iqr_threshold"]["failsafe"])
+
+    def create(self, station_id, anomaly_status, station_series, start_from_0 = False):
+        hampel_func.hampel_filter_module(self.config, station_id, self.analysis, self.measurements, anomaly_status, station_series, start_from_0)
+
+    def score(self, station_ids, property_name, values):
+        outliers = hampel_func.outlier_function_hampel_filter_batch(station_ids, property_name, self.sliding_window[property_name], self.threshold,
+                                                                    self.iqr_thresholds, values, self.measurements)
+        return outliers, ["None"] * len(station_ids)
+
+    def score_series(self, property_name, values, dates = None, history = None):
+        return hampel_func.outlier_function_hampel_filter_series(self.config, property_name, values, dates, history)
+
+    def correction(self, property_measurements, property_name):
+        # Mean of the sliding window
+        return round(np.mean(property_measurements["data"].last(self.sliding_window[property_name])), 2)
+
+@register("watercps_threshold")
+class WatercpsDetector(Detector):
+    prefix = "watercps_"
+
+    def __init__(self, config, analysis, measurements):
+        super().__init__(config, analysis, measurements)
+        # Thresholds of the analysed properties, one row per property (max, min, delta)
+        self.thresholds = wcps_func.compile_thresholds(config["watercps_error_flagging"], self.properties)
+
+    def create(self, station_id, anomaly_status, station_series, start_from_0 = False):
+        wcps_func.watercps_module(self.config, station_id, self.analysis, self.measurements, anomaly_status, station_series, start_from_0)
+
+    def score(self, station_ids, property_name, values):
+        row = self.properties.index(property_name)
+        is_outlier, reason = wcps_func.outlier_function_watercps_stations(self.thresholds[row:row + 1], [self.station(x) for x in station_ids],
+                                                                          [property_name], np.asarray(values, dtype = np.float64)[:, None])
+        return is_outlier[:, 0].tolist(), reason[:, 0].tolist()
+
+    def score_all(self, station_ids, stations, values):
+        # Every property of every station in a single evaluation
+        is_outlier, reason = wcps_func.outlier_function_watercps_stations(self.thresholds, stations, self.properties,
+                                                                          np.array([values[x] for x in self.properties], dtype = np.float64).T)
+        return {property_name: (is_outlier[:, j].tolist(), reason[:, j].tolist()) for j, property_name in enumerate(self.properties)}
+
+    def score_series(self, property_name, values, dates = None, history = None):
+        return wcps_func.outlier_function_watercps_series(self.config["watercps_error_flagging"], property_name, values, dates, history)
+
+    def correction(self, property_measurements, property_name):
+        # Mean of the last hour
+        return round(np.mean(property_measurements["data"].last(4)))
+
+    @staticmethod
+    def update(property_measurements):
+        # Number of samples and last samples scored with the next reading
+        wcps_func.update_last_samples(property_measurements)
@@ -1,81 +1,187 @@
 ################################################################################### Imports
+import bisect
 import numpy as np
 import pandas as pd
-from hampel import hampel
 import math
 
 import auxiliar_functions as aux_func
 import context_broker_client_utils as aquaspice_utils
+import sliding_window as sw
+
+# Constant scale factor of the MAD (normal distribution), same as the hampel library
+MAD_SCALE = 1.4826
 
 def outlier_function_hampel_filter(config, station_id, variable, data, hampel_filter_measurements):
     """
-    Function to implement Hampel Filter method
+    Function to implement Hampel Filter method (streaming, only the newest sample is scored)
     """
-    #global hampel_filter_measurements
+    iqr_thresholds = (config["iqr_threshold"]["default"], config["iqr_threshold"]["failsafe"])
+    return bool(outlier_function_hampel_filter_batch([station_id], variable, config["property_sliding_window"][variable], config["hampel_filter_threshold"],
+                                                     iqr_thresholds, [data], hampel_filter_measurements)[0])
 
-    short_id = station_id.split(":")[4]
-    data = float(data)
+def outlier_function_hampel_filter_batch(station_ids, variable, sliding_window, threshold, iqr_thresholds, data, hampel_filter_measurements):
+    """
+    Hampel Filter method for the newest sample of several stations at once.
+    sliding_window = sliding window of the variable (config "property_sliding_window"), threshold = config "hampel_filter_threshold"
+    iqr_thresholds = (default, failsafe) thresholds of the IQR confirmation (config "iqr_threshold")
+    Median and MAD are read per station, the decision is vectorized. Returns an array of booleans aligned with station_ids
+    """
+    iqr_default, iqr_failsafe = iqr_thresholds
+    data = np.asarray(data, dtype = np.float64)
+    measurements = [hampel_filter_measurements["hampel_filter_" + aux_func.short_id(station_id)][variable] for station_id in station_ids]
+
+    median = np.full(len(data), np.nan)
+    mad = np.full(len(data), np.nan)
+
+    for i, m in enumerate(measurements):
+        # Samples analysed: sliding window of history plus the sample of interest
+        num_points = min(len(m["data"]), sliding_window) + 1
+
+        # Look at the lenght of available data, and adjust the sliding window size according to that
+        hampel_window_size = math.floor(num_points / 2)
+
+        if hampel_window_size > sliding_window:
+            hampel_window_size = sliding_window
+
+        # If the sliding window is at least 100 (otherwise median stays NaN, never an outlier)
+        if hampel_window_size >= 100:
+            median[i], mad[i] = rolling_median_mad(m, data[i], hampel_window_size)
+
+    aux_func.logMessage("--> Debug: median({}), mad({}) current value: {}", "debug", lambda: median, lambda: mad, lambda: data)
+
+    # Check if the data point is an outlier or not (same rule as hampel(): |x - median| >= n * k * MAD)
+    outliers = np.abs(data - median) >= threshold * MAD_SCALE * mad
+
+    # Confirm candidates with the IQR method
+    for i in np.flatnonzero(outliers):
+        aux_func.logMessage("---> Hampel decided Outlier, waiting for IQR confirmation.", kind = "debug")
+
+        # Quartiles of the whole history (sorted index), shared by both thresholds
+        measurements[i]["iqr_index"].sync(measurements[i]["data"])
+        quartiles = aux_func.iqr_quartiles(measurements[i]["iqr_index"])
+
+        # IQR Failsafe
+        if aux_func.iqr_method(None, data[i], iqr_default, quartiles) == True:
+            aux_func.logMessage(f"--> Outlier ({data[i]}) detected by hampel filter.====================================================", kind = "warning")
+        else:
+            # Second check
+            if aux_func.iqr_method(None, data[i], iqr_failsafe, quartiles) == True:
+                aux_func.logMessage(f"--> IQR ({iqr_failsafe}) considered {data[i]} an outlier.", kind = "warning")
+            else:
+                aux_func.logMessage(f"--> Hampel filter did not consider {data[i]} an outlier. (After checking IQR)", kind = "debug")
+                outliers[i] = False
 
-    data_list = hampel_filter_measurements["hampel_filter_" + str(short_id)][variable]["data"][variable].values
-    data_observations = np.copy(data_list)
+    return outliers
 
-    # Append data point and get its index
-    data_list = list(data_list)[-(config["property_sliding_window"][variable]):]
-    aux_func.logMessage(f"Len data list (start): {len(data_list)}", kind = "debug")
+def rolling_median_mad(measurements, data, hampel_window_size):
+    '''
+    Median and MAD of the last 2 * hampel_window_size samples, including the sample of interest.
+    This is the centered window the hampel library uses for the last index of the series.
+    Read in O(log w) from the sorted window of the (station, property), numpy is used while it is still filling up.
+    '''
+    history_points = 2 * hampel_window_size - 1
+    sorted_window = measurements["sorted_window"]
 
-    # Append sample of interest
-    data_list.append(data)
+    if history_points != sorted_window.window:
+        values = np.append(measurements["data"].last(history_points), data)
+        median = np.median(values)
+        return median, np.median(np.abs(values - median))
 
-    # Get index of the value
-    index_data_point = len(data_list) - 1 if len(data_list) >= 2 else 0
+    sorted_window.sync(measurements["data"])
+    values = sorted_window.values
+    position = bisect.bisect_left(values, data)
 
-    # Look at the lenght of available data, and adjust the sliding window size according to that
-    hampel_window_size = math.floor((len(data_list) / 2))
+    # k-th value of the window once the sample of interest is inserted
+    def merged(k):
+        if k < position:
+            return values[k]
+        elif k == position:
+            return data
+        return values[k - 1]
 
-    if hampel_window_size > config["property_sliding_window"][variable]:
-        hampel_window_size = config["property_sliding_window"][variable]
+    median = (merged(hampel_window_size - 1) + merged(hampel_window_size)) / 2
 
-    # Debug
-    aux_func.logMessage(f"Len data list (end): {len(data_list)}", kind = "debug")
-    if len(data_list) >= 2:
-        aux_func.logMessage(f"--> Debug: min({np.min(data_list)}), max({np.max(data_list)}), mean({np.mean(data_list)}) current value: {data}, sliding_window: {hampel_window_size}", kind = "debug")
+    # Absolute deviations, both ascending: below the median (going left) and above it (going right)
+    def lower(i):
+        return median - merged(hampel_window_size - 1 - i)
 
-    # If the sliding window is at least 100
-    if hampel_window_size >= 100:
-        # Run outlier detection, must convert to pd Series
-        detected_outliers = hampel(pd.Series(data_list), window_size = hampel_window_size,
-                                   n = config["hampel_filter_threshold"],
-                                   imputation = False)
+    def upper(i):
+        return merged(hampel_window_size + i) - median
 
-        aux_func.logMessage(f"Total outliers in detected_outliers: {len(detected_outliers)}")
+    mad = (sw.kth_of_two(lower, hampel_window_size, upper, hampel_window_size, hampel_window_size - 1) +
+           sw.kth_of_two(lower, hampel_window_size, upper, hampel_window_size, hampel_window_size)) / 2
 
-        del data_list
+    return median, mad
 
-        # Debug
-        # Check if the data point is an outlier or not
-        if index_data_point in detected_outliers:
-            aux_func.logMessage("---> Hampel decided Outlier, waiting for IQR confirmation.", kind = "warning")
-            # IQR Failsafe
-            if aux_func.iqr_method(data_observations, data, config["iqr_threshold"]["default"]) == True:
-                aux_func.logMessage(f"--> Outlier ({data}) detected by hampel filter.====================================================", kind = "warning")
-                return True
+def outlier_function_hampel_filter_series(config, variable, values, dates = None, history = None):
+    """
+    Offline Hampel Filter method over a whole series (bulk QA of the history), same decisions as streaming its samples through
+    outlier_function_hampel_filter (including the IQR failsafe): median and MAD of the centered window ending with each sample,
+    starting from `history` (samples in memory before the series, none by default) and resetting the windows at the data gaps
+    of `dates` (epoch ms, see aux_func.series_segments).
+    Returns three arrays aligned with values: outlier (True/False), corrected value (original value if not an outlier) and reason ("None")
+    """
+    values = np.asarray(values, dtype = np.float64)
+    query_points = config["query_points"]
+    sliding_window = config["property_sliding_window"][variable]
+
+    outliers = np.zeros(len(values), dtype = bool)
+    corrected = values.copy()
+
+    # n * k of the rule |x - median| >= n * k * MAD
+    threshold = config["hampel_filter_threshold"] * MAD_SCALE
+
+    for series, offset, start, end in aux_func.series_segments(values, dates, history):
+        positions = np.arange(offset, offset + end - start)
+        data = values[start:end]
+
+        # Hampel window size of each sample, from the samples in memory when it is scored (see outlier_function_hampel_filter_batch)
+        num_points = np.minimum(np.minimum(positions, query_points), sliding_window) + 1
+        hampel_window_size = np.minimum(num_points // 2, sliding_window)
+
+        # Only scored if the window is at least 100 (otherwise never an outlier)
+        scored = np.flatnonzero(hampel_window_size >= 100)
+        median = np.full(len(scored), np.nan)
+        mad = np.full(len(scored), np.nan)
+
+        # Window of 2 * hampel_window_size samples ending with the sample of interest: a single size once the history is
+        # large enough, one per sample while it fills up
+        for size in np.unique(hampel_window_size[scored]):
+            rows = np.flatnonzero(hampel_window_size[scored] == size)
+            ends = positions[scored[rows]] + 1
+
+            if len(rows) > 2 * size:
+                # Rolling median of the whole series (O(log w) per sample)
+                rolling = pd.Series(series).rolling(2 * size)
+                median[rows] = rolling.median().to_numpy()[ends - 1]
+
+                # A sample can only be an outlier if its MAD is within bound = |x - median| / (n * k), i.e. `size` consecutive
+                # values of the sorted window v are within median +- bound: the run includes v[size // 2] or v[size // 2 + size],
+                # read with two rolling quantiles, so the MAD is only computed for the few samples passing this check
+                bound = np.abs(data[scored[rows]] - median[rows]) / threshold * (1 + 1e-9)
+                lower = rolling.quantile((size // 2 + 0.5) / (2 * size - 1), interpolation = "lower").to_numpy()[ends - 1]
+                upper = rolling.quantile((size // 2 + size + 0.5) / (2 * size - 1), interpolation = "lower").to_numpy()[ends - 1]
+                possible = (median[rows] - lower <= bound) | (upper - median[rows] <= bound)
+                rows, ends = rows[possible], ends[possible]
             else:
-                # Second check
-                if aux_func.iqr_method(data_observations, data, config["iqr_threshold"]["failsafe"]) == True:
-                    aux_func.logMessage(f"--> IQR ({config['iqr_threshold']['failsafe']}) considered {data} an outlier.", kind = "warning")
-                    return True
-                else:
-                    aux_func.logMessage(f"--> Hampel filter did not consider {data} an outlier. (After checking IQR)")
-                    return False
-        else:
-            aux_func.logMessage(f"--> Hampel filter did not consider {data} an outlier.")
-            return False
-    else:
-        return False
+                median[rows] = sw.trailing_apply(series, ends, 2 * size, lambda windows, block: np.median(windows, axis = 1))
+
+            mad[rows] = sw.trailing_apply(series, ends, 2 * size, lambda windows, block: np.median(np.abs(windows - median[rows[block], None]), axis = 1))
+
+        # Same rule as hampel(): |x - median| >= n * k * MAD, then confirm the candidates with the IQR method
+        candidates = np.flatnonzero(np.abs(data[scored] - median) >= threshold * mad)
+        confirmed = scored[candidates[aux_func.iqr_confirm(series, positions[scored[candidates]], data[scored[candidates]], config["iqr_threshold"], query_points)]]
+
+        outliers[start + confirmed] = True
+        # Mean of the sliding window
+        corrected[start + confirmed] = np.round(sw.trailing_apply(series, positions[confirmed], sliding_window, lambda windows, block: np.mean(windows, axis = 1)), 2)
 
-def hampel_filter_module(config, station_id, analysis, hampel_filter_measurements, anomaly_status, start_from_0 = False):
+    return outliers, corrected, np.full(len(values), "None", dtype = object)
+
+def hampel_filter_module(config, station_id, analysis, hampel_filter_measurements, anomaly_status, station_series, start_from_0 = False):
     '''
     Module responsible for executing the initial in-memory population of data for the hampel filter algorithm to work
+    The series are taken from `station_series` (shared with the other analyses of the station, history only queried for the new ones)
     # start_from_0, True = Do not get historic data, False = Get historic data
     '''
     aux_func.logMessage('--> Started hampel_filter module.')
@@ -90,58 +196,60 @@ def hampel_filter_module(config, station_id, analysis, hampel_filter_measurement
 
     hampel_filter_measurements["hampel_filter_" + str(short_id)] = {}
 
-    if station_id in anomaly_status:
-        pass
-    else:
-        anomaly_status[station_id] = {}
+    # (setdefault: modules of several analyses can initialise the same station concurrently)
+    anomaly_status.setdefault(station_id, {})
+
+    # Series of the analysed properties (views over the series shared by the analyses of the station)
+    series = {variable: sw.shared_series(station_series, station_id, variable, query_points) for variable in analysis["analyzedProperties"] if variable != "location"}
 
     if start_from_0 == True:
         for variable in analysis["analyzedProperties"]:
             if variable != "location":
                 hampel_filter_measurements["hampel_filter_" + str(short_id)][variable] = {
-                    "data": [],
+                    "data": series[variable][0],
                     "num_data": None,
+                    # History samples of the centered window (2 * floor((sliding_window + 1) / 2) - 1)
+                    "sorted_window": sw.SortedWindow(2 * math.floor((config["property_sliding_window"][variable] + 1) / 2) - 1),
+                    # Sorted index of the whole history (IQR failsafe)
+                    "iqr_index": sw.SortedWindow(query_points),
                     "date_updated" : aux_func.get_datetime_now()
                 }
 
                 # Anomaly control
-                if variable in anomaly_status[station_id]:
-                    pass
-                else:
-                    anomaly_status[station_id][variable] = {}
-                    anomaly_status[station_id][variable]["startDateOfOngoingAnomaly"] = None
+                anomaly_status[station_id].setdefault(variable, {"startDateOfOngoingAnomaly": None})
 
     elif start_from_0 == False:
-        # Get historic data
-        historic_data = aquaspice_utils.query_historical_data_lastN(f'urn:ngsi-ld:AquaSpice:{entityType}:{short_id}', query_points)
+        # Get historic data (only if a series is not in memory yet)
+        if any(created for view, created in series.values()):
+            historic_data = aquaspice_utils.query_historical_data_lastN(f'urn:ngsi-ld:AquaSpice:{analysis["entityType"]}:{short_id}', query_points)
 
         # Iterate over properties defined on config file
         for variable in analysis["analyzedProperties"]:
             if variable != "location":
+                view, created = series[variable]
                 hampel_filter_measurements["hampel_filter_" + str(short_id)][variable] = {
-                    "data": pd.DataFrame(columns = ["date", str(variable)]),
+                    "data": view,
                     "num_data": None,
+                    # History samples of the centered window (2 * floor((sliding_window + 1) / 2) - 1)
+                    "sorted_window": sw.SortedWindow(2 * math.floor((config["property_sliding_window"][variable] + 1) / 2) - 1),
+                    # Sorted index of the whole history (IQR failsafe)
+                    "iqr_index": sw.SortedWindow(query_points),
                     "date_updated" : aux_func.get_datetime_now()
                 }
 
                 # Anomaly control
-                if variable in anomaly_status[station_id]:
-                    pass
-                else:
-                    anomaly_status[station_id][variable] = {}
-                    anomaly_status[station_id][variable]["startDateOfOngoingAnomaly"] = None
-
-                # Populate dicts
-                if historic_data != None:
-                    aux_func.logMessage("--> Creating dataframes based on historical data (Hampel).")
+                anomaly_status[station_id].setdefault(variable, {"startDateOfOngoingAnomaly": None})
 
-                    hampel_filter_measurements["hampel_filter_" + str(short_id)][variable]["data"]["date"] = pd.to_datetime(historic_data["index"])
-                    hampel_filter_measurements["hampel_filter_" + str(short_id)][variable]["data"][variable] = next(e for e in historic_data["attributes"] if e["attrName"] == variable)["values"]
+                # Populate dicts (series already in memory are shared)
+                if (historic_data != None) or (created == False):
+                    if created:
+                        aux_func.logMessage("--> Creating sliding windows based on historical data (Hampel).")
+                        view.load(*sw.history_to_arrays(historic_data, variable))
 
                     # Get the number of available data samples
                     hampel_filter_measurements["hampel_filter_" + str(short_id)][variable]["num_data"] = len(hampel_filter_measurements["hampel_filter_" + str(short_id)][variable]["data"])
 
-                    aux_func.logMessage(hampel_filter_measurements["hampel_filter_" + str(short_id)][variable]["data"].head())
+                    aux_func.logMessage(f"Samples in memory ({variable}): {hampel_filter_measurements['hampel_filter_' + str(short_id)][variable]['num_data']}")
 
         aux_func.logMessage(f"---> Finished creating variables for urn = {station_id}")
 
@@ -0,0 +1,163 @@
+################################################################################### Imports
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+###################################################################################
+
+# Metrics of the DataQA module, rendered in the Prometheus text exposition format (see the /metrics endpoint)
+
+# Default histogram buckets (seconds), from 50 microseconds to 10 seconds
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Every metric created, in order of creation
+registry = []
+
+def _labels_text(labels, extra = ()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{str(value)}"' for name, value in items) + "}"
+
+def _value_text(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    '''
+    Base class, holds one value per combination of labels
+    '''
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def render(self, extra_labels = ()):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines += self._render_value(labels + tuple(extra_labels), value)
+        return lines
+
+    def _render_value(self, labels, value):
+        return [f"{self.name}{_labels_text(labels)} {_value_text(value)}"]
+
+class Counter(Metric):
+    '''
+    Monotonic counter
+    '''
+    kind = "counter"
+
+    def inc(self, amount = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    '''
+    Value that can go up and down (set when the metrics are collected)
+    '''
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(Metric):
+    '''
+    Distribution of durations (seconds) in cumulative buckets
+    '''
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets = DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            state = self._values[key]
+            state["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            state["sum"] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        '''
+        Observe the duration of the block
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, labels, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), state["counts"]):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_labels_text(labels, [('le', _value_text(bound))])} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels_text(labels)} {_value_text(state['sum'])}")
+        lines.append(f"{self.name}_count{_labels_text(labels)} {cumulative}")
+        return lines
+
+def render(**labels):
+    '''
+    Return every metric in the text exposition format, labels are added to every sample
+    '''
+    lines = []
+    for metric in registry:
+        lines += metric.render(tuple(sorted(labels.items())))
+    return "\n".join(lines) + "\n"
+
+def merge(texts):
+    '''
+    Merge the metrics rendered by several processes (samples of a metric are grouped under a single HELP / TYPE header)
+    '''
+    families = {}
+    name = None
+
+    for text in texts:
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                name = line.split()[2]
+                family = families.setdefault(name, {"header": [], "samples": []})
+                if line not in family["header"]:
+                    family["header"].append(line)
+            elif line and (name is not None):
+                families[name]["samples"].append(line)
+
+    return "".join("\n".join(family["header"] + family["samples"]) + "\n" for family in families.values())
+
+############### Metrics of the DataQA module ###############
+
+HISTORY_FETCH_SECONDS = Histogram("dataqa_history_fetch_seconds", "Time to create the in-memory windows of a station (create_history, including the historical query).")
+WINDOW_UPDATE_SECONDS = Histogram("dataqa_window_update_seconds", "Time to update the in-memory windows with a sample (manage_sliding_window_dataframe).")
+DETECTOR_SECONDS = Histogram("dataqa_detector_seconds", "Time to score the samples of a round (one call of the detector of an algorithm, every property).")
+UPSERT_SECONDS = Histogram("dataqa_upsert_seconds", "Time of an upsert request to the context broker.")
+INGEST_WAIT_SECONDS = Histogram("dataqa_ingest_wait_seconds", "Time a notification waits in the ingestion queue, from its acknowledgement to the start of its analysis.")
+
+READINGS = Counter("dataqa_readings_total", "Readings analysed.")
+REJECTED_READINGS = Counter("dataqa_rejected_readings_total", "Readings ignored because none of their analysed properties has an observedAt.")
+OUTLIERS = Counter("dataqa_outliers_total", "Samples flagged as outliers.")
+WINDOW_RESETS = Counter("dataqa_window_resets_total", "Resets of the in-memory windows after a gap in the received data.")
+UPSERTED_ENTITIES = Counter("dataqa_upserted_entities_total", "Entities (corrected readings and anomalies) sent to the context broker, by status (sent, failed, rejected).")
+CADENCY_ANOMALIES = Counter("dataqa_cadency_anomalies_total", "Anomalies produced for stations without data for more than data_cadency_anomaly_threshold.")
+INGEST_FAILED = Counter("dataqa_ingest_failed_notifications_total", "Notifications acknowledged (asynchronous ingestion) whose analysis failed, they are not retried.")
+BACKFILL_SAMPLES = Counter("dataqa_backfill_samples_total", "Samples analysed by the backfill jobs (corrected readings sent), per algorithm.")
+INGEST_SHED = Counter("dataqa_ingest_shed_notifications_total", "Notifications (or shards of a notification) discarded because the ingestion queue was full, by reason (rejected, dropped).")
+
+TRACKED_STATIONS = Gauge("dataqa_tracked_stations", "Stations with in-memory windows.")
+RETAINED_POINTS = Gauge("dataqa_retained_points", "Samples held in the in-memory windows.")
+UPSERT_QUEUE = Gauge("dataqa_upsert_queue_entities", "Entities waiting in the upsert queue.")
+INGEST_QUEUE = Gauge("dataqa_ingest_queue_notifications", "Notifications acknowledged and waiting to be analysed.")
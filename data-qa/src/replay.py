@@ -0,0 +1,214 @@
+################################################################################### Imports
+import argparse
+import collections
+import contextlib
+import json
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+import context_broker_client_utils as aquaspice_utils
+import auxiliar_functions as aux_func
+import streaming_analysis
+
+###################################################################################
+
+# Offline replay of recorded data through process_reading (no context broker nor QuantumLeap).
+# Reads NGSI-LD notifications ({"subscriptionId", "data"}) and/or QuantumLeap exports ({"entityId", "entityType", "index", "attributes"}),
+# given as JSON documents, lists of documents or JSON lines, and reports the throughput, the latency per algorithm and the anomalies found.
+#
+# Usage: python replay.py "<config files>" <input files> [--output summary.json] [--anomalies anomalies.jsonl] [--corrected corrected.jsonl]
+
+def read_documents(path):
+    '''
+    Return the JSON documents of a file (a single document, a list of documents or JSON lines)
+    '''
+    with open(path, "r") as f:
+        content = f.read()
+
+    try:
+        documents = json.loads(content)
+    except ValueError:
+        documents = [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    return documents if isinstance(documents, list) else [documents]
+
+def quantumleap_readings(document, analysis_list):
+    '''
+    Convert a QuantumLeap export of one entity into notification readings, for every analysis of its entityType
+    Timestamps missing one of the analyzed properties are skipped. Returns a list of (epoch, subscription_id, reading) and the skipped count
+    '''
+    station_id = document.get("entityId", document.get("id"))
+    entityType = document.get("entityType", document.get("type"))
+    attributes = {attribute["attrName"]: attribute["values"] for attribute in document["attributes"]}
+
+    timestamps = pd.to_datetime(document["index"], utc = True)
+    epochs = timestamps.asi8 // 10**6
+    observedAt = timestamps.strftime("%Y-%m-%dT%H:%M:%S.%f").str[:-3] + "Z"
+
+    readings = []
+    skipped = 0
+
+    for analysis in analysis_list:
+        if analysis["entityType"] != entityType:
+            continue
+
+        properties = [x for x in analysis["analyzedProperties"] if x != "location"]
+        if any(x not in attributes for x in properties):
+            skipped += len(epochs)
+            continue
+
+        for i in range(len(epochs)):
+            if any(attributes[x][i] is None for x in properties):
+                skipped += 1
+                continue
+
+            reading = {"id": station_id, "type": entityType}
+            for property_name in properties:
+                reading[property_name] = {"type": "Property", "value": attributes[property_name][i], "observedAt": observedAt[i]}
+
+            readings.append((int(epochs[i]), analysis["subscription_id"], reading))
+
+    return readings, skipped
+
+def load_readings(paths, analysis_list):
+    '''
+    Return the readings of the input files as (subscription_id, reading), ordered by observation date
+    (recorded notifications keep their order for equal dates), the skipped count and the rejected count (recorded readings
+    without observedAt, which cannot be ordered)
+    '''
+    readings = []
+    skipped = 0
+    rejected = 0
+
+    for path in paths:
+        for document in read_documents(path):
+            if "subscriptionId" in document:
+                for reading in document["data"]:
+                    observedAt = aux_func.return_observedAt(reading, [x for x in reading if isinstance(reading[x], dict)])
+
+                    if observedAt is None:
+                        rejected += 1
+                        continue
+
+                    readings.append((observedAt * 1000, document["subscriptionId"], reading))
+
+            elif "index" in document:
+                converted, skipped_document = quantumleap_readings(document, analysis_list)
+                readings += converted
+                skipped += skipped_document
+
+            else:
+                raise ValueError(f"Unknown document in {path} (expected a notification or a QuantumLeap export)")
+
+    readings.sort(key = lambda x: x[0])
+
+    return [(subscriptionId, reading) for epoch, subscriptionId, reading in readings], skipped, rejected
+
+def latency_summary(latencies):
+    '''
+    Percentiles (milliseconds) of the processing time of the readings
+    '''
+    latencies = np.asarray(latencies) * 1000
+    return {"count": len(latencies),
+            "mean": round(float(np.mean(latencies)), 4),
+            "p50": round(float(np.percentile(latencies, 50)), 4),
+            "p90": round(float(np.percentile(latencies, 90)), 4),
+            "p99": round(float(np.percentile(latencies, 99)), 4),
+            "max": round(float(np.max(latencies)), 4)}
+
+def replay(readings, anomalies_file = None, corrected_file = None):
+    '''
+    Push the readings through process_reading with in-memory sinks, histories start from 0 (no QuantumLeap query)
+    Returns the summary (throughput, latency per algorithm, anomalies)
+    '''
+    analysis_list = {analysis["subscription_id"]: analysis for analysis in aquaspice_utils.config["analysis"]}
+
+    latencies = collections.defaultdict(list)
+    anomalies = collections.Counter()
+    outliers = collections.defaultdict(collections.Counter)
+    corrected_readings = 0
+    unknown = 0
+
+    def produce_anomaly(*args):
+        anomalies[args[2]] += 1
+        if anomalies_file is not None:
+            anomalies_file.write(json.dumps(aux_func.build_anomaly(*args)) + "\n")
+
+    def produce_corrected_reading(**kwargs):
+        nonlocal corrected_readings
+        corrected_readings += 1
+
+        for property_name, is_outlier in kwargs["is_outlier"].items():
+            if (is_outlier == True) or (is_outlier == "Yes"):
+                outliers[kwargs["analysis"]["algorithm"]][property_name] += 1
+
+        if corrected_file is not None:
+            corrected_file.write(json.dumps(aux_func.build_corrected_reading(**kwargs)) + "\n")
+
+    start = time.perf_counter()
+
+    for subscriptionId, reading in readings:
+        analysis = analysis_list.get(subscriptionId)
+        if analysis is None:
+            unknown += 1
+            continue
+
+        # Windows filled with the replayed data only
+        streaming_analysis.create_history(reading["id"], analysis, start_from_0 = True)
+
+        reading_start = time.perf_counter()
+        streaming_analysis.process_reading(reading, subscriptionId, produce_anomaly, produce_corrected_reading)
+        latencies[analysis["algorithm"]].append(time.perf_counter() - reading_start)
+
+    elapsed = time.perf_counter() - start
+
+    processed = sum(len(x) for x in latencies.values())
+
+    return {"readings": processed,
+            "unknown_subscription": unknown,
+            "elapsed_seconds": round(elapsed, 3),
+            "readings_per_second": round(processed / elapsed, 1) if elapsed > 0 else None,
+            "latency_ms": {algorithm: latency_summary(x) for algorithm, x in latencies.items()},
+            "corrected_readings": corrected_readings,
+            "outliers": {algorithm: dict(x) for algorithm, x in outliers.items()},
+            "anomalies": dict(anomalies)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Replay recorded notifications or QuantumLeap exports through the DataQA analysis (offline)")
+    parser.add_argument("config_file", help = "the config file path[s] (separated by ';')")
+    parser.add_argument("inputs", nargs = "+", help = "recorded notifications or QuantumLeap exports (JSON or JSON lines)")
+    parser.add_argument("--output", help = "write the summary to this file (default: stdout)")
+    parser.add_argument("--anomalies", help = "write the anomalies found to this file (JSON lines)")
+    parser.add_argument("--corrected", help = "write the corrected readings to this file (JSON lines)")
+    parser.add_argument("--verbose", action = "store_true", help = "keep the log of the analysis (written to stderr)")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        # The log is discarded unless verbose (levels of the config files)
+        log_sink = sys.stderr if args.verbose else stack.enter_context(open(os.devnull, "w"))
+
+        aux_func.setup_logging({}, sink = log_sink)
+        aquaspice_utils.load_config(args.config_file)
+        aux_func.setup_logging(aquaspice_utils.config, sink = log_sink)
+
+        readings, skipped, rejected = load_readings(args.inputs, aquaspice_utils.config["analysis"])
+
+        anomalies_file = stack.enter_context(open(args.anomalies, "w")) if args.anomalies else None
+        corrected_file = stack.enter_context(open(args.corrected, "w")) if args.corrected else None
+
+        summary = replay(readings, anomalies_file, corrected_file)
+
+        # Queued log messages are written, and the sink released, before it is closed
+        aux_func.logger.remove()
+
+    summary["skipped_readings"] = skipped
+    summary["rejected_readings"] = rejected
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent = 4)
+    else:
+        print(json.dumps(summary, indent = 4))
@@ -0,0 +1,260 @@
+################################################################################### Imports
+import argparse
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import flask
+from waitress import serve
+
+import context_broker_client_utils as aquaspice_utils
+import auxiliar_functions as aux_func
+import backfill
+import metrics
+
+###################################################################################
+
+# Production serving mode: a router process (waitress) receives the notifications and forwards each reading to the
+# worker process owning its station (consistent hashing on the entity id), so the windows of a station are never split
+# across processes. Each worker runs the analysis of streaming_analysis on its own state, sends its own upserts and writes
+# its own snapshot (snapshot_dir/worker_<i>). On startup, workers restore their stations from every snapshot found,
+# so the number of workers can change between runs without losing state.
+#
+# Usage: python server.py "<config files>" [--workers N] [--port P] [--threads T]
+
+app = flask.Flask(__name__)
+
+# Backfill jobs, run by the router (/backfill endpoints)
+app.register_blueprint(backfill.blueprint)
+
+# Time (seconds) to wait for the answer of a worker to a control request (metrics)
+CONTROL_TIMEOUT = 5
+
+# Hash ring of the router, and the worker processes (process, inbox queue, control pipe, ready event)
+ring = None
+workers = []
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class HashRing:
+    '''
+    Consistent hashing of station ids to workers (virtual nodes). The owner of a station only depends on its id and the
+    number of workers (stable across processes and restarts), and changing the number of workers moves few stations
+    '''
+
+    def __init__(self, num_workers, replicas = 100):
+        points = sorted((_hash(f"worker-{worker}-{replica}"), worker) for worker in range(num_workers) for replica in range(replicas))
+        self._points = [point for point, worker in points]
+        self._workers = [worker for point, worker in points]
+
+    def owner(self, station_id):
+        '''
+        Return the index of the worker owning a station
+        '''
+        return self._workers[bisect.bisect(self._points, _hash(station_id)) % len(self._points)]
+
+############### Router ###############
+
+@app.route("/", methods=["POST"])
+def callback():
+    '''
+    Callback function, forwards the readings of the notification to the workers owning their stations
+    '''
+    notification = flask.request.get_json(silent = True)
+
+    error = aux_func.notification_error(notification)
+    if error is not None:
+        aux_func.logMessage(f"---X Malformed notification rejected: {error}", kind = "error")
+        return flask.jsonify(isError=True, message=f"Malformed notification: {error}", statusCode=400), 400
+
+    shards = {}
+
+    # Readings of a station keep their order (same worker, FIFO queue)
+    for reading in notification["data"]:
+        shards.setdefault(ring.owner(reading["id"]), []).append(reading)
+
+    # Rejected (503) only if no shard was queued, otherwise the broker would send the queued readings again
+    if not aux_func.enqueue_shards(notification["subscriptionId"], [(workers[worker]["inbox"], readings, {"worker": worker}) for worker, readings in shards.items()]):
+        return flask.jsonify(isError=True, message="Busy", statusCode=503), 503
+
+    return flask.jsonify(isError=False, message="Success", statusCode=200), 200
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    '''
+    Readiness probe, 503 until every worker has loaded its histories (or if a worker died)
+    '''
+    status = [worker["ready"].is_set() and worker["process"].is_alive() for worker in workers]
+    return flask.jsonify(ready=all(status), workers=status), 200 if all(status) else 503
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    '''
+    Metrics of every worker (label "worker") in the Prometheus text exposition format
+    '''
+    for index, worker in enumerate(workers):
+        try:
+            metrics.INGEST_QUEUE.set(worker["inbox"].qsize(), worker = index)
+        except NotImplementedError:
+            pass
+
+    # Metrics of the router (queues of the workers, shed notifications), then those of every worker
+    texts = [metrics.render()]
+
+    for worker in workers:
+        with worker["control_lock"]:
+            try:
+                worker["control"].send("metrics")
+                if worker["control"].poll(CONTROL_TIMEOUT):
+                    texts.append(worker["control"].recv())
+            except (OSError, EOFError):
+                pass
+
+    return flask.Response(metrics.merge(texts), mimetype = "text/plain; version=0.0.4")
+
+def start_workers(num_workers, config_file):
+    '''
+    Start the worker processes (spawned, each one imports its own copy of the analysis modules)
+    '''
+    global ring
+
+    ring = HashRing(num_workers)
+    context = multiprocessing.get_context("spawn")
+
+    for index in range(num_workers):
+        inbox = context.Queue(maxsize = aquaspice_utils.config.get("ingest_queue_size", 1000))
+        control, worker_control = context.Pipe()
+        ready_event = context.Event()
+
+        process = context.Process(target = worker_main, name = f"dataqa_worker_{index}",
+                                  args = (index, num_workers, config_file, inbox, worker_control, ready_event))
+        process.start()
+
+        workers.append({"process": process, "inbox": inbox, "control": control, "control_lock": threading.Lock(), "ready": ready_event})
+
+    aux_func.logMessage(f"--> Started {num_workers} workers")
+
+def stop_workers(timeout = 60):
+    '''
+    Ask the workers to finish the queued notifications, write their snapshot and send their upserts
+    '''
+    for worker in workers:
+        try:
+            worker["inbox"].put(None, timeout = timeout)
+        except queue.Full:
+            pass
+
+    for index, worker in enumerate(workers):
+        worker["process"].join(timeout)
+        if worker["process"].is_alive():
+            aux_func.logMessage(f"---X Worker {index} did not stop, terminated", kind = "error")
+            worker["process"].terminate()
+
+############### Workers ###############
+
+def worker_main(index, num_workers, config_file, inbox, control, ready_event):
+    '''
+    Worker process: analyses the readings of the stations it owns
+    '''
+    # Interruptions are handled by the router (stop_workers)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import streaming_analysis
+    import snapshot as snap
+
+    # Default configuration until the config files are loaded
+    aux_func.setup_logging({})
+    aquaspice_utils.init(config_file)
+    aux_func.setup_logging(aquaspice_utils.config)
+    aux_func.logMessage(f"--> Worker {index} started (pid {os.getpid()})")
+
+    worker_ring = HashRing(num_workers)
+    owns = lambda station_id: worker_ring.owner(station_id) == index
+
+    aquaspice_utils.start_upsert_sender()
+    streaming_analysis.analysis_plan()
+
+    # Restore the owned stations from the snapshots of every worker of previous runs (newest first)
+    snapshot_dir = aquaspice_utils.config.get("snapshot_dir")
+    if snapshot_dir:
+        restored = set()
+        for directory in snap.snapshot_directories(snapshot_dir):
+            restored |= streaming_analysis.restore_snapshot(lambda station_id: owns(station_id) and (station_id not in restored), directory)
+
+        aquaspice_utils.config["snapshot_dir"] = os.path.join(snapshot_dir, f"worker_{index}")
+
+    streaming_analysis.prewarm_histories(owns)
+    streaming_analysis.schedule_snapshots()
+    streaming_analysis.schedule_cadency_monitoring()
+
+    threading.Thread(target = _control_loop, args = (index, control), name = "control", daemon = True).start()
+    ready_event.set()
+
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+
+        streaming_analysis.process_queued_notification(item)
+
+    # The process exits without atexit handlers (multiprocessing)
+    streaming_analysis.save_snapshot()
+    aquaspice_utils.stop_upsert_sender()
+    aux_func.logMessage(f"--> Worker {index} stopped")
+    aux_func.logger.complete()
+
+def _control_loop(index, control):
+    '''
+    Answer the requests of the router (metrics), independently of the queued notifications
+    '''
+    import streaming_analysis
+
+    while True:
+        try:
+            request = control.recv()
+        except (EOFError, OSError):
+            return
+
+        if request == "metrics":
+            control.send(streaming_analysis.collect_metrics(worker = index))
+
+if __name__ == "__main__":
+    '''
+    Main function, creates the subscriptions, starts the workers and serves the notifications
+    '''
+    parser = argparse.ArgumentParser(description = "DataQA production server (router and worker processes)")
+    parser.add_argument("config_file", help = "the config file path[s] (separated by ';')")
+    parser.add_argument("--workers", type = int, help = "number of worker processes (default: server_workers)")
+    parser.add_argument("--port", type = int, help = "port of the callback (default: server_port)")
+    parser.add_argument("--threads", type = int, help = "threads of the router (default: server_threads)")
+    args = parser.parse_args()
+
+    # Default configuration until the config files are loaded
+    aux_func.setup_logging({})
+    aquaspice_utils.init(args.config_file)
+    aux_func.setup_logging(aquaspice_utils.config)
+
+    # Create subscriptions (once, by the router)
+    aux_func.logMessage("--> Subscribing to defined topics (json file)...")
+    for analysis in aquaspice_utils.config["analysis"]:
+        aquaspice_utils.create_subscription(analysis)
+
+    start_workers(args.workers or aquaspice_utils.config.get("server_workers", 2), args.config_file)
+
+    # Backfill jobs interrupted by the last shutdown
+    backfill.resume_jobs()
+
+    # SIGTERM exits normally, so the workers are stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        serve(app, host = "0.0.0.0",
+              port = args.port or aquaspice_utils.config.get("server_port", 5000),
+              threads = args.threads or aquaspice_utils.config.get("server_threads", 8))
+    finally:
+        stop_workers()
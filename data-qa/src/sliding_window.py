@@ -0,0 +1,488 @@
+################################################################################### Imports
+import bisect
+import math
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Spare slots of the shared series: an analysis lagging up to this number of samples behind the others still reads whole windows
+SHARED_SPARE_SLOTS = 8
+
+# Samples per block of windows evaluated at once by trailing_apply (bounds the memory of the copies)
+WINDOW_BLOCK = 1 << 20
+
+class RingBuffer:
+    '''
+    Fixed-capacity ring buffer holding the in-memory series of one (station, property).
+    Values and epoch timestamps (milliseconds) live in preallocated arrays. Every sample is written twice
+    (slot i and slot i + slots) so the last N samples are always a contiguous view, without copies.
+    '''
+
+    def __init__(self, capacity, spare = 1):
+        self.capacity = int(capacity)
+        # Spare slots keep the last evicted samples readable (see WindowTracker and SeriesView)
+        self.slots = self.capacity + int(spare)
+        self._values = np.full(2 * self.slots, np.nan, dtype = np.float64)
+        self._dates = np.zeros(2 * self.slots, dtype = np.int64)
+        # Incremented whenever the content is rewritten (reset, load, late sample), so derived statistics know they must be rebuilt
+        self.generation = 0
+        self.reset()
+        # Newest timestamp of the loaded history (views created later start there, see SeriesView)
+        self.history_date = None
+
+    def __len__(self):
+        return self.count
+
+    def reset(self):
+        '''
+        Empty the buffer (arrays are kept allocated)
+        '''
+        # Number of samples currently held
+        self.count = 0
+        # Number of samples appended since the last reset (logical index of the next sample)
+        self.total = 0
+        self.generation += 1
+        self.history_date = None
+
+    def newest_date(self):
+        '''
+        Return the timestamp of the newest sample (None if empty)
+        '''
+        if self.count == 0:
+            return None
+        return int(self._dates[(self.total - 1) % self.slots])
+
+    def oldest_index(self):
+        '''
+        Return the logical index of the oldest sample still readable with `value_at` (including the last evicted one)
+        '''
+        return max(0, self.total - self.slots)
+
+    def value_at(self, index):
+        '''
+        Return the value of the sample with logical index `index` (oldest_index() <= index < total)
+        '''
+        return self._values[index % self.slots]
+
+    def append(self, value, date):
+        '''
+        Append a sample in O(1). Duplicated timestamps keep the first sample received.
+        Returns True if the sample was stored.
+        '''
+        newest_date = self.newest_date()
+
+        if newest_date is not None and date <= newest_date:
+            if date == newest_date:
+                return False
+            # Late sample, keep the series ordered (rare, slow path)
+            return self._insert(value, date)
+
+        position = self.total % self.slots
+        self._values[position] = value
+        self._values[position + self.slots] = value
+        self._dates[position] = date
+        self._dates[position + self.slots] = date
+
+        self.total += 1
+        if self.count < self.capacity:
+            self.count += 1
+
+        return True
+
+    def last(self, n = None):
+        '''
+        Return a read-only view over the values of the last n samples (all of them if n is None)
+        '''
+        return self._view(self._values, self.count if n is None else min(n, self.count))
+
+    def last_dates(self, n = None):
+        '''
+        Return a read-only view over the timestamps of the last n samples (all of them if n is None)
+        '''
+        return self._view(self._dates, self.count if n is None else min(n, self.count))
+
+    def export(self):
+        '''
+        Return a copy of the values and timestamps held (consistent even if a sample is appended meanwhile)
+        '''
+        total, count = self.total, self.count
+        end = total % self.slots + self.slots
+        return self._values[end - count:end].copy(), self._dates[end - count:end].copy()
+
+    def load(self, values, dates):
+        '''
+        Replace the content of the buffer with a whole series (e.g. historical data)
+        '''
+        values = np.asarray(values, dtype = np.float64)
+        dates = np.asarray(dates, dtype = np.int64)
+
+        # Sort and drop duplicated timestamps (keep first)
+        order = np.argsort(dates, kind = "stable")
+        dates, first = np.unique(dates[order], return_index = True)
+        values = values[order][first]
+
+        values = values[-self.capacity:]
+        dates = dates[-self.capacity:]
+        n = len(values)
+
+        self._values[:n] = values
+        self._values[self.slots:self.slots + n] = values
+        self._dates[:n] = dates
+        self._dates[self.slots:self.slots + n] = dates
+
+        self.count = n
+        self.total = n
+        self.generation += 1
+
+    def discard_before(self, date):
+        '''
+        Drop the samples older than `date` (empties the buffer if they all are)
+        '''
+        dates = self.last_dates()
+
+        if self.count == 0 or dates[0] >= date:
+            return
+
+        start = int(np.searchsorted(dates, date))
+        if start == self.count:
+            self.reset()
+        else:
+            self.load(self.last()[start:].copy(), dates[start:].copy())
+
+    def _view(self, array, n, total = None):
+        # n samples before the logical index `total` (readable: total - n >= oldest_index())
+        end = (self.total if total is None else total) % self.slots + self.slots
+        view = array[end - n:end]
+        view.setflags(write = False)
+        return view
+
+    def _insert(self, value, date):
+        dates = self.last_dates()
+        index = np.searchsorted(dates, date)
+
+        if index < self.count and dates[index] == date:
+            return False
+
+        self.load(np.insert(self.last(), index, value), np.insert(dates, index, date))
+        return True
+
+class SeriesView:
+    '''
+    Series of a RingBuffer shared by several analyses, as seen by one of them: the samples up to the newest one it appended
+    (`end_date`). An analysis receiving a reading already appended by another one is thus scored against the previous history.
+    Same reading interface as RingBuffer (used by the detectors and the WindowTrackers), and append / reset / load
+    act on the shared buffer.
+    '''
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.capacity = buffer.capacity
+        # Timestamp of the newest sample of the view (None: the view is empty). A view created over a series other
+        # analyses are already appending to starts at the end of its history
+        self.end_date = buffer.history_date
+        # Logical index following end_date, valid while the buffer content is not rewritten (generation)
+        self._end = (None, None, None)
+        # Incremented when the view jumps (reset, first sample), so its derived statistics are rebuilt
+        self._epoch = 0
+
+    def __len__(self):
+        if self.end_date is None:
+            return 0
+        return max(0, min(self.capacity, self.total - self.oldest_index()))
+
+    @property
+    def generation(self):
+        return (self.buffer.generation, self._epoch)
+
+    @property
+    def total(self):
+        '''
+        Logical index following the newest sample of the view
+        '''
+        buffer = self.buffer
+
+        if self.end_date is None:
+            return buffer.total
+
+        # Usual case, the view is up to date
+        newest_date = buffer.newest_date()
+        if (newest_date is None) or (self.end_date >= newest_date):
+            return buffer.total
+
+        generation, end_date, total = self._end
+        if (generation != buffer.generation) or (end_date != self.end_date):
+            # Timestamps of every readable sample (including the evicted ones still in the spare slots)
+            oldest = buffer.oldest_index()
+            total = oldest + int(np.searchsorted(buffer._view(buffer._dates, buffer.total - oldest), self.end_date, side = "right"))
+            self._end = (buffer.generation, self.end_date, total)
+
+        return total
+
+    def oldest_index(self):
+        return self.buffer.oldest_index()
+
+    def value_at(self, index):
+        return self.buffer.value_at(index)
+
+    def last(self, n = None):
+        '''
+        Return a read-only view over the values of the last n samples of the view (all of them if n is None)
+        '''
+        return self.buffer._view(self.buffer._values, len(self) if n is None else min(n, len(self)), self.total)
+
+    def last_dates(self, n = None):
+        '''
+        Return a read-only view over the timestamps of the last n samples of the view (all of them if n is None)
+        '''
+        return self.buffer._view(self.buffer._dates, len(self) if n is None else min(n, len(self)), self.total)
+
+    def export(self):
+        '''
+        Return a copy of the values and timestamps of the view
+        '''
+        return self.last().copy(), self.last_dates().copy()
+
+    def append(self, value, date):
+        '''
+        Append a sample to the shared buffer (no-op if another analysis already did) and move the view up to it
+        '''
+        stored = self.buffer.append(value, date)
+
+        # An empty view takes the whole series up to the sample (including what other analyses appended)
+        if self.end_date is None:
+            self._epoch += 1
+
+        if (self.end_date is None) or (date > self.end_date):
+            self.end_date = date
+
+        return stored
+
+    def reset(self, date = None):
+        '''
+        Forget the samples older than `date` (all of them if None), for every analysis sharing the buffer
+        '''
+        if date is None:
+            self.buffer.reset()
+        else:
+            self.buffer.discard_before(date)
+
+        self.end_date = None
+        self._epoch += 1
+
+    def load(self, values, dates):
+        '''
+        Replace the content of the shared buffer with a whole series (e.g. historical data), the view covers all of it
+        '''
+        self.buffer.load(values, dates)
+        self.end_date = self.buffer.history_date = self.buffer.newest_date()
+        self._epoch += 1
+
+def shared_series(store, station_id, variable, capacity):
+    '''
+    Return a SeriesView over the series of (station_id, variable) in `store` ({station_id: {variable: RingBuffer}}), created if missing,
+    and whether it was created (the history of a series is only loaded once, whatever the number of analyses reading it)
+    '''
+    series = store.setdefault(station_id, {})
+    created = variable not in series
+
+    if created:
+        series[variable] = RingBuffer(capacity, spare = SHARED_SPARE_SLOTS)
+
+    return SeriesView(series[variable]), created
+
+class WindowTracker:
+    '''
+    Base class for statistics following the last `window` samples of a RingBuffer.
+    `sync` consumes the samples appended since the previous call (calling `_add` for the sample entering the window
+    and `_remove` for the one evicted), and rebuilds from scratch when the buffer content was rewritten.
+    '''
+
+    def __init__(self, window, recompute_every = None):
+        self.window = int(window)
+        self.recompute_every = recompute_every
+        self._cursor = 0
+        self._generation = None
+        self._updates = 0
+
+    def sync(self, buffer):
+        '''
+        Consume the samples appended to `buffer` since the last call
+        '''
+        first_evicted = self._cursor - self.window
+
+        # Content rewritten, or the samples to evict are no longer in the buffer
+        if (self._generation != buffer.generation) or (first_evicted >= 0 and first_evicted < buffer.oldest_index()):
+            self.recompute(buffer)
+            return
+
+        for index in range(self._cursor, buffer.total):
+            if index - self.window >= 0:
+                self._remove(buffer.value_at(index - self.window))
+            self._add(buffer.value_at(index))
+
+        self._cursor = buffer.total
+        self._updates += 1
+
+        if (self.recompute_every is not None) and (self._updates >= self.recompute_every):
+            self.recompute(buffer)
+
+    def recompute(self, buffer):
+        '''
+        Exact computation over the current window
+        '''
+        self._rebuild(buffer.last(self.window))
+        self._cursor = buffer.total
+        self._generation = buffer.generation
+        self._updates = 0
+
+class RunningStats(WindowTracker):
+    '''
+    Mean and standard deviation (np.mean / np.std) of the last `window` samples of a RingBuffer.
+    Updated in O(1) (Welford) when a sample enters the window and when a sample is evicted,
+    and recomputed exactly every `recompute_every` updates to bound float drift.
+    '''
+
+    def __init__(self, window, recompute_every = 1000):
+        super().__init__(window, recompute_every)
+        self.count = 0
+        self.mean = np.nan
+        self._m2 = 0.0
+
+    @property
+    def std(self):
+        if self.count == 0:
+            return np.nan
+        return np.sqrt(max(self._m2, 0.0) / self.count)
+
+    def _rebuild(self, values):
+        self.count = len(values)
+        self.mean = np.mean(values) if self.count > 0 else np.nan
+        self._m2 = np.var(values) * self.count if self.count > 0 else 0.0
+
+    def _add(self, value):
+        self.count += 1
+        delta = value - self.mean if self.count > 1 else 0.0
+        self.mean = value if self.count == 1 else self.mean + delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    def _remove(self, value):
+        if self.count <= 1:
+            self.count = 0
+            self.mean = np.nan
+            self._m2 = 0.0
+            return
+
+        self.count -= 1
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self._m2 -= delta * (value - self.mean)
+
+class SortedWindow(WindowTracker):
+    '''
+    Sorted copy of the last `window` samples of a RingBuffer (order statistics index).
+    Insertions and evictions use binary search, order statistics are read in O(1).
+    '''
+
+    def __init__(self, window):
+        super().__init__(window)
+        self.values = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def _rebuild(self, values):
+        self.values = sorted(values.tolist())
+
+    def _add(self, value):
+        bisect.insort(self.values, float(value))
+
+    def _remove(self, value):
+        del self.values[bisect.bisect_left(self.values, float(value))]
+
+    def percentile(self, q):
+        '''
+        Return the q-th percentile in O(1), same result as np.percentile (linear interpolation)
+        '''
+        if len(self.values) == 0:
+            return np.nan
+
+        index = (q / 100) * (len(self.values) - 1)
+        previous = math.floor(index)
+        gamma = index - previous
+
+        low = self.values[previous]
+        high = self.values[min(previous + 1, len(self.values) - 1)]
+        diff = high - low
+
+        # Same interpolation as numpy (_lerp)
+        if gamma >= 0.5:
+            return high - diff * (1 - gamma)
+        return low + diff * gamma
+
+def kth_of_two(a, len_a, b, len_b, k):
+    '''
+    Return the k-th smallest value (0-based) of the merge of two ascending sequences, given as accessors, in O(log n)
+    '''
+    low, high = max(0, k + 1 - len_b), min(k + 1, len_a)
+
+    # Find how many of the k + 1 smallest values come from `a`
+    while low < high:
+        taken_a = (low + high) // 2
+        if a(taken_a) < b(k - taken_a):
+            low = taken_a + 1
+        else:
+            high = taken_a
+
+    taken_b = k + 1 - low
+    if low == 0:
+        return b(taken_b - 1)
+    if taken_b == 0:
+        return a(low - 1)
+    return max(a(low - 1), b(taken_b - 1))
+
+def trailing_apply(series, positions, size, function):
+    '''
+    Apply `function` to the `size` samples preceding each position of `series` (series[p - size:p], fewer at the start of the series).
+    function receives the windows as a 2-D array (one window per row) and the indices of their positions, and returns one result per row.
+    Full windows are taken in blocks from a sliding_window_view of the series (read-only), the shorter ones one by one
+    '''
+    series = np.asarray(series, dtype = np.float64)
+    positions = np.asarray(positions, dtype = np.int64)
+    blocks = []
+
+    full = np.flatnonzero(positions >= size)
+    if len(full) > 0:
+        windows = sliding_window_view(series, size)
+        rows = max(1, WINDOW_BLOCK // size)
+
+        for start in range(0, len(full), rows):
+            block = full[start:start + rows]
+            first, last = positions[block[0]] - size, positions[block[-1]] - size
+
+            # Consecutive positions (the usual case) read the windows without copying them
+            if last - first == len(block) - 1:
+                blocks.append((block, function(windows[first:last + 1], block)))
+            else:
+                blocks.append((block, function(windows[positions[block] - size], block)))
+
+    for i in np.flatnonzero(positions < size):
+        blocks.append(([i], function(series[None, :positions[i]], [i])))
+
+    if not blocks:
+        return np.asarray(function(np.empty((0, size)), np.empty(0, dtype = np.int64)))
+
+    result = np.empty((len(positions),) + np.shape(blocks[0][1])[1:])
+    for block, values in blocks:
+        result[block] = values
+
+    return result
+
+def history_to_arrays(historic_data, variable):
+    '''
+    Return the values and epoch timestamps (ms) of a property from a historical query (see query_historical_data_paginated)
+    '''
+    values = historic_data["values"].get(variable, np.full(len(historic_data["dates"]), np.nan))
+
+    # Drop missing samples (null values)
+    available = ~np.isnan(values)
+
+    return values[available], historic_data["dates"][available]
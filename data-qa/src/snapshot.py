@@ -0,0 +1,107 @@
+################################################################################### Imports
+import glob
+import json
+import os
+import time
+import numpy as np
+
+import auxiliar_functions as aux_func
+
+###################################################################################
+
+# Format of the snapshot (increase when the layout changes, older snapshots are then ignored)
+SNAPSHOT_VERSION = 3
+
+INDEX_FILE = "index.json"
+
+def write_snapshot(directory, series, index):
+    '''
+    Write a snapshot of the in-memory series to `directory`.
+    `series` is a list of (values, dates) arrays, concatenated in two .npy files (memory-mappable), and `index` a JSON-serialisable
+    dict describing them (entries refer to the series with offset/length). The index is replaced last, so an interrupted
+    write never leaves a partial snapshot.
+    '''
+    os.makedirs(directory, exist_ok = True)
+
+    stamp = str(time.time_ns())
+    values_file = f"values_{stamp}.npy"
+    dates_file = f"dates_{stamp}.npy"
+
+    if len(series) > 0:
+        values = np.concatenate([s[0] for s in series]).astype(np.float64)
+        dates = np.concatenate([s[1] for s in series]).astype(np.int64)
+    else:
+        values = np.empty(0, dtype = np.float64)
+        dates = np.empty(0, dtype = np.int64)
+
+    np.save(os.path.join(directory, values_file), values)
+    np.save(os.path.join(directory, dates_file), dates)
+
+    index = dict(index, version = SNAPSHOT_VERSION, created = time.time(), values = values_file, dates = dates_file)
+
+    with open(os.path.join(directory, INDEX_FILE + ".tmp"), "w") as f:
+        json.dump(index, f)
+    os.replace(os.path.join(directory, INDEX_FILE + ".tmp"), os.path.join(directory, INDEX_FILE))
+
+    # Remove the arrays of previous snapshots
+    for path in glob.glob(os.path.join(directory, "values_*.npy")) + glob.glob(os.path.join(directory, "dates_*.npy")):
+        if os.path.basename(path) not in (values_file, dates_file):
+            os.remove(path)
+
+    return index
+
+def read_snapshot(directory, max_age, settings):
+    '''
+    Return the index and the (memory-mapped) values and dates of the snapshot in `directory`.
+    Returns None if there is no snapshot, if it is older than `max_age` seconds or if it was taken with different `settings`
+    '''
+    try:
+        with open(os.path.join(directory, INDEX_FILE), "r") as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        aux_func.logMessage(f"--> No snapshot found in {directory}")
+        return None
+    except ValueError as e:
+        aux_func.logMessage(f"---X Unreadable snapshot index, ignored: {e}", kind = "error")
+        return None
+
+    age = time.time() - index.get("created", 0)
+
+    if index.get("version") != SNAPSHOT_VERSION:
+        aux_func.logMessage(f"--> Snapshot ignored (version {index.get('version')}, expected {SNAPSHOT_VERSION})")
+        return None
+
+    if age > max_age:
+        aux_func.logMessage(f"--> Snapshot ignored, too old ({int(age)} s > {max_age} s)")
+        return None
+
+    if index.get("settings") != settings:
+        aux_func.logMessage("--> Snapshot ignored, taken with different settings")
+        return None
+
+    try:
+        values = np.load(os.path.join(directory, index["values"]), mmap_mode = "r")
+        dates = np.load(os.path.join(directory, index["dates"]), mmap_mode = "r")
+    except (OSError, ValueError) as e:
+        aux_func.logMessage(f"---X Unreadable snapshot arrays, ignored: {e}", kind = "error")
+        return None
+
+    aux_func.logMessage(f"--> Snapshot found ({len(index['entries'])} entries, {len(values)} samples, {int(age)} s old)")
+
+    return index, values, dates
+
+def snapshot_directories(directory):
+    '''
+    Return `directory` and its subdirectories (snapshots of each worker, see server.py) holding a snapshot, newest first
+    '''
+    candidates = [directory] + sorted(glob.glob(os.path.join(directory, "*", "")))
+    snapshots = []
+
+    for candidate in candidates:
+        try:
+            with open(os.path.join(candidate, INDEX_FILE), "r") as f:
+                snapshots.append((json.load(f).get("created", 0), os.path.normpath(candidate)))
+        except (OSError, ValueError):
+            pass
+
+    return [candidate for created, candidate in sorted(snapshots, reverse = True)]
@@ -1,16 +1,24 @@
 ################################################################################### Imports
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import atexit
+import contextlib
 import flask
-import pandas as pd
+import queue
+import signal
+import sys
+import threading
+import time
 import warnings
-import numpy as np
+import zlib
 from flask_apscheduler import APScheduler
 
 import context_broker_client_utils as aquaspice_utils
-import hampel_functions as hampel_func
-import z_score_functions as zscore_func
-import watercps_functions as wcps_func
 import auxiliar_functions as aux_func
+import backfill
+import cadency_monitor
+import detectors
+import metrics
+import snapshot as snap
 
 ###################################################################################
 
@@ -18,6 +26,9 @@ warnings.filterwarnings(action = "ignore")
 
 app = flask.Flask(__name__)
 
+# Backfill jobs (/backfill endpoints)
+app.register_blueprint(backfill.blueprint)
+
 # Dict to hold metrics in memory (for Z-score)
 entities_data = {}
 
@@ -27,16 +38,45 @@ hampel_filter_measurements = {}
 # Dict to hold in memory data of the watercps thresholds
 watercps_measurements = {}
 
-# Variable to hold and control the last date of received data.
+# In-memory dict of each algorithm (algorithms added to the detector registry get an empty one, see algorithm_measurements)
+algorithm_state = {"z_score": entities_data, "hampel_filter": hampel_filter_measurements, "watercps_threshold": watercps_measurements}
+
+# Analysis plan compiled for the loaded configuration (config, {subscription_id: detector}), see analysis_plan
+plan = (None, {})
+
+# Series of every (station, property), shared by the analyses reading it ({station_id: {property: RingBuffer}}).
+# The dicts of the algorithms hold views over them (sliding_window.SeriesView) and their own derived statistics
+station_series = {}
+
+# Variable to hold and control the last date of received data (epoch seconds of the reception, and of the observation per subscription).
 last_date_received = {}
 last_observedAt_received = {key: {} for key in ["urn:ngsi-ld:Subscription:hampel_anomaly_detection_1", "urn:ngsi-ld:Subscription:z_score_detection_1","urn:ngsi-ld:Subscription:watercps_detection_1"]}
 
 # Variable to hold anomaly status
 anomaly_status = {}
 
-# Indicates wheter or not the dataframes on memory should be printed (for debug)
+# Deadlines of the missing-data (cadency) anomalies, see cadency_monitoring
+cadency = cadency_monitor.CadencyMonitor()
+
+# Anomaly type of the cadency anomalies
+CADENCY_ANOMALY_TYPE = "_anomaly_cadency"
+
+# Indicates whether the histories of the configured stations are loaded (see prewarm_histories)
+history_ready = False
+
+# Serialises the snapshots (periodic and on shutdown)
+snapshot_lock = threading.Lock()
+
+# Locks of the in-memory state of each station (see station_lock)
+station_locks = {}
+station_locks_guard = threading.Lock()
+
+# Notifications acknowledged and waiting to be analysed by the ingestion consumers, one queue per consumer (see start_ingestion)
+ingest_queues = []
+ingest_consumers = []
+
+# Indicates wheter or not the sliding windows on memory should be printed (for debug)
 print_debug = False
-produce_corrected_reading_debug = True
 
 ############################### Scheduler #########################################
 # set configuration values
@@ -53,134 +93,280 @@ def callback():
     '''
     Callback function
     '''
-    aux_func.logMessage("--> Callback function called.")
+    aux_func.logMessage("--> Callback function called.", kind = "debug")
     # For more info, see:
     # https://github.com/FIWARE/tutorials.LD-Subscriptions-Registrations
 
-    # print the incoming json
-    # print(json.dumps(flask.request.json, indent=4), flush=True)
+    notification = flask.request.get_json(silent = True)
+
+    error = aux_func.notification_error(notification)
+    if error is not None:
+        aux_func.logMessage(f"---X Malformed notification rejected: {error}", kind = "error")
+        return flask.jsonify(isError=True, message=f"Malformed notification: {error}", statusCode=400), 400
+
+    # Synchronous mode (async_ingestion disabled): analysed before the acknowledgement
+    if not ingest_queues:
+        handle_notification(notification["data"], notification["subscriptionId"])
+        return flask.jsonify(isError=False, message="Success", statusCode=200), 200
 
-    for reading in flask.request.json["data"]:
-        process_reading(reading, flask.request.json["subscriptionId"], aux_func._produce_anomaly, _produce_corrected_reading)
+    # Readings of a station always go to the same consumer (they keep their order)
+    shards = {}
+    for reading in notification["data"]:
+        shards.setdefault(zlib.crc32(reading["id"].encode()) % len(ingest_queues), []).append(reading)
+
+    # Rejected (503) only if no shard was queued, otherwise the broker would send the queued readings again
+    if not aux_func.enqueue_shards(notification["subscriptionId"], [(ingest_queues[consumer], readings, {}) for consumer, readings in shards.items()]):
+        return flask.jsonify(isError=True, message="Busy", statusCode=503), 503
 
     return flask.jsonify(isError=False, message="Success", statusCode=200), 200
 
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    '''
+    Metrics in the Prometheus text exposition format
+    '''
+    return flask.Response(collect_metrics(), mimetype = "text/plain; version=0.0.4")
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    '''
+    Readiness probe, 503 while the histories are being loaded
+    '''
+    if history_ready:
+        return flask.jsonify(ready=True), 200
+    return flask.jsonify(ready=False), 503
+
 ################################################ Main function
 
+def handle_notification(readings, subscriptionId):
+    '''
+    Analyze the readings of a notification, and queue the corrected readings and anomalies (sent as combined upserts)
+    '''
+    # Collect the outputs of the whole notification
+    entities = []
+
+    def collect_anomaly(*args):
+        entities.append(aux_func.build_anomaly(*args))
+
+    def collect_corrected_reading(**kwargs):
+        entities.append(aux_func.build_corrected_reading(**kwargs))
+
+    process_batch(readings, subscriptionId, collect_anomaly, collect_corrected_reading)
+
+    # Sent by the background upsert sender (batched)
+    aquaspice_utils.enqueue_upsert(entities)
+
+def process_queued_notification(item):
+    '''
+    Analyse a notification taken from the ingestion queue (subscriptionId, readings, time of the acknowledgement)
+    '''
+    subscriptionId, readings, received_at = item
+
+    metrics.INGEST_WAIT_SECONDS.observe(max(0.0, time.time() - received_at))
+
+    try:
+        handle_notification(readings, subscriptionId)
+    except Exception as e:
+        # Already acknowledged, the broker does not send it again
+        metrics.INGEST_FAILED.inc()
+        aux_func.logMessage(f"---X Failed to process a notification of {subscriptionId}: {e}", kind = "error")
+
+def start_ingestion():
+    '''
+    Start the consumers analysing the queued notifications: the callback only validates, queues and acknowledges them.
+    Stations are split among `ingest_workers` consumers (threads), each one analyses its notifications in order of arrival,
+    so the readings of a station keep their order while different stations are analysed concurrently
+    '''
+    for index in range(aquaspice_utils.config.get("ingest_workers", 1)):
+        ingest_queues.append(queue.Queue(maxsize = aquaspice_utils.config.get("ingest_queue_size", 1000)))
+
+        consumer = threading.Thread(target = _ingestion_consumer, args = (ingest_queues[-1],), name = f"ingestion_{index}", daemon = True)
+        consumer.start()
+        ingest_consumers.append(consumer)
+
+    atexit.register(stop_ingestion)
+
+    aux_func.logMessage(f"--> {len(ingest_consumers)} ingestion consumers started (queue size: {ingest_queues[0].maxsize}, policy: {aquaspice_utils.config.get('ingest_shed_policy', 'reject')})")
+
+def stop_ingestion(timeout = 60):
+    '''
+    Analyse the queued notifications and stop the consumers (on shutdown)
+    '''
+    for work_queue in ingest_queues:
+        try:
+            work_queue.put(None, timeout = timeout)
+        except queue.Full:
+            pass
+
+    for consumer in ingest_consumers:
+        consumer.join(timeout)
+
+def _ingestion_consumer(work_queue):
+    '''
+    Background loop: analyses the queued notifications until the stop request (None)
+    '''
+    while True:
+        item = work_queue.get()
+        if item is None:
+            return
+
+        process_queued_notification(item)
+
+def station_lock(station_id):
+    '''
+    Return the lock of a station. The in-memory state of a station (windows of every analysis, anomaly status, last received dates)
+    is only modified holding it, so different stations can be analysed concurrently (reentrant: create_history takes it again)
+    '''
+    lock = station_locks.get(station_id)
+
+    if lock is None:
+        with station_locks_guard:
+            lock = station_locks.setdefault(station_id, threading.RLock())
+
+    return lock
+
+@contextlib.contextmanager
+def hold_station_locks(station_ids):
+    '''
+    Hold the locks of several stations (taken in a fixed order, so concurrent rounds never deadlock)
+    '''
+    with contextlib.ExitStack() as stack:
+        for station_id in sorted(set(station_ids)):
+            stack.enter_context(station_lock(station_id))
+        yield
+
 def process_reading(reading, subscriptionId, produce_anomaly, produce_corrected_reading):
     """
     Main function to analyze incoming samples
     """
-    global entities_data, hampel_filter_measurements, watercps_measurements, last_date_received, last_observedAt_received, anomaly_status
+    process_batch([reading], subscriptionId, produce_anomaly, produce_corrected_reading)
 
-    analysis_list = aquaspice_utils.config["analysis"]
+def process_batch(readings, subscriptionId, produce_anomaly, produce_corrected_reading):
+    """
+    Analyze the incoming samples of a notification (all of them belong to the same subscription)
+    Samples are grouped by property and scored at once, samples of the same station are processed in order (one per round)
+    """
+    # Detector of the analysis (identified by the subscription id)
+    detector = analysis_plan().get(subscriptionId)
 
     # Check if the subscription is valid
-    if subscriptionId in [x["subscription_id"] for x in analysis_list]:
+    if detector is None:
+        aux_func.logMessage(f"---X Unknown subscription, the incoming package is ignored: {subscriptionId}", "error")
+        return
+
+    # Readings without observedAt are ignored (no gap check nor position in the series), one warning per notification
+    rejected = [reading for reading in readings if not aux_func.has_observedAt(reading, detector.analysis["analyzedProperties"])]
+
+    if rejected:
+        metrics.REJECTED_READINGS.inc(len(rejected), algorithm = detector.algorithm)
+        aux_func.logMessage(f"---X {len(rejected)} readings without observedAt ignored ({subscriptionId}): {[reading.get('id') for reading in rejected]}", kind = "warning")
+        readings = [reading for reading in readings if aux_func.has_observedAt(reading, detector.analysis["analyzedProperties"])]
+
+    # Split in rounds where each station appears at most once
+    rounds = []
+    station_round = {}
+
+    for reading in readings:
+        round_index = station_round.get(reading["id"], -1) + 1
+        if round_index == len(rounds):
+            rounds.append([])
+
+        rounds[round_index].append(reading)
+        station_round[reading["id"]] = round_index
+
+    for round_readings in rounds:
+        with hold_station_locks(reading["id"] for reading in round_readings):
+            _process_round(round_readings, subscriptionId, detector, produce_anomaly, produce_corrected_reading)
+
+def _process_round(readings, subscriptionId, detector, produce_anomaly, produce_corrected_reading):
+    """
+    Analyze samples of different stations (same analysis)
+    """
+    analysis = detector.analysis
+    need_reset_dicts = []
+    now = int(time.time())
+
+    # Subscriptions other than the predefined ones
+    last_observedAt_received.setdefault(subscriptionId, {})
+
+    for reading in readings:
         # Only calls after the first reading
-        need_reset_dicts = False
+        need_reset = False
+        observedAt = aux_func.return_observedAt(reading, analysis["analyzedProperties"])
 
         if reading["id"] in last_observedAt_received[subscriptionId]:
-            need_reset_dicts = aux_func.calculate_date_distance(last_observedAt_received,
-                                                                last_date_received,
-                                                                subscriptionId,
-                                                                reading["id"],
-                                                                aux_func.return_observedAt(reading))
+            need_reset = aux_func.calculate_date_distance(last_observedAt_received,
+                                                          last_date_received,
+                                                          subscriptionId,
+                                                          reading["id"],
+                                                          observedAt)
+        need_reset_dicts.append(need_reset)
+
+        if need_reset:
+            metrics.WINDOW_RESETS.inc(algorithm = detector.algorithm)
 
         # Updates the last time data was received (for each entityType)
-        last_date_received[reading["id"]] = aux_func.get_datetime_now()
-        last_observedAt_received[subscriptionId][reading["id"]] = aux_func.return_observedAt(reading)
+        last_date_received[reading["id"]] = now
+        last_observedAt_received[subscriptionId][reading["id"]] = observedAt
+        cadency.touch(reading["id"], analysis["entityType"], now)
 
-        # Get short id
-        short_id = reading["id"].split(":")[4]
+        aux_func.logMessage(f"\n ################ New reading received ################ subscription_id = {subscriptionId}", kind = "debug")
+        aux_func.logMessage(f"observedAt: {observedAt}\n", kind = "debug")
 
-        aux_func.logMessage(f"\n ################ New reading received ################ subscription_id = {subscriptionId}")
-        aux_func.logMessage(f"observedAt: {last_observedAt_received[subscriptionId][reading['id']]}\n")
+        # Trigger create history, but querying historic data instead of starting from 0
+        _create_station(detector, reading["id"], start_from_0 = False)
 
-        ################################################ Analysis block
+    metrics.READINGS.inc(len(readings), algorithm = detector.algorithm)
+
+    ################################################ Analysis block
+
+    station_ids = [reading["id"] for reading in readings]
+    stations = [detector.station(station_id) for station_id in station_ids]
+    property_correction = [{} for reading in readings]
+    is_outlier = [{} for reading in readings]
+    property_error_reason = [{} for reading in readings]
+
+    # Values and observation dates (epoch ms, parsed once) of each property
+    values = {property_name: [reading[property_name]["value"] for reading in readings] for property_name in detector.properties}
+    dates = {property_name: [aux_func.date_to_epoch(reading[property_name]["observedAt"]) for reading in readings] for property_name in detector.properties}
+
+    # Cycle through the defined properties
+    for property_name in detector.properties:
+        for i, reading in enumerate(readings):
+            aux_func.logMessage("----> Initiated analysis for entity: {}", "debug", lambda: reading["id"])
+            aux_func.logMessage("----> property_name: {} ({}), value: {}", "debug", lambda: property_name, lambda: detector.algorithm, lambda: reading[property_name]["value"])
+
+            property_correction[i][property_name] = {}
+            is_outlier[i][property_name] = "No"
+            property_error_reason[i][property_name] = "None"
+
+            # Reset dicts if needed (on the first execution, when there is no data in memory, the windows start with the sample,
+            # keeping the series other analyses may share)
+            if detector.first_execution(stations[i][property_name]) or need_reset_dicts[i]:
+                _update_window(detector, station_ids[i], property_name, stations[i][property_name],
+                               value = reading[property_name]["value"],
+                               date = dates[property_name][i],
+                               dict_reset = need_reset_dicts[i])
+
+    # Score the samples (every property of all the stations of the round, at once for the detectors supporting it)
+    detector_start = time.perf_counter()
+    scores = detector.score_all(station_ids, stations, values)
+    metrics.DETECTOR_SECONDS.observe(time.perf_counter() - detector_start, algorithm = detector.algorithm)
+
+    for property_name in detector.properties:
+        outliers, reasons = scores[property_name]
+
+        for i, reading in enumerate(readings):
+            is_outlier[i][property_name] = outliers[i]
+            property_error_reason[i][property_name] = reasons[i]
+
+            # If outlier
+            if (is_outlier[i][property_name] == True) or (is_outlier[i][property_name] == "Yes"):
+                metrics.OUTLIERS.inc(algorithm = detector.algorithm, property = property_name)
 
-        # Get the analysis index (Identify analysis based on the subscription id)
-        analysis_index = [x["subscription_id"] == subscriptionId for x in analysis_list].index(True)
-        
-        # Trigger create history, but querying historic data instead of starting from 0
-        create_history(reading["id"], analysis_list[analysis_index], start_from_0 = False)
-
-        property_correction = {}
-        is_outlier = {}
-        property_error_reason = {}
-        
-        # Cycle through the defined properties
-        for property_name in analysis_list[analysis_index]["analyzedProperties"]:
-            aux_func.logMessage(f"----> Initiated analysis for entity: {reading['id']}")
-            aux_func.logMessage(f"----> property_name: {property_name} ({analysis_list[analysis_index]['algorithm']}), value: {reading[property_name]['value']}")
-            
-            property_correction[property_name] = {}
-            is_outlier[property_name] = "No"
-            property_error_reason[property_name] = "None"
-            
-            # To treat the first execution (when there is no data in memory in case of starting from 0)
-            if analysis_list[analysis_index]["algorithm"] == "z_score":
-                if entities_data["z_score_measurement_" + str(short_id)][property_name]["mean"] is None:
-                    manage_sliding_window_dataframe(station_id = reading["id"],
-                                                    property_name = property_name,
-                                                    algorithm = analysis_list[analysis_index]['algorithm'],
-                                                    value = reading[property_name]["value"],
-                                                    date = reading[property_name]["observedAt"],
-                                                    dict_reset = True)
-
-            # To treat the first execution (when there is no data in memory in case of starting from 0)
-            if analysis_list[analysis_index]["algorithm"] == "watercps_threshold":
-                if watercps_measurements["watercps_" + str(short_id)][property_name]["num_data"] is None:
-                    manage_sliding_window_dataframe(station_id = reading["id"],
-                                                    property_name = property_name,
-                                                    algorithm = analysis_list[analysis_index]['algorithm'],
-                                                    value = reading[property_name]["value"],
-                                                    date = reading[property_name]["observedAt"],
-                                                    dict_reset = True)
-
-            # To treat the first execution (when there is no data in memory in case of starting from 0)
-            if analysis_list[analysis_index]["algorithm"] == "hampel_filter":
-                if hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["num_data"] is None:
-                    manage_sliding_window_dataframe(station_id = reading["id"],
-                                                    property_name = property_name,
-                                                    algorithm = analysis_list[analysis_index]['algorithm'],
-                                                    value = reading[property_name]["value"],
-                                                    date = reading[property_name]["observedAt"],
-                                                    dict_reset = True)
-            
-            # Reset dicts if needed
-            if need_reset_dicts == True:
-                manage_sliding_window_dataframe(reading["id"], property_name, analysis_list[analysis_index]['algorithm'], reading[property_name]["value"], reading[property_name]["observedAt"], True)
-            
-            # Identify algorithms
-            if analysis_list[analysis_index]["algorithm"] == "z_score":
-                is_outlier[property_name] = zscore_func.outlier_function_z_score(config = aquaspice_utils.config,
-                                                                  station_id = reading["id"],
-                                                                  variable = property_name,
-                                                                  threshold = aquaspice_utils.config["z_score_threshold"],
-                                                                  data = reading[property_name]["value"],
-                                                                  entities_data = entities_data)
-
-            elif analysis_list[analysis_index]["algorithm"] == "hampel_filter":
-                is_outlier[property_name] = hampel_func.outlier_function_hampel_filter(config = aquaspice_utils.config,
-                                                                        station_id = reading["id"],
-                                                                        variable = property_name,
-                                                                        data = reading[property_name]["value"],
-                                                                        hampel_filter_measurements = hampel_filter_measurements)
-
-            elif analysis_list[analysis_index]["algorithm"] == "watercps_threshold":
-                is_outlier[property_name], property_error_reason[property_name] = wcps_func.outlier_function_watercps(config = aquaspice_utils.config["watercps_error_flagging"],
-                                                                         station_id = reading["id"],
-                                                                         variable = property_name,
-                                                                         data = reading[property_name]["value"],
-                                                                         watercps_measurements = watercps_measurements,
-                                                                         debug = False)
-
-            # If outlier    
-            if (is_outlier[property_name] == True) or (is_outlier[property_name] == "Yes"):
                 anomaly_start_date = None
                 current_reading_date = reading[property_name]["observedAt"]
-                
+
                 if anomaly_status[reading["id"]][property_name]["startDateOfOngoingAnomaly"]:
                     anomaly_start_date = anomaly_status[reading["id"]][property_name]["startDateOfOngoingAnomaly"]
                 else:
@@ -188,215 +374,345 @@ def process_reading(reading, subscriptionId, produce_anomaly, produce_corrected_
                     anomaly_status[reading["id"]][property_name]["startDateOfOngoingAnomaly"] = anomaly_start_date
 
                 produce_anomaly(
-                    reading["id"].split(":")[4]
+                    aux_func.short_id(reading["id"])
                     + "_"
                     + property_name,
-                    analysis_list[analysis_index]["entityType"],
-                    analysis_list[analysis_index]["anomalyTypeId"],
+                    analysis["entityType"],
+                    analysis["anomalyTypeId"],
                     anomaly_start_date,
                     current_reading_date,
                     "abnormal value in sensor: " + str(property_name),
                 )
-                
-                if analysis_list[analysis_index]["algorithm"] == "z_score":
-                    property_correction[property_name]["value"] = round(entities_data["z_score_measurement_" + str(short_id)][property_name]["mean"], 2)
-                    
-                elif analysis_list[analysis_index]["algorithm"] == "hampel_filter":
-                    property_correction[property_name]["value"] = round(np.mean(hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"][property_name].values[-aquaspice_utils.config["property_sliding_window"][property_name]:]), 2)
-
-                elif analysis_list[analysis_index]["algorithm"] == "watercps_threshold":
-                    property_correction[property_name]["value"] = round(np.mean(watercps_measurements["watercps_" + str(short_id)][property_name]["data"][property_name].values[-4:]))
-
-                aux_func.logMessage(f"--> {property_name} corrected value from {reading[property_name]['value']} to {property_correction[property_name]['value']}")
-            
+
+                property_correction[i][property_name]["value"] = detector.correction(stations[i][property_name], property_name)
+
+                aux_func.logMessage(f"--> {property_name} corrected value from {reading[property_name]['value']} to {property_correction[i][property_name]['value']}", kind = "debug")
+
             else:
                 # Clear the ongoing anomaly
                 anomaly_status[reading["id"]][property_name]["startDateOfOngoingAnomaly"] = None
-                
+
                 # Use the original value (does not correct)
-                property_correction[property_name]["value"] = reading[property_name]["value"]
+                property_correction[i][property_name]["value"] = reading[property_name]["value"]
 
             # Trigger update of in-memory data
-            manage_sliding_window_dataframe(station_id=reading["id"],
-                                            property_name=property_name,
-                                            algorithm=analysis_list[analysis_index]['algorithm'],
-                                            value=reading[property_name]["value"],
-                                            date=reading[property_name]["observedAt"],
-                                            dict_reset=False)
-
-        # Answer back (with corrected values)
-        produce_corrected_reading(id=reading["id"].split(":")[4],
+            _update_window(detector, station_ids[i], property_name, stations[i][property_name],
+                           value = reading[property_name]["value"],
+                           date = dates[property_name][i],
+                           dict_reset = False)
+
+    # Answer back (with corrected values)
+    for i, reading in enumerate(readings):
+        produce_corrected_reading(id=aux_func.short_id(reading["id"]),
                                   entityType=reading["type"],
                                   reading=reading,
-                                  corrected_variables=property_correction,
-                                  analysis=analysis_list[analysis_index],
-                                  is_outlier=is_outlier,
-                                  reason_watercps = property_error_reason)
-    else:
-        aux_func.logMessage(f"---X Unknown subscription, the incoming package is ignored: {subscriptionId}", "error")
-        pass
+                                  corrected_variables=property_correction[i],
+                                  analysis=analysis,
+                                  is_outlier=is_outlier[i],
+                                  reason_watercps = property_error_reason[i])
 
 def manage_sliding_window_dataframe(station_id, property_name, algorithm, value, date, dict_reset = False):
     '''
-    Manage the in-memory dataframes.
-    Decides when to reset the in-memory dataframes, and updates its values/index each time a sample is received
+    Manage the in-memory sliding windows.
+    Decides when to reset the in-memory windows, and appends the received sample to the ring buffer of each (station, property)
     '''
-    global entities_data, hampel_filter_measurements, watercps_measurements, print_debug
+    measurements, prefix = algorithm_measurements(algorithm)
 
-    short_id = station_id.split(":")[4]
-    new_row = {"date" : pd.to_datetime(date), str(property_name) : value}
-    
-    if dict_reset == False:
-        if algorithm == "z_score":
-            # Reset index
-            entities_data['z_score_measurement_' + str(short_id)][property_name]["data"].reset_index(inplace = True)
-            
-            try:
-                entities_data['z_score_measurement_' + str(short_id)][property_name]["data"].drop("index", axis = 1, inplace = True)
-            except: pass
-            
-            # Append new row
-            # New append format (Pandas 2.1.2): new_df = pd.concat([new_df, pd.Series({"Value" : 1, "Col1" : "Val1", "Col2" : "Val2"}).to_frame().T], ignore_index = True)
-            entities_data['z_score_measurement_' + str(short_id)][property_name]["data"] = pd.concat([entities_data['z_score_measurement_' + str(short_id)][property_name]["data"], pd.Series(new_row).to_frame().T], ignore_index = True)
-
-            # Set index again
-            entities_data['z_score_measurement_' + str(short_id)][property_name]["data"].set_index("date", inplace = True)
-
-            # Drop index duplicates and sort index
-            entities_data['z_score_measurement_' + str(short_id)][property_name]["data"] = entities_data['z_score_measurement_' + str(short_id)][property_name]["data"][~entities_data['z_score_measurement_' + str(short_id)][property_name]["data"].index.duplicated(keep='first')]
-            entities_data['z_score_measurement_' + str(short_id)][property_name]["data"] = entities_data['z_score_measurement_' + str(short_id)][property_name]["data"].sort_index()
-            
-            # Trim dataset according to config
-            entities_data['z_score_measurement_' + str(short_id)][property_name]["data"] = entities_data['z_score_measurement_' + str(short_id)][property_name]["data"][-aquaspice_utils.config["query_points"]:]
-            
-            # Re-calculate metrics
-            entities_data["z_score_measurement_" + str(short_id)][property_name]["mean"] = np.mean(entities_data["z_score_measurement_" + str(short_id)][property_name]["data"][property_name][-((aquaspice_utils.config["property_sliding_window"][property_name] * 2) + 2):].values)
-            entities_data["z_score_measurement_" + str(short_id)][property_name]["std"] = np.std(entities_data["z_score_measurement_" + str(short_id)][property_name]["data"][property_name][-((aquaspice_utils.config["property_sliding_window"][property_name] * 2) + 2):].values)
-            
-            if print_debug is True:
-                aux_func.logMessage(entities_data['z_score_measurement_' + str(short_id)][property_name]["data"], kind = "debug")
-            
-            try:
-                entities_data['z_score_measurement_' + str(short_id)][property_name]["data"].drop("index", axis = 1, inplace = True)
-            except:
-                pass
-            
-        elif algorithm == "hampel_filter":
-            
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"].reset_index(inplace = True)
-            
-            try:
-                hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"].drop("index", axis = 1, inplace = True)
-            except: pass
-
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"] = pd.concat([hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"], pd.Series(new_row).to_frame().T], ignore_index = True)
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"].set_index("date", inplace = True)
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"] = hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"][~hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"].index.duplicated(keep='first')]
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"] = hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"].sort_index()
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"] = hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"][-aquaspice_utils.config["query_points"]:]
-            
-            if print_debug is True:
-                aux_func.logMessage(hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"])
-            
-            try:
-                hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"].drop("index", axis = 1, inplace = True)
-            except:
-                pass
-            
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["num_data"] = len(hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"])
+    _update_window(detectors.DETECTORS[algorithm], station_id, property_name, measurements[prefix + aux_func.short_id(station_id)][property_name],
+                   value, aux_func.date_to_epoch(date), dict_reset)
 
-        elif algorithm == "watercps_threshold":
-            watercps_measurements["watercps_" + str(short_id)][property_name]["data"].reset_index(inplace=True)
-
-            try:
-                watercps_measurements["watercps_" + str(short_id)][property_name]["data"].drop("index", axis = 1, inplace = True)
-            except: pass
+def _update_window(detector, station_id, property_name, measurements, value, date, dict_reset = False):
+    '''
+    Append a sample (date: epoch ms) to the windows of a (station, property) of an algorithm (`measurements`), resetting them first if needed
+    '''
+    start = time.perf_counter()
+    value = float(value)
 
-            watercps_measurements["watercps_" + str(short_id)][property_name]["data"] = pd.concat(
-                [watercps_measurements["watercps_" + str(short_id)][property_name]["data"],
-                 pd.Series(new_row).to_frame().T], ignore_index=True)
+    # Reset on-memory dicts (the samples before the gap, for every analysis sharing the series)
+    if dict_reset == True:
+        aux_func.logMessage("--> Triggered on-memory reset dicts")
+        measurements["data"].reset(date)
 
-            watercps_measurements["watercps_" + str(short_id)][property_name]["data"].set_index("date", inplace=True)
-            watercps_measurements["watercps_" + str(short_id)][property_name]["data"] = watercps_measurements["watercps_" + str(short_id)][property_name]["data"][~watercps_measurements["watercps_" + str(short_id)][property_name]["data"].index.duplicated(keep='first')]
-            watercps_measurements["watercps_" + str(short_id)][property_name]["data"] = watercps_measurements["watercps_" + str(short_id)][property_name]["data"].sort_index()
-            watercps_measurements["watercps_" + str(short_id)][property_name]["data"] = watercps_measurements["watercps_" + str(short_id)][property_name]["data"][-aquaspice_utils.config["query_points"]:]
+    # Append new sample (O(1), duplicated dates keep the first sample)
+    measurements["data"].append(value, date)
 
-            if print_debug is True:
-                aux_func.logMessage(watercps_measurements["watercps_" + str(short_id)][property_name]["data"], kind = "debug")
+    # Derived statistics of the algorithm (running metrics, number of samples)
+    detector.update(measurements)
 
-            try:
-                watercps_measurements["watercps_" + str(short_id)][property_name]["data"].drop("index", axis = 1, inplace=True)
-            except:
-                pass
+    # Keep the sorted index used by the IQR failsafe up to date (the evicted sample is only readable right after the append)
+    if "iqr_index" in measurements:
+        measurements["iqr_index"].sync(measurements["data"])
 
-            watercps_measurements["watercps_" + str(short_id)][property_name]["num_data"] = len(watercps_measurements["watercps_" + str(short_id)][property_name]["data"])
+    if print_debug is True:
+        aux_func.logMessage("{} ({}, {}): {}", "debug", lambda: detector.algorithm, lambda: aux_func.short_id(station_id), lambda: property_name, lambda: measurements["data"].last())
 
-    # Reset on-memory dicts
-    elif dict_reset == True:
-        aux_func.logMessage("--> Triggered on-memory reset dicts")
-        if algorithm == "z_score":
-            entities_data["z_score_measurement_" + str(short_id)][property_name]["data"] = pd.DataFrame(columns = ["date", str(property_name)])
-            entities_data["z_score_measurement_" + str(short_id)][property_name]["data"] = pd.concat([entities_data["z_score_measurement_" + str(short_id)][property_name]["data"], pd.Series(new_row).to_frame().T], ignore_index = True)
-            entities_data['z_score_measurement_' + str(short_id)][property_name]["data"].set_index("date", inplace = True)
-            entities_data["z_score_measurement_" + str(short_id)][property_name]["mean"] = value
-            entities_data["z_score_measurement_" + str(short_id)][property_name]["std"] = value
-            
-        elif algorithm == "hampel_filter":
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"] = pd.DataFrame(columns = ["date", str(property_name)])
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"] = pd.concat([hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"], pd.Series(new_row).to_frame().T], ignore_index = True)
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"].set_index("date", inplace = True)
-            hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["num_data"] = len(hampel_filter_measurements["hampel_filter_" + str(short_id)][property_name]["data"])
-
-        elif algorithm == "watercps_threshold":
-            watercps_measurements["watercps_" + str(short_id)][property_name]["data"] = pd.DataFrame(columns = ["date", str(property_name)])
-            watercps_measurements["watercps_" + str(short_id)][property_name]["data"] = pd.concat([watercps_measurements["watercps_" + str(short_id)][property_name]["data"], pd.Series(new_row).to_frame().T], ignore_index = True)
-            watercps_measurements["watercps_" + str(short_id)][property_name]["data"].set_index("date", inplace = True)
-            watercps_measurements["watercps_" + str(short_id)][property_name]["num_data"] = len(watercps_measurements["watercps_" + str(short_id)][property_name]["data"])
+    metrics.WINDOW_UPDATE_SECONDS.observe(time.perf_counter() - start, algorithm = detector.algorithm)
 
 def create_history(station_id, analysis, start_from_0 = False):
     '''
     Function which decides if the entity Id is on the in-memory dicts
-    If the entity is already on memory, it passes, if not, triggers the respective module for each kind of analysis
+    If the entity is already on memory, it passes, if not, triggers the module of its algorithm (see detectors)
     '''
-    global entities_data, hampel_filter_measurements, watercps_measurements, last_observedAt_received, anomaly_status
-    
-    short_id = station_id.split(":")[4]
-    
-    if analysis["algorithm"] == "z_score":
-        if "z_score_measurement_" + str(short_id) in entities_data:
-            pass
-        else:
-            aux_func.logMessage(f"--> (create_history): Id {short_id} triggered z_score module.")
-            entities_data, anomaly_status = zscore_func.z_score_module(aquaspice_utils.config,
-                                                                       station_id,
-                                                                       analysis,
-                                                                       entities_data,
-                                                                       anomaly_status,
-                                                                       start_from_0)
-            
-    elif analysis["algorithm"] == "hampel_filter":
-        if "hampel_filter_" + str(short_id) in hampel_filter_measurements:
-            pass
-        else:
-            aux_func.logMessage(f"--> (create_history): Id {short_id} triggered hampel filter module.")
-            hampel_filter_measurements, anomaly_status = hampel_func.hampel_filter_module(aquaspice_utils.config,
-                                                                                          station_id,
-                                                                                          analysis,
-                                                                                          hampel_filter_measurements,
-                                                                                          anomaly_status,
-                                                                                          start_from_0)
-
-    elif analysis["algorithm"] == "watercps_threshold":
-        if "watercps_" + str(short_id) in watercps_measurements:
-            pass
-        else:
-            aux_func.logMessage(f"--> (create_history): Id {short_id} triggered watercps module.")
-            watercps_measurements, anomaly_status = wcps_func.watercps_module(aquaspice_utils.config,
-                                                                              station_id,
-                                                                              analysis,
-                                                                              watercps_measurements,
-                                                                              anomaly_status,
-                                                                              start_from_0)
+    _create_station(analysis_detector(analysis), station_id, start_from_0)
+
+def _create_station(detector, station_id, start_from_0 = False):
+    # The windows are created holding the lock of the station (its readings wait for the history)
+    with station_lock(station_id):
+        if detector.station(station_id) is None:
+            aux_func.logMessage(f"--> (create_history): Id {aux_func.short_id(station_id)} triggered {detector.algorithm} module.")
+            with metrics.HISTORY_FETCH_SECONDS.time(algorithm = detector.algorithm):
+                detector.create(station_id, anomaly_status, station_series, start_from_0)
+
+def prewarm_histories(station_filter = None):
+    '''
+    Load the history of every station listed in the "entityIds" of the analysis before accepting notifications.
+    Histories are fetched concurrently (bounded worker pool), stations discovered later use the lazy path (create_history on the first reading)
+    station_filter: optional function(station_id) -> bool selecting the stations to load
+    '''
+    global history_ready
+
+    history_ready = False
+
+    tasks = []
+    for analysis in aquaspice_utils.config["analysis"]:
+        if "entityIds" in analysis:
+            for station_id in analysis["entityIds"].split(";"):
+                if (station_filter is None) or station_filter(station_id):
+                    tasks.append((station_id, analysis))
+
+    aux_func.logMessage(f"--> Pre-warming {len(tasks)} histories (workers: {aquaspice_utils.config.get('prewarm_workers', 8)})")
+
+    with ThreadPoolExecutor(max_workers = aquaspice_utils.config.get("prewarm_workers", 8)) as executor:
+        futures = {executor.submit(create_history, station_id, analysis, False) : (station_id, analysis["algorithm"]) for station_id, analysis in tasks}
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                aux_func.logMessage(f"---X Pre-warm failed for {futures[future]} (lazy load on first reading): {e}", kind = "error")
+
+    history_ready = True
+    aux_func.logMessage("--> Pre-warm finished, ready to accept notifications")
+
+def analysis_plan():
+    '''
+    Return the analysis plan ({subscription_id: detector}), compiled once for the loaded configuration. The detectors hold the
+    properties, windows and thresholds of their analysis, so the readings are dispatched without scanning the config
+    '''
+    global plan
+
+    config, compiled = plan
+    if config is not aquaspice_utils.config:
+        compiled = compile_plan(aquaspice_utils.config)
+        plan = (aquaspice_utils.config, compiled)
+
+    return compiled
+
+def compile_plan(config):
+    '''
+    Build the detector of every analysis of the config (registry of detectors.DETECTORS), indexed by subscription id
+    '''
+    compiled = {}
+
+    for analysis in config["analysis"]:
+        if analysis["algorithm"] not in detectors.DETECTORS:
+            aux_func.logMessage(f"---X Unknown algorithm {analysis['algorithm']}, the analysis of {analysis['subscription_id']} is ignored", kind = "error")
+            continue
+
+        # (as before, the first analysis of a subscription is the one applied)
+        if analysis["subscription_id"] in compiled:
+            continue
+
+        try:
+            compiled[analysis["subscription_id"]] = detectors.DETECTORS[analysis["algorithm"]](config, analysis, algorithm_measurements(analysis["algorithm"])[0])
+        except KeyError as e:
+            aux_func.logMessage(f"---X Missing parameter {e} for the analysis of {analysis['subscription_id']}, it is ignored", kind = "error")
+
+    aux_func.logMessage(f"--> Analysis plan compiled ({len(compiled)} subscriptions)")
+
+    return compiled
+
+def analysis_detector(analysis):
+    '''
+    Return the detector of an analysis (the one of the plan, or a new one for an analysis outside the config)
+    '''
+    detector = analysis_plan().get(analysis["subscription_id"])
+
+    if (detector is None) or (detector.analysis is not analysis):
+        detector = detectors.DETECTORS[analysis["algorithm"]](aquaspice_utils.config, analysis, algorithm_measurements(analysis["algorithm"])[0])
+
+    return detector
+
+def algorithm_measurements(algorithm):
+    '''
+    Return the in-memory dict of an algorithm and the prefix of its keys (followed by the short station id)
+    '''
+    return algorithm_state.setdefault(algorithm, {}), detectors.DETECTORS[algorithm].prefix
+
+def snapshot_settings():
+    '''
+    Parameters the in-memory state depends on (a snapshot taken with other values is not restored)
+    '''
+    return {"query_points": aquaspice_utils.config["query_points"],
+            "property_sliding_window": aquaspice_utils.config["property_sliding_window"]}
+
+def save_snapshot():
+    '''
+    Write the in-memory state (series of every station, anomaly status and last received dates) to the snapshot directory
+    '''
+    directory = aquaspice_utils.config.get("snapshot_dir")
+    if not directory:
+        return
+
+    with snapshot_lock:
+        start = time.perf_counter()
+        series = []
+        entries = []
+        offset = 0
+        # Shared series already written (id of the buffer -> number of the series, offset, length)
+        written = {}
+
+        for analysis in aquaspice_utils.config["analysis"]:
+            measurements, prefix = algorithm_measurements(analysis["algorithm"])
+
+            for station_id in list(anomaly_status):
+                station = measurements.get(prefix + aux_func.short_id(station_id))
+                if station is None:
+                    continue
+
+                properties = {}
+                with station_lock(station_id):
+                    for property_name, property_measurements in list(station.items()):
+                        view = property_measurements["data"]
+
+                        if id(view.buffer) not in written:
+                            values, dates = view.buffer.export()
+                            written[id(view.buffer)] = (len(series), offset, len(values))
+                            series.append((values, dates))
+                            offset += len(values)
+
+                        properties[property_name] = {"series": written[id(view.buffer)][0],
+                                                     "offset": written[id(view.buffer)][1],
+                                                     "length": written[id(view.buffer)][2],
+                                                     # Newest sample seen by the analysis (the series may be ahead)
+                                                     "end_date": view.end_date,
+                                                     # Whether the history was loaded (num_data is None before the first sample)
+                                                     "loaded": property_measurements.get("num_data") is not None or "stats" in property_measurements}
+
+                entries.append({"subscription_id": analysis["subscription_id"],
+                                "algorithm": analysis["algorithm"],
+                                "station_id": station_id,
+                                "properties": properties})
+
+        snap.write_snapshot(directory, series, {"settings": snapshot_settings(),
+                                                "entries": entries,
+                                                "anomaly_status": {k: {p: dict(v) for p, v in list(status.items())} for k, status in list(anomaly_status.items())},
+                                                "last_observedAt_received": {k: dict(v) for k, v in list(last_observedAt_received.items())},
+                                                "last_date_received": dict(last_date_received)})
+
+        aux_func.logMessage(f"--> Snapshot written ({len(entries)} entries, {offset} samples) in {time.perf_counter() - start:.3f} s")
+
+def restore_snapshot(station_filter = None, directory = None):
+    '''
+    Restore the in-memory state from the last snapshot (of `directory`, snapshot_dir by default). Stale or incompatible snapshots are ignored,
+    the histories are then queried to QuantumLeap as usual (prewarm_histories / create_history).
+    station_filter: optional function(station_id) -> bool selecting the stations to restore
+    Returns the set of restored stations
+    '''
+    directory = directory or aquaspice_utils.config.get("snapshot_dir")
+    if not directory:
+        return set()
+
+    start = time.perf_counter()
+    snapshot = snap.read_snapshot(directory, aquaspice_utils.config.get("snapshot_max_age", 3600), snapshot_settings())
+    if snapshot is None:
+        return set()
+
+    index, values, dates = snapshot
+    analysis_list = {analysis["subscription_id"]: analysis for analysis in aquaspice_utils.config["analysis"]}
+    restored_stations = set()
+    # Entity type of each restored station (cadency anomalies)
+    station_types = {}
+    # Shared series already loaded (number of the series in the snapshot)
+    loaded_series = set()
+
+    for entry in index["entries"]:
+        analysis = analysis_list.get(entry["subscription_id"])
+
+        if (station_filter is not None) and (not station_filter(entry["station_id"])):
+            continue
+
+        # The analysis changed since the snapshot (history queried on the first reading)
+        if (analysis is None) or (analysis["algorithm"] != entry["algorithm"]) or \
+           (sorted(entry["properties"]) != sorted(x for x in analysis["analyzedProperties"] if x != "location")):
+            aux_func.logMessage(f"--> Snapshot entry ignored ({entry['station_id']}, {entry['subscription_id']}), analysis changed")
+            continue
+
+        # Empty windows, filled with the snapshot series
+        create_history(entry["station_id"], analysis, start_from_0 = True)
+        measurements, prefix = algorithm_measurements(analysis["algorithm"])
+        station = measurements[prefix + aux_func.short_id(entry["station_id"])]
+
+        for property_name, series in entry["properties"].items():
+            property_measurements = station[property_name]
+            end = series["offset"] + series["length"]
+
+            if series["series"] not in loaded_series:
+                property_measurements["data"].load(values[series["offset"]:end], dates[series["offset"]:end])
+                loaded_series.add(series["series"])
+
+            property_measurements["data"].end_date = series["end_date"]
+
+            if "stats" in property_measurements:
+                property_measurements["stats"].recompute(property_measurements["data"])
+            elif series["loaded"]:
+                detectors.DETECTORS[analysis["algorithm"]].update(property_measurements)
+
+        restored_stations.add(entry["station_id"])
+        station_types[entry["station_id"]] = analysis["entityType"]
+
+    for station_id in restored_stations:
+        for property_name, status in index["anomaly_status"].get(station_id, {}).items():
+            anomaly_status[station_id].setdefault(property_name, {}).update(status)
+
+        if station_id in index["last_date_received"]:
+            last_date_received[station_id] = index["last_date_received"][station_id]
+            # The silence of the station counts from its last reading before the restart
+            cadency.touch(station_id, station_types[station_id], last_date_received[station_id])
+
+    for subscriptionId, stations in index["last_observedAt_received"].items():
+        for station_id in stations:
+            if station_id in restored_stations:
+                last_observedAt_received.setdefault(subscriptionId, {})[station_id] = stations[station_id]
+
+    aux_func.logMessage(f"--> Restored {len(restored_stations)} stations from snapshot in {time.perf_counter() - start:.3f} s")
+
+    return restored_stations
+
+def schedule_snapshots():
+    '''
+    Take a snapshot every snapshot_interval seconds (if snapshot_dir is configured)
+    '''
+    if aquaspice_utils.config.get("snapshot_dir"):
+        scheduler.add_job(id = "state_snapshot", func = save_snapshot, trigger = "interval",
+                          seconds = aquaspice_utils.config.get("snapshot_interval", 300), misfire_grace_time = 60)
+
+def collect_metrics(**labels):
+    '''
+    Update the gauges (tracked stations, retained points, upsert queue) and return the metrics in the text exposition format.
+    labels are added to every sample (e.g. the worker index)
+    '''
+    for algorithm, measurements in list(algorithm_state.items()):
+        metrics.TRACKED_STATIONS.set(len(measurements), algorithm = algorithm)
+
+    metrics.RETAINED_POINTS.set(sum(len(buffer) for series in list(station_series.values()) for buffer in list(series.values())))
+
+    metrics.UPSERT_QUEUE.set(aquaspice_utils.upsert_queue_status()["queued"])
+
+    if ingest_queues:
+        metrics.INGEST_QUEUE.set(sum(work_queue.qsize() for work_queue in ingest_queues))
+
+    return metrics.render(**labels)
 
 ############### Support functions ###############
 
@@ -404,110 +720,56 @@ def _produce_corrected_reading(id, entityType, reading, corrected_variables, ana
     """
     Sends corrected_data to the context broker
     """
-    global produce_corrected_reading_debug
-    
-    if (str(entityType) == "measurementStation") or (str(entityType) == "measurementstation"):
-        entityType = "MeasurementStation"
-
-    # Get correct flag
-    flag = "Flagged" if analysis["algorithm"] == "watercps_threshold" else "Corrected"
-
-    aux_func.logMessage("--> Started produce_corrected_reading")
-    body = [
-        {
-            "id": "urn:ngsi-ld:AquaSpice:" + str(entityType) + str(flag) + ":" + id,
-            "type":  str(entityType) + str(flag)
-        }
-    ]
-
-    for property_name in analysis["notCorrectedProperties"]:
-        if property_name in reading:
-            body[0][property_name] = reading[property_name]
-        
-    # Exclude properties that are not relevant    
-    properties_to_iterate = [str(x) for x in reading.keys() if not x in analysis["notCorrectedProperties"]]
-    
-    if produce_corrected_reading_debug == True:
-        aux_func.logMessage(f"Analysis: {analysis['algorithm']}", kind = "debug")
-        aux_func.logMessage(f"Properties to iterate: {properties_to_iterate}", kind = "debug")
-        aux_func.logMessage(f"analyzedProperties: {analysis['analyzedProperties']}", kind = "debug")
-
-    # Add corresponding properties to the corrected reading, propertyRaw and propertyCorrected
-    if analysis["algorithm"] == "watercps_threshold":
-        for property_name in properties_to_iterate:
-            body[0][str(property_name)] = {
-                "type": "Property",
-                "value": reading[property_name]["value"],
-                "observedAt": reading[property_name]["observedAt"]
-            }
-
-            body[0][str(property_name) + "_error"] = {
-                "type": "Property",
-                "value": str(is_outlier[property_name]),  # Yes or No
-                "observedAt": reading[property_name]["observedAt"]
-            }
-
-            body[0][str(property_name) + "_error_reason"] = {
-                "type": "Property",
-                "value": str(reason_watercps[property_name]),  # Can be reason_max, min, and delta.
-                "observedAt": reading[property_name]["observedAt"]
-            }
-    else:
-        for property_name in properties_to_iterate:
-            body[0][str(property_name) + "Raw"] = {
-                "type" : "Property",
-                "value" : reading[property_name]["value"],
-                "observedAt" : reading[property_name]["observedAt"]
-            }
-
-            body[0][str(property_name) + "Corrected"] = {
-                "type" : "Property",
-                "value" : corrected_variables[property_name]["value"],
-                "observedAt" : reading[property_name]["observedAt"]
-            }
-
-    body[0]["@context"] =  [
-                "https://uri.etsi.org/ngsi-ld/v1/ngsi-ld-core-context.jsonld"
-            ]
+    body = [aux_func.build_corrected_reading(id, entityType, reading, corrected_variables, analysis, is_outlier, reason_watercps)]
 
     # Print body
-    aux_func.logMessage(f"--> Upsert body debug: {body}")
+    aux_func.logMessage("--> Upsert body debug: {}", "debug", lambda: body)
 
-    aquaspice_utils.upsert_context_broker(body)
+    aquaspice_utils.enqueue_upsert(body)
 
-@scheduler.task("interval", id = "cadency_check", seconds = 3000, misfire_grace_time = 300)
 def cadency_monitoring():
     """
-    Function to monitor if data has been received the last x minutes (configured in data_qa_params.json)
-    The function is executed every 45min.
-    misfire_grace_time = (None means “allow the job to run no matter how late it is”)
+    Produce an anomaly for the stations without data for more than data_cadency_anomaly_threshold minutes (data_qa_params.json).
+    Runs every cadency_check_interval seconds, only the stations whose deadline expired are visited (see CadencyMonitor),
+    and the anomalies of a check are sent together
     """
-    global last_date_received
+    threshold = aquaspice_utils.config["data_cadency_anomaly_threshold"]
+    now = time.time()
 
-    aux_func.logMessage(f"---- Cadency time anomaly module triggered ---- (current threshold) : {aquaspice_utils.config['data_cadency_anomaly_threshold']} (minutes)")
+    alerts = cadency.expired(now, threshold * 60)
+    if not alerts:
+        return
 
-    # Check all the current measured stations
-    for key in last_date_received:
-        difference = datetime.strptime(
-            aux_func.get_datetime_now(), "%Y-%m-%dT%H:%M:%SZ"
-        ) - datetime.strptime(last_date_received[key], "%Y-%m-%dT%H:%M:%SZ")
+    entities = []
+    for station_id, entity_type, last_seen in alerts:
+        aux_func.logMessage(f"Anomaly: data of {aux_func.short_id(station_id)} hasn't been received for {int(now - last_seen) // 60} minutes.", kind = "warning")
 
-        # Calculate difference in minutes
-        difference = difference.total_seconds() / 60
+        entities.append(aux_func.build_anomaly(aux_func.short_id(station_id),
+                                               entity_type,
+                                               CADENCY_ANOMALY_TYPE,
+                                               aux_func.epoch_to_date(last_seen),
+                                               aux_func.epoch_to_date(now),
+                                               f"cadency of data (>{threshold} min)"))
 
-        if difference > aquaspice_utils.config["data_cadency_anomaly_threshold"]:
-            # Trigger anomaly alert
-            produce_anomaly(str(key), get_datetime_now(), "cadency of data (>20min)")
-            aux_func.logMessage(f"Anomaly: data of {str(key).split(':')[4]}: hasn't been received for: {str(difference)} minutes.", kind = "warning")
-        else:
-            pass
+    metrics.CADENCY_ANOMALIES.inc(len(entities))
+    aquaspice_utils.enqueue_upsert(entities)
+
+def schedule_cadency_monitoring():
+    '''
+    Check the cadency deadlines every cadency_check_interval seconds
+    '''
+    scheduler.add_job(id = "cadency_check", func = cadency_monitoring, trigger = "interval",
+                      seconds = aquaspice_utils.config.get("cadency_check_interval", 10), misfire_grace_time = 60)
 
 if __name__ == "__main__":
     '''
     Main function, initiate process.
     '''
 
+    # Default configuration until the config files are loaded
+    aux_func.setup_logging({})
     aquaspice_utils.init()
+    aux_func.setup_logging(aquaspice_utils.config)
 
     # Create subscriptions
     aux_func.logMessage("--> Subscribing to defined topics (json file)...")
@@ -516,7 +778,37 @@ if __name__ == "__main__":
     # Create subscription at given ID (get from config file) for each analysis
     for analysis in aquaspice_utils.config["analysis"]:
         aquaspice_utils.create_subscription(analysis)
-                
-    # Run application
+
+    # Corrected readings and anomalies are sent in background (batched upserts)
+    aquaspice_utils.start_upsert_sender()
+
+    # Detectors of the configured analyses (compiled once, see analysis_plan)
+    analysis_plan()
+
+    # Restore the state of the last run, the remaining histories are queried (pre-warm)
+    restore_snapshot()
+
+    # Load the histories of the configured stations
+    prewarm_histories()
+
+    # Missing-data anomalies
+    schedule_cadency_monitoring()
+
+    # Backfill jobs interrupted by the last shutdown
+    backfill.resume_jobs()
+
+    # Periodic snapshots, and one on shutdown
+    if aquaspice_utils.config.get("snapshot_dir"):
+        schedule_snapshots()
+        atexit.register(save_snapshot)
+
+    # Notifications are acknowledged on arrival and analysed in background (the queue is drained before the snapshot on shutdown)
+    if aquaspice_utils.config.get("async_ingestion", False):
+        start_ingestion()
+
+    # SIGTERM exits normally so atexit handlers run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Run application (development server, single process; see server.py for the multi-worker mode)
     aux_func.logMessage("--> streaming_analysis started")
     app.run(host="0.0.0.0")
\ No newline at end of file
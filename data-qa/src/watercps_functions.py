@@ -1,9 +1,15 @@
 ################################################################################### Imports
 import numpy as np
-import pandas as pd
 
 import context_broker_client_utils as aquaspice_utils
 import auxiliar_functions as aux_func
+import sliding_window as sw
+
+# Reasons of the thresholds (checked in this order: max, min, delta), indexed by the code of outlier_function_watercps_matrix
+REASONS = np.array(["None", "reason_max", "reason_min", "reason_delta"], dtype = object)
+FLAGS = np.array(["No", "Yes"], dtype = object)
+# Last samples of a (station, variable) with less than 3 samples in memory
+NO_SAMPLES = (np.nan, np.nan, np.nan)
 
 def outlier_function_watercps(config, station_id : str, variable : str, data, watercps_measurements, debug = False):
     """
@@ -13,56 +19,159 @@ def outlier_function_watercps(config, station_id : str, variable : str, data, wa
 
     returns outlier True/False and Reason (None if not outlier)
     """
+    is_outlier, reason = outlier_function_watercps_batch(config, [station_id], variable, [data], watercps_measurements, debug)
 
-    # Get short id
-    short_id = station_id.split(":")[4]
+    return is_outlier[0], reason[0]
 
-    is_outlier = "No"
-    reason = "None"
+def compile_thresholds(config, variables):
+    """
+    Return the threshold matrix of the variables, one row per variable: max_value, min_value, delta_value
+    config_dict = dict from data_qa_params.json with key "watercps_error_flagging"
+    """
+    thresholds = [config["harbour_docks"][variable] for variable in variables]
+    return np.array([[x["max_value"], x["min_value"], x["delta_value"]] for x in thresholds], dtype = np.float64).reshape(len(variables), 3)
 
-    if watercps_measurements["watercps_" + str(short_id)][variable]["num_data"] >= 4:
+def outlier_function_watercps_batch(config, station_ids, variable : str, data, watercps_measurements, debug = False):
+    """
+    Vectorized watercps thresholds for the newest sample of several stations at once.
+    returns two lists aligned with station_ids: outlier ("Yes"/"No") and Reason ("None" if not outlier)
+    """
+    stations = [watercps_measurements["watercps_" + aux_func.short_id(station_id)] for station_id in station_ids]
+
+    is_outlier, reason = outlier_function_watercps_stations(compile_thresholds(config, [variable]), stations, [variable],
+                                                            np.asarray(data, dtype = np.float64)[:, None], debug)
+
+    return is_outlier[:, 0].tolist(), reason[:, 0].tolist()
+
+def outlier_function_watercps_stations(thresholds, stations, variables, data, debug = False):
+    """
+    Watercps thresholds of several variables of several stations in a single evaluation.
+    stations = in-memory dict of each station ({variable: {"data", "num_data", "last"}})
+    thresholds = matrix of compile_thresholds (one row per variable)
+    data = array (stations, variables) of the current readings
+
+    returns two arrays (stations, variables): outlier ("Yes"/"No") and Reason ("None" if not outlier)
+    """
+    # A single station (the usual round) is checked with scalars, cheaper than the array evaluation for a few values
+    if len(stations) == 1:
+        return outlier_function_watercps_station(thresholds, stations[0], variables, data[0], debug)
 
-        # Get latest 3 readings
-        series = list(watercps_measurements["watercps_" + str(short_id)][variable]["data"][variable].values[-3:])
-        # Add current reading
-        series = np.hstack((series, data))
+    # Latest 3 readings (kept in the station state, see update_last_samples) plus the current reading of each (station, variable)
+    series = np.empty(data.shape + (4,))
+    series[:, :, :3] = [[station[variable]["last"] for variable in variables] for station in stations]
+    series[:, :, 3] = data
 
-        # Calculate mean of 1-hour.
-        mean_value = np.mean(series)
-        delta_value = np.abs(series[3] - series[2])
+    # Need 4 samples (3 in memory plus the current reading)
+    sufficient_data = np.array([[(station[variable]["num_data"] or 0) >= 4 for variable in variables] for station in stations], dtype = bool).reshape(data.shape)
+
+    if not sufficient_data.all():
+        aux_func.logMessage("Insufficient data to compute watercps method (need 4).", kind = "debug")
+
+    return outlier_function_watercps_matrix(thresholds, series, sufficient_data, debug)
+
+def outlier_function_watercps_station(thresholds, station, variables, data, debug = False):
+    """
+    Same decisions as outlier_function_watercps_matrix for the variables of one station (data: current readings aligned with variables)
+
+    returns two arrays (1, variables): outlier ("Yes"/"No") and Reason ("None" if not outlier)
+    """
+    codes = []
+
+    for (max_value, min_value, delta_value), variable, value in zip(thresholds.tolist(), variables, data.tolist()):
+        measurements = station[variable]
+
+        # Need 4 samples (3 in memory plus the current reading)
+        if (measurements["num_data"] or 0) < 4:
+            aux_func.logMessage("Insufficient data to compute watercps method (need 4).", kind = "debug")
+            codes.append(0)
+            continue
+
+        # Mean of 1-hour (summed in the order of np.mean)
+        first, second, third = measurements["last"]
+        mean_value = (first + second + third + value) / 4
+        delta = abs(value - third)
 
         if debug:
-            aux_func.logMessage(f"---O Debug watercps_method {variable}:", kind = "debug")
-            aux_func.logMessage(f"Mean value: {mean_value}", kind = "debug")
-            aux_func.logMessage(f"Delta value: {delta_value}", kind = "debug")
-
-        # Check each case of the threshold
-        if mean_value > config["harbour_docks"][variable]["max_value"]:
-            if debug:
-                aux_func.logMessage("- watercps max value triggered", kind = "debug")
-            is_outlier = "Yes"
-            reason = "reason_max"
-        elif mean_value < config["harbour_docks"][variable]["min_value"]:
-            if debug:
-                aux_func.logMessage("- watercps min value triggered", kind = "debug")
-            is_outlier = "Yes"
-            reason = "reason_min"
-        elif delta_value > config["harbour_docks"][variable]["delta_value"]:
-            if debug:
-                aux_func.logMessage("- watercps delta value triggered", kind = "debug")
-            is_outlier = "Yes"
-            reason = "reason_delta"
-
-        return is_outlier, reason
-
-    else:
-        aux_func.logMessage("Insufficient data to compute watercps method (need 4).")
-        return is_outlier, reason
-
-
-def watercps_module(config, station_id, analysis, watercps_measurements, anomaly_status, start_from_0 = False):
+            aux_func.logMessage("---O Debug watercps_method:", kind = "debug")
+            aux_func.logMessage("Mean value: {}", "debug", lambda: mean_value)
+            aux_func.logMessage("Delta value: {}", "debug", lambda: delta)
+
+        codes.append(1 if mean_value > max_value else 2 if mean_value < min_value else 3 if delta > delta_value else 0)
+
+    codes = np.array([codes], dtype = int).reshape(1, len(variables))
+    return FLAGS[(codes > 0).astype(int)], REASONS[codes]
+
+def update_last_samples(measurements):
+    """
+    Update the number of samples in memory of a (station, variable) and its last 3 samples (scored with the current reading),
+    after a sample is appended or the history loaded
+    """
+    measurements["num_data"] = len(measurements["data"])
+    measurements["last"] = tuple(measurements["data"].last(3).tolist()) if measurements["num_data"] >= 3 else NO_SAMPLES
+
+def outlier_function_watercps_matrix(thresholds, series, sufficient_data, debug = False):
+    """
+    series = array (stations, variables, 4), last 3 samples in memory plus the current reading
+    thresholds = matrix of compile_thresholds (one row per variable)
+    sufficient_data = boolean array (stations, variables), the samples without enough data are never outliers
+
+    returns two arrays (stations, variables): outlier ("Yes"/"No") and Reason ("None" if not outlier)
+    """
+    # Calculate mean of 1-hour.
+    mean_value = np.mean(series, axis = 2)
+    delta_value = np.abs(series[:, :, 3] - series[:, :, 2])
+
+    if debug:
+        aux_func.logMessage("---O Debug watercps_method:", kind = "debug")
+        aux_func.logMessage("Mean value: {}", "debug", lambda: mean_value)
+        aux_func.logMessage("Delta value: {}", "debug", lambda: delta_value)
+
+    # Check each case of the threshold (in order: max, min, delta), the first one exceeded gives the reason
+    code = np.select([sufficient_data & (mean_value > thresholds[:, 0]),
+                      sufficient_data & (mean_value < thresholds[:, 1]),
+                      sufficient_data & (delta_value > thresholds[:, 2])],
+                     [1, 2, 3],
+                     default = 0)
+
+    return FLAGS[(code > 0).astype(int)], REASONS[code]
+
+def outlier_function_watercps_series(config, variable : str, values, dates = None, history = None, debug = False):
+    """
+    Offline watercps thresholds over a whole series (bulk QA of the history), same decisions as streaming its samples through
+    outlier_function_watercps, starting from `history` (samples in memory before the series, none by default) and resetting the
+    windows at the data gaps of `dates` (epoch ms, see aux_func.series_segments).
+    config_dict = dict from data_qa_params.json with key "watercps_error_flagging"
+
+    returns three arrays aligned with values: outlier ("Yes"/"No"), corrected value (original value if not an outlier) and Reason ("None" if not outlier)
+    """
+    values = np.asarray(values, dtype = np.float64)
+    thresholds = compile_thresholds(config, [variable])
+
+    is_outlier = FLAGS[np.zeros(len(values), dtype = int)]
+    reason = REASONS[np.zeros(len(values), dtype = int)]
+    corrected = values.copy()
+
+    for series, offset, start, end in aux_func.series_segments(values, dates, history):
+        positions = np.arange(offset, offset + end - start)
+
+        # Need 4 samples (3 in memory plus the current reading)
+        scored = np.flatnonzero(positions >= 4)
+        series_1h = sw.trailing_apply(series, positions[scored] + 1, 4, lambda windows, rows: windows)
+
+        flags, reasons = outlier_function_watercps_matrix(thresholds, series_1h[:, None, :], np.ones((len(scored), 1), dtype = bool), debug)
+        is_outlier[start + scored] = flags[:, 0]
+        reason[start + scored] = reasons[:, 0]
+
+        # Mean of the last hour
+        outliers = scored[flags[:, 0] == "Yes"]
+        corrected[start + outliers] = np.round(sw.trailing_apply(series, positions[outliers], 4, lambda windows, rows: np.mean(windows, axis = 1)))
+
+    return is_outlier, corrected, reason
+
+def watercps_module(config, station_id, analysis, watercps_measurements, anomaly_status, station_series, start_from_0 = False):
     '''
     Process responsible for doing the initial population of in-memory dicts. (WaterCPS threshold)
+    The series are taken from `station_series` (shared with the other analyses of the station, history only queried for the new ones)
     # start_from_0, True = Do not get historic data, False = Get historic data
     '''
     #global watercps_measurements, anomaly_status
@@ -77,55 +186,55 @@ def watercps_module(config, station_id, analysis, watercps_measurements, anomaly
     # Expand dicts
     watercps_measurements["watercps_" + str(short_id)] = {}
 
-    if station_id in anomaly_status:
-        pass
-    else:
-        anomaly_status[station_id] = {}
+    # (setdefault: modules of several analyses can initialise the same station concurrently)
+    anomaly_status.setdefault(station_id, {})
+
+    # Series of the analysed properties (views over the series shared by the analyses of the station)
+    series = {variable: sw.shared_series(station_series, station_id, variable, query_points) for variable in analysis["analyzedProperties"] if variable != "location"}
 
     # Do the same, but don't populate the dicts
     if start_from_0 == True:
         for variable in analysis["analyzedProperties"]:
             if variable != "location":
                 watercps_measurements["watercps_" + str(short_id)][variable] = {
-                    "data": pd.DataFrame(columns=["date", str(variable)]),
+                    "data": series[variable][0],
                     "num_data": None,
+                    "last": NO_SAMPLES,
                     "startDateOfOngoingAnomaly": None,
                 }
 
                 # Anomaly control
-                if variable in anomaly_status[station_id]:
-                    pass
-                else:
-                    anomaly_status[station_id][variable] = {}
-                    anomaly_status[station_id][variable]["startDateOfOngoingAnomaly"] = None
+                anomaly_status[station_id].setdefault(variable, {"startDateOfOngoingAnomaly": None})
 
         aux_func.logMessage(f"---> Finished creating watercps variables for urn = {station_id}")
 
     elif start_from_0 == False:
-        historic_data = aquaspice_utils.query_historical_data_lastN(f'urn:ngsi-ld:AquaSpice:{entityType}:{short_id}', query_points)
+        # Get historic data (only if a series is not in memory yet)
+        if any(created for view, created in series.values()):
+            historic_data = aquaspice_utils.query_historical_data_lastN(f'urn:ngsi-ld:AquaSpice:{analysis["entityType"]}:{short_id}', query_points)
 
         # Iterate over defined properties
         for variable in analysis["analyzedProperties"]:
             if variable != "location":
+                view, created = series[variable]
                 watercps_measurements["watercps_" + str(short_id)][variable] = {
-                    "data": pd.DataFrame(columns=["date", str(variable)]),
+                    "data": view,
                     "num_data": None,
+                    "last": NO_SAMPLES,
                     "startDateOfOngoingAnomaly": None,
                 }
 
                 # Anomaly control
-                if variable in anomaly_status[station_id]:
-                    pass
-                else:
-                    anomaly_status[station_id][variable] = {}
-                    anomaly_status[station_id][variable]["startDateOfOngoingAnomaly"] = None
-
-                # Populate dict with in-memory data
-                if historic_data is not None:
-                    aux_func.logMessage("--> Creating dataframes based on historical data (WaterCPS).")
-
-                    watercps_measurements["watercps_" + str(short_id)][variable]["data"]["date"] = pd.to_datetime(historic_data["index"])
-                    watercps_measurements["watercps_" + str(short_id)][variable]["data"][variable] = next(e for e in historic_data["attributes"] if e["attrName"] == variable)["values"]
+                anomaly_status[station_id].setdefault(variable, {"startDateOfOngoingAnomaly": None})
+
+                # Populate dict with in-memory data (series already in memory are shared)
+                if (historic_data is not None) or (created == False):
+                    if created:
+                        aux_func.logMessage("--> Creating sliding windows based on historical data (WaterCPS).")
+                        view.load(*sw.history_to_arrays(historic_data, variable))
+
+                    # Get the number of available data samples (and the last ones)
+                    update_last_samples(watercps_measurements["watercps_" + str(short_id)][variable])
 
         aux_func.logMessage(f"---> Finished creating watercps variables for urn = {station_id}")
 
@@ -4,56 +4,108 @@ import pandas as pd
 
 import auxiliar_functions as aux_func
 import context_broker_client_utils as aquaspice_utils
+import sliding_window as sw
+
+def stats_window(config, variable):
+    """
+    Size of the window of the running statistics: 2 * sliding window + 2 samples, at most the query_points held in memory
+    """
+    return min((config["property_sliding_window"][variable] * 2) + 2, config["query_points"])
 
 def outlier_function_z_score(config, station_id, variable, threshold, data, entities_data):
     """
     Function to implement z-score method
     """
-    data = float(data)
+    iqr_thresholds = (config["iqr_threshold"]["default"], config["iqr_threshold"]["failsafe"])
+    return bool(outlier_function_z_score_batch([station_id], variable, threshold, iqr_thresholds, [data], entities_data)[0])
 
-    short_id = station_id.split(":")[4]
-    aux_func.logMessage(f"Len data list: {len(entities_data['z_score_measurement_' + str(short_id)][variable]['data'])}")
-    aux_func.logMessage(
-        f"--> Debug: mean({entities_data['z_score_measurement_' + str(short_id)][variable]['mean']}), std: {entities_data['z_score_measurement_' + str(short_id)][variable]['std']} current value: {data}", kind = "debug")
-
-    if len(entities_data['z_score_measurement_' + str(short_id)][variable]['data']) >= 200:
-        mean = entities_data["z_score_measurement_" + str(short_id)][variable]["mean"]
-        std = entities_data["z_score_measurement_" + str(short_id)][variable]["std"]
-
-        z = np.abs((data - mean) / std)
-        aux_func.logMessage(f"Z value: {z}")
-
-        # If it is an outlier return True, otherwise False
-        outlier = True if z >= threshold else False
-
-        # Debug
-        if outlier == False:
-            aux_func.logMessage(f"--> Z-Score did not consider {data} an outlier.")
-        elif outlier == True:
-            if aux_func.iqr_method(entities_data['z_score_measurement_' + str(short_id)][variable]['data'].values, data,
-                                   config["iqr_threshold"]["default"]):
+def outlier_function_z_score_batch(station_ids, variable, threshold, iqr_thresholds, data, entities_data):
+    """
+    Vectorized z-score method, scores the newest sample of several stations at once.
+    iqr_thresholds = (default, failsafe) thresholds of the IQR confirmation (config "iqr_threshold")
+    Returns an array of booleans (outlier or not) aligned with station_ids
+    """
+    iqr_default, iqr_failsafe = iqr_thresholds
+    data = np.asarray(data, dtype = np.float64)
+    measurements = [entities_data["z_score_measurement_" + aux_func.short_id(station_id)][variable] for station_id in station_ids]
+
+    # Running statistics over the sliding window (updated on each append)
+    num_data = np.array([len(m["data"]) for m in measurements])
+    mean = np.array([m["stats"].mean for m in measurements])
+    std = np.array([m["stats"].std for m in measurements])
+
+    aux_func.logMessage("--> Debug: len data list {}, mean({}), std: {} current value: {}", "debug", lambda: num_data, lambda: mean, lambda: std, lambda: data)
+
+    z = np.abs((data - mean) / std)
+    aux_func.logMessage("Z value: {}", "debug", lambda: z)
+
+    # If it is an outlier True, otherwise False (at least 200 samples needed)
+    outliers = (num_data >= 200) & (z >= threshold)
+
+    # Confirm candidates with the IQR method
+    for i in np.flatnonzero(outliers):
+        # Quartiles of the whole history (sorted index), shared by both thresholds
+        measurements[i]["iqr_index"].sync(measurements[i]["data"])
+        quartiles = aux_func.iqr_quartiles(measurements[i]["iqr_index"])
+
+        if aux_func.iqr_method(None, data[i], iqr_default, quartiles):
+            aux_func.logMessage(
+                f"--> Z-score considered {data[i]} an outlier ====================================================", kind = "warning")
+        else:
+            # Second check
+            if aux_func.iqr_method(None, data[i], iqr_failsafe, quartiles):
                 aux_func.logMessage(
-                    f"--> Z-score considered {data} an outlier ====================================================", kind = "warning")
-                outlier = True
+                    f"--> IQR ({iqr_failsafe}) considered {data[i]} an outlier.", kind = "warning")
             else:
-                # Second check
-                if aux_func.iqr_method(entities_data['z_score_measurement_' + str(short_id)][variable]['data'].values,
-                                       data, config["iqr_threshold"]["failsafe"]):
-                    aux_func.logMessage(
-                        f"--> IQR ({config['iqr_threshold']['failsafe']}) considered {data} an outlier.", kind = "warning")
-                    outlier = True
-                else:
-                    aux_func.logMessage(f"--> Z-score did not consider {data} and outlier (after checking all IQRs).")
-                    outlier = False
-
-        return outlier
-    else:
-        return False
-
-
-def z_score_module(config, station_id, analysis, entities_data, anomaly_status, start_from_0 = False):
+                aux_func.logMessage(f"--> Z-score did not consider {data[i]} and outlier (after checking all IQRs).", kind = "debug")
+                outliers[i] = False
+
+    return outliers
+
+def outlier_function_z_score_series(config, variable, threshold, values, dates = None, history = None):
+    """
+    Offline z-score method over a whole series (bulk QA of the history), same decisions as streaming its samples through
+    outlier_function_z_score: each sample is scored against the samples before it (running statistics window, whole history
+    for the IQR failsafe), starting from `history` (samples in memory before the series, none by default) and resetting the
+    windows at the data gaps of `dates` (epoch ms, see aux_func.series_segments).
+    Returns three arrays aligned with values: outlier (True/False), corrected value (original value if not an outlier) and reason ("None")
+    """
+    values = np.asarray(values, dtype = np.float64)
+    query_points = config["query_points"]
+    window = stats_window(config, variable)
+
+    outliers = np.zeros(len(values), dtype = bool)
+    corrected = values.copy()
+
+    for series, offset, start, end in aux_func.series_segments(values, dates, history):
+        positions = np.arange(offset, offset + end - start)
+        data = values[start:end]
+
+        # Samples in memory when each one is scored (at least 200 needed)
+        scored = np.flatnonzero(np.minimum(positions, query_points) >= 200)
+
+        # Running mean and std of the sliding window (as sw.RunningStats), the window preceding each sample ends at the previous one
+        rolling = pd.Series(series).rolling(window, min_periods = 1)
+        mean = rolling.mean().to_numpy()[positions[scored] - 1]
+        std = rolling.std(ddof = 0).to_numpy()[positions[scored] - 1]
+
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            z = np.abs((data[scored] - mean) / std)
+
+        # Confirm candidates with the IQR method
+        candidates = np.flatnonzero(z >= threshold)
+        confirmed = candidates[aux_func.iqr_confirm(series, positions[scored[candidates]], data[scored[candidates]], config["iqr_threshold"], query_points)]
+
+        outliers[start + scored[confirmed]] = True
+        # Mean of the sliding window
+        corrected[start + scored[confirmed]] = np.round(mean[confirmed], 2)
+
+    return outliers, corrected, np.full(len(values), "None", dtype = object)
+
+def z_score_module(config, station_id, analysis, entities_data, anomaly_status, station_series, start_from_0 = False):
     '''
     Process responsible for doing the initial population of in-memory dicts.
+    The series are taken from `station_series` (shared with the other analyses of the station, history only queried for the new ones)
     # start_from_0, True = Do not get historic data, False = Get historic data
     '''
     #global entities_data, anomaly_status
@@ -68,68 +120,60 @@ def z_score_module(config, station_id, analysis, entities_data, anomaly_status,
     # Expand dicts
     entities_data["z_score_measurement_" + str(short_id)] = {}
 
-    if station_id in anomaly_status:
-        pass
-    else:
-        anomaly_status[station_id] = {}
+    # (setdefault: modules of several analyses can initialise the same station concurrently)
+    anomaly_status.setdefault(station_id, {})
+
+    # Series of the analysed properties (views over the series shared by the analyses of the station)
+    series = {variable: sw.shared_series(station_series, station_id, variable, query_points) for variable in analysis["analyzedProperties"] if variable != "location"}
 
     # Do the same, but don't populate the dicts
     if start_from_0 == True:
         for variable in analysis["analyzedProperties"]:
             if variable != "location":
                 entities_data["z_score_measurement_" + str(short_id)][variable] = {
-                    "data": pd.DataFrame(columns=["date", str(variable)]),
-                    "mean": None,
-                    "std": None,
+                    "data": series[variable][0],
+                    "stats": sw.RunningStats(stats_window(config, variable)),
+                    # Sorted index of the whole history (IQR failsafe)
+                    "iqr_index": sw.SortedWindow(query_points),
                     "startDateOfOngoingAnomaly": None,
                 }
 
                 # Anomaly control
-                if variable in anomaly_status[station_id]:
-                    pass
-                else:
-                    anomaly_status[station_id][variable] = {}
-                    anomaly_status[station_id][variable]["startDateOfOngoingAnomaly"] = None
+                anomaly_status[station_id].setdefault(variable, {"startDateOfOngoingAnomaly": None})
 
     elif start_from_0 == False:
-        historic_data = aquaspice_utils.query_historical_data_lastN(f'urn:ngsi-ld:AquaSpice:{entityType}:{short_id}', query_points)
+        # Get historic data (only if a series is not in memory yet)
+        if any(created for view, created in series.values()):
+            historic_data = aquaspice_utils.query_historical_data_lastN(f'urn:ngsi-ld:AquaSpice:{analysis["entityType"]}:{short_id}', query_points)
 
         # Iterate over defined properties
         for variable in analysis["analyzedProperties"]:
             if variable != "location":
+                view, created = series[variable]
                 entities_data["z_score_measurement_" + str(short_id)][variable] = {
-                    "data": pd.DataFrame(columns=["date", str(variable)]),
-                    "mean": None,
-                    "std": None,
+                    "data": view,
+                    "stats": sw.RunningStats(stats_window(config, variable)),
+                    # Sorted index of the whole history (IQR failsafe)
+                    "iqr_index": sw.SortedWindow(query_points),
                     "startDateOfOngoingAnomaly": None,
                 }
 
                 # Anomaly control
-                if variable in anomaly_status[station_id]:
-                    pass
-                else:
-                    anomaly_status[station_id][variable] = {}
-                    anomaly_status[station_id][variable]["startDateOfOngoingAnomaly"] = None
-
-                # Populate dict with in-memory data
-                if historic_data is not None:
-                    aux_func.logMessage("--> Creating dataframes based on historical data (Z-score).")
-
-                    entities_data["z_score_measurement_" + str(short_id)][variable]["data"]["date"] = pd.to_datetime(
-                        historic_data["index"])
-                    entities_data["z_score_measurement_" + str(short_id)][variable]["data"][variable] = \
-                    next(e for e in historic_data["attributes"] if e["attrName"] == variable)["values"]
-
-                # Calculate mean and std metrics
-                entities_data["z_score_measurement_" + str(short_id)][variable]["mean"] = np.mean(
-                    entities_data["z_score_measurement_" + str(short_id)][variable]["data"][variable].values)
-                entities_data["z_score_measurement_" + str(short_id)][variable]["std"] = np.std(
-                    entities_data["z_score_measurement_" + str(short_id)][variable]["data"][variable].values)
-                aux_func.logMessage(entities_data["z_score_measurement_" + str(short_id)][variable]["data"].head())
-
-            aux_func.logMessage(f"---> Finished creating z-score variables for urn = {station_id}")
-
-            # Free memory
-            del historic_data
+                anomaly_status[station_id].setdefault(variable, {"startDateOfOngoingAnomaly": None})
+
+                # Populate dict with in-memory data (series already in memory are shared)
+                if (historic_data is not None) and created:
+                    aux_func.logMessage("--> Creating sliding windows based on historical data (Z-score).")
+
+                    view.load(*sw.history_to_arrays(historic_data, variable))
+
+                # Calculate mean and std metrics (over the sliding window)
+                entities_data["z_score_measurement_" + str(short_id)][variable]["stats"].recompute(entities_data["z_score_measurement_" + str(short_id)][variable]["data"])
+                aux_func.logMessage(f"Samples in memory ({variable}): {len(entities_data['z_score_measurement_' + str(short_id)][variable]['data'])}")
+
+        aux_func.logMessage(f"---> Finished creating z-score variables for urn = {station_id}")
+
+        # Free memory
+        del historic_data
 
     return entities_data, anomaly_status
\ No newline at end of file
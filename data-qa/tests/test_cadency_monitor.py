@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import cadency_monitor
+
+# Threshold of the missing-data anomalies (seconds)
+THRESHOLD = 3000
+
+class TestCadencyMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.monitor = cadency_monitor.CadencyMonitor()
+
+    def test_deadline(self):
+        self.monitor.touch("S1", "MeasurementStation", 1000)
+
+        self.assertEqual(self.monitor.expired(1000 + THRESHOLD - 1, THRESHOLD), [])
+        self.assertEqual(self.monitor.expired(1000 + THRESHOLD, THRESHOLD), [("S1", "MeasurementStation", 1000)])
+
+    def test_readings_postpone_the_deadline(self):
+        self.monitor.touch("S1", "MeasurementStation", 1000)
+        self.monitor.touch("S1", "MeasurementStation", 2500)
+
+        # The entry of the first reading expired, checked again from the last one
+        self.assertEqual(self.monitor.expired(1000 + THRESHOLD, THRESHOLD), [])
+        self.assertEqual(self.monitor.expired(2500 + THRESHOLD - 1, THRESHOLD), [])
+        self.assertEqual(self.monitor.expired(2500 + THRESHOLD, THRESHOLD), [("S1", "MeasurementStation", 2500)])
+
+    def test_late_readings_are_ignored(self):
+        self.monitor.touch("S1", "MeasurementStation", 2000)
+        self.monitor.touch("S1", "OtherType", 1500)
+
+        self.assertEqual(self.monitor.expired(2000 + THRESHOLD, THRESHOLD), [("S1", "MeasurementStation", 2000)])
+
+    def test_silent_station_reported_once_per_threshold(self):
+        self.monitor.touch("S1", "MeasurementStation", 0)
+
+        self.assertEqual(len(self.monitor.expired(THRESHOLD, THRESHOLD)), 1)
+        self.assertEqual(self.monitor.expired(THRESHOLD + 10, THRESHOLD), [])
+        self.assertEqual(self.monitor.expired(2 * THRESHOLD - 1, THRESHOLD), [])
+        self.assertEqual(self.monitor.expired(2 * THRESHOLD, THRESHOLD), [("S1", "MeasurementStation", 0)])
+
+    def test_missed_checks_report_once(self):
+        self.monitor.touch("S1", "MeasurementStation", 0)
+
+        # Several periods without a check: a single report, the next one a threshold after the check
+        self.assertEqual(len(self.monitor.expired(10 * THRESHOLD, THRESHOLD)), 1)
+        self.assertEqual(self.monitor.expired(11 * THRESHOLD - 1, THRESHOLD), [])
+        self.assertEqual(len(self.monitor.expired(11 * THRESHOLD, THRESHOLD)), 1)
+
+    def test_recovered_station(self):
+        self.monitor.touch("S1", "MeasurementStation", 0)
+        self.assertEqual(len(self.monitor.expired(THRESHOLD, THRESHOLD)), 1)
+
+        # Data received again, not reported until it is silent for another threshold
+        self.monitor.touch("S1", "MeasurementStation", THRESHOLD + 100)
+        self.assertEqual(self.monitor.expired(2 * THRESHOLD, THRESHOLD), [])
+        self.assertEqual(self.monitor.expired(2 * THRESHOLD + 100, THRESHOLD), [("S1", "MeasurementStation", THRESHOLD + 100)])
+
+    def test_only_expired_stations_are_reported(self):
+        for i in range(100):
+            self.monitor.touch(f"S{i}", "MeasurementStation", i * 10)
+
+        self.assertEqual(len(self.monitor), 100)
+        alerts = self.monitor.expired(THRESHOLD + 495, THRESHOLD)
+        self.assertEqual(sorted(station_id for station_id, entity_type, last_seen in alerts), sorted(f"S{i}" for i in range(50)))
+
+        # The others expire later, each one once
+        alerts = self.monitor.expired(THRESHOLD + 990, THRESHOLD)
+        self.assertEqual(sorted(station_id for station_id, entity_type, last_seen in alerts), sorted(f"S{i}" for i in range(50, 100)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import unittest
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import auxiliar_functions as aux_func
+import detectors
+import hampel_functions as hampel_func
+import sliding_window as sw
+
+# Only the errors of the analysis are logged
+aux_func.setup_logging({}, level = "ERROR")
+
+STATION_ID = "urn:ngsi-ld:MeasurementStation:AquaSpice:T1"
+
+ANALYSIS = {
+    "algorithm": "hampel_filter",
+    "subscription_id": "urn:ngsi-ld:Subscription:hampel_anomaly_detection_1",
+    "entityType": "MeasurementStation",
+    "analyzedProperties": ["depth"],
+    "anomalyTypeId": "_anomaly_hampel_filter",
+    "notCorrectedProperties": ["location"]
+}
+
+def make_config(sliding_window, query_points = 4000):
+    return {
+        "query_points": query_points,
+        "property_sliding_window": {"depth": sliding_window},
+        "hampel_filter_threshold": 3,
+        "iqr_threshold": {"default": 2, "failsafe": 1.8}
+    }
+
+def make_series(num_samples, decimals, seed = 0):
+    '''
+    Seeded series with spikes (outliers), rounded to `decimals` (repeated values, ties in the windows)
+    '''
+    rng = np.random.default_rng(seed)
+    values = 1000 + 80 * np.sin(np.arange(num_samples) / 96 * 2 * np.pi) + rng.normal(0, 10, num_samples)
+    spikes = rng.choice(num_samples, num_samples // 20, replace = False)
+    values[spikes] += rng.choice([-1, 1], len(spikes)) * rng.uniform(100, 600, len(spikes))
+    return np.round(values, decimals)
+
+def hampel_reference(ts, window_size, n):
+    '''
+    Outlier indices of hampel 0.0.5, hampel(ts, window_size, n, imputation = False), the library the streaming filter replaced:
+    centered rolling median and MAD of 2 * window_size samples (edges filled from the nearest window), |x - median| >= n * k * MAD
+    '''
+    k = 1.4826
+    rolling_ts = ts.rolling(window_size * 2, center = True)
+    rolling_median = rolling_ts.median().bfill().ffill()
+    rolling_sigma = k * rolling_ts.apply(lambda x: np.median(np.abs(x - np.median(x))), raw = True).bfill().ffill()
+    return list(np.flatnonzero(np.abs(ts - rolling_median) >= n * rolling_sigma))
+
+class TestStreamingHampel(unittest.TestCase):
+
+    def check_same_decisions(self, sliding_window, values):
+        '''
+        Stream the samples through the sorted windows (scoring the newest sample only) and compare every decision with hampel()
+        run on the samples in memory plus the sample of interest, as the filter did before
+        '''
+        config = make_config(sliding_window)
+        measurements = {}
+        hampel_func.hampel_filter_module(config, STATION_ID, ANALYSIS, measurements, {}, {}, start_from_0 = True)
+        detector = detectors.DETECTORS["hampel_filter"](config, ANALYSIS, measurements)
+        property_measurements = detector.station(STATION_ID)["depth"]
+
+        decisions = 0
+        outliers = 0
+
+        for i, value in enumerate(values):
+            data = property_measurements["data"]
+            data_list = list(data.last(sliding_window)) + [value]
+            hampel_window_size = min(len(data_list) // 2, sliding_window)
+
+            if hampel_window_size >= 100:
+                median, mad = hampel_func.rolling_median_mad(property_measurements, value, hampel_window_size)
+                streamed = abs(value - median) >= config["hampel_filter_threshold"] * hampel_func.MAD_SCALE * mad
+                expected = (len(data_list) - 1) in hampel_reference(pd.Series(data_list), hampel_window_size, config["hampel_filter_threshold"])
+
+                self.assertEqual(streamed, expected, f"sample {i}")
+
+                # Window of the last index in hampel(): the last 2 * hampel_window_size samples
+                window = np.array(data_list[-2 * hampel_window_size:])
+                np.testing.assert_allclose([median, mad], [np.median(window), np.median(np.abs(window - np.median(window)))], rtol = 1e-12)
+                decisions += 1
+                outliers += streamed
+
+            data.append(float(value), 1672531200000 + i * 900000)
+            detector.update(property_measurements)
+
+        # Scored with the sorted window once full, and some of the decisions are outliers
+        self.assertGreater(decisions, len(values) // 2)
+        self.assertGreater(outliers, 0)
+
+    def test_odd_sliding_window(self):
+        self.check_same_decisions(201, make_series(700, decimals = 3))
+
+    def test_even_sliding_window_with_ties(self):
+        self.check_same_decisions(200, make_series(700, decimals = 0, seed = 1))
+
+    def test_kth_of_two(self):
+        rng = np.random.default_rng(2)
+
+        for _ in range(200):
+            a = np.sort(rng.integers(0, 20, rng.integers(0, 10)))
+            b = np.sort(rng.integers(0, 20, rng.integers(1, 10)))
+            merged = np.sort(np.concatenate([a, b]))
+
+            for k in range(len(merged)):
+                self.assertEqual(sw.kth_of_two(lambda i: a[i], len(a), lambda i: b[i], len(b), k), merged[k])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import collections
+import os
+import subprocess
+import sys
+import unittest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+import server
+
+STATION_IDS = [f"urn:ngsi-ld:MeasurementStation:AquaSpice:S{i}" for i in range(2000)]
+
+class TestHashRing(unittest.TestCase):
+
+    def test_owners_are_pinned(self):
+        # Owners only depend on the station id and the number of workers: a change would move the stations (and their
+        # snapshots) to other workers after an upgrade
+        ring = server.HashRing(4)
+        self.assertEqual([ring.owner(station_id) for station_id in STATION_IDS[:8]], [1, 1, 3, 2, 1, 1, 2, 1])
+
+    def test_same_owners_in_other_processes(self):
+        # Not affected by the hash randomisation of str (PYTHONHASHSEED)
+        code = ("import sys; sys.path.insert(0, sys.argv[1]); import server; ring = server.HashRing(4); "
+                "print([ring.owner(f'urn:ngsi-ld:MeasurementStation:AquaSpice:S{i}') for i in range(200)])")
+        ring = server.HashRing(4)
+        expected = str([ring.owner(station_id) for station_id in STATION_IDS[:200]])
+
+        for seed in ["1", "2"]:
+            output = subprocess.run([sys.executable, "-c", code, SRC], capture_output = True, text = True, check = True,
+                                    env = dict(os.environ, PYTHONHASHSEED = seed))
+            self.assertEqual(output.stdout.strip(), expected)
+
+    def test_single_worker(self):
+        ring = server.HashRing(1)
+        self.assertEqual({ring.owner(station_id) for station_id in STATION_IDS}, {0})
+
+    def test_balanced(self):
+        ring = server.HashRing(4)
+        counts = collections.Counter(ring.owner(station_id) for station_id in STATION_IDS)
+
+        self.assertEqual(sorted(counts), [0, 1, 2, 3])
+        for worker, count in counts.items():
+            self.assertGreater(count, len(STATION_IDS) / 4 * 0.7, worker)
+            self.assertLess(count, len(STATION_IDS) / 4 * 1.3, worker)
+
+    def test_adding_a_worker_moves_few_stations(self):
+        before = server.HashRing(4)
+        after = server.HashRing(5)
+        moved = [station_id for station_id in STATION_IDS if before.owner(station_id) != after.owner(station_id)]
+
+        # Only the stations taken by the new worker move (about 1 / 5 of them)
+        self.assertEqual({after.owner(station_id) for station_id in moved}, {4})
+        self.assertLess(len(moved), len(STATION_IDS) * 0.3)
+
+if __name__ == "__main__":
+    unittest.main()
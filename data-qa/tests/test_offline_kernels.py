@@ -0,0 +1,143 @@
+import datetime
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import auxiliar_functions as aux_func
+import context_broker_client_utils as aquaspice_utils
+import streaming_analysis
+
+# Only the errors of the analysis are logged
+aux_func.setup_logging({}, level = "ERROR")
+
+STATION_ID = "urn:ngsi-ld:MeasurementStation:AquaSpice:T1"
+PROPERTIES = ["temperature", "depth", "conductivity"]
+ALGORITHMS = ["z_score", "hampel_filter", "watercps_threshold"]
+START = datetime.datetime(2023, 1, 1, tzinfo = datetime.timezone.utc)
+
+# Samples loaded as history before streaming, and streamed
+HISTORY_POINTS = 500
+STREAMED_POINTS = 1600
+
+# Minutes between samples (15 by default) before some streamed samples: gaps of at least RESET_GAP_MINUTES reset the windows,
+# including two resets close to each other, a gap just below the limit does not
+GAPS = {HISTORY_POINTS + 300: 240, HISTORY_POINTS + 700: 239, HISTORY_POINTS + 1000: 600, HISTORY_POINTS + 1010: 300, HISTORY_POINTS + 1300: 241}
+
+def make_config():
+    return {
+        "query_points": 400,
+        "property_sliding_window": {property_name: 200 for property_name in PROPERTIES},
+        "z_score_threshold": 4,
+        "hampel_filter_threshold": 3,
+        "iqr_threshold": {"default": 2, "failsafe": 1.8},
+        "watercps_error_flagging": {"harbour_docks": {"temperature": {"min_value": 2, "max_value": 35, "delta_value": 5},
+                                                      "depth": {"min_value": 100, "max_value": 3000, "delta_value": 500},
+                                                      "conductivity": {"min_value": 300, "max_value": 30000, "delta_value": 5000}}},
+        "analysis": [{"algorithm": algorithm,
+                      "subscription_id": f"urn:ngsi-ld:Subscription:{algorithm}_test",
+                      "entityType": "MeasurementStation",
+                      "analyzedProperties": PROPERTIES + ["location"],
+                      "anomalyTypeId": f"_anomaly_{algorithm}",
+                      "notCorrectedProperties": ["location"]} for algorithm in ALGORITHMS]
+    }
+
+def make_series(num_samples, seed = 0):
+    '''
+    Seeded series of every property with spikes (outliers), and their dates (epoch ms) with the gaps of GAPS
+    '''
+    rng = np.random.default_rng(seed)
+    base = {"temperature": (15, 2, 0.2), "depth": (1000, 80, 10), "conductivity": (5000, 300, 40)}
+    series = {}
+
+    for property_name, (level, amplitude, noise) in base.items():
+        values = level + amplitude * np.sin(np.arange(num_samples) / 96 * 2 * np.pi) + rng.normal(0, noise, num_samples)
+        spikes = rng.choice(num_samples, num_samples // 30, replace = False)
+        values[spikes] += rng.choice([-1, 1], len(spikes)) * amplitude * rng.uniform(3, 12, len(spikes))
+        series[property_name] = np.round(values, 3)
+
+    minutes = np.cumsum([GAPS.get(i, 15) for i in range(num_samples)])
+    return series, int(START.timestamp() * 1000) + minutes.astype(np.int64) * 60 * 1000
+
+def clear_state():
+    for state in [streaming_analysis.entities_data, streaming_analysis.hampel_filter_measurements, streaming_analysis.watercps_measurements,
+                  streaming_analysis.station_series, streaming_analysis.anomaly_status, streaming_analysis.last_date_received,
+                  streaming_analysis.last_observedAt_received]:
+        state.clear()
+
+def stream(series, dates):
+    '''
+    Load the first HISTORY_POINTS samples as history and analyse the others reading by reading (streaming_analysis.process_reading).
+    Returns {(algorithm, property): (outlier flags, corrected values, reasons)} of the streamed samples
+    '''
+    results = {(algorithm, property_name): ([], [], []) for algorithm in ALGORITHMS for property_name in PROPERTIES}
+
+    def corrected(id, entityType, reading, corrected_variables, analysis, is_outlier, reason_watercps):
+        for property_name in is_outlier:
+            for result, value in zip(results[analysis["algorithm"], property_name],
+                                     [str(is_outlier[property_name]), corrected_variables[property_name]["value"], reason_watercps[property_name]]):
+                result.append(value)
+
+    for analysis in aquaspice_utils.config["analysis"]:
+        streaming_analysis.create_history(STATION_ID, analysis, start_from_0 = True)
+        detector = streaming_analysis.analysis_detector(analysis)
+
+        for property_name, property_measurements in detector.station(STATION_ID).items():
+            property_measurements["data"].load(series[property_name][:HISTORY_POINTS], dates[:HISTORY_POINTS])
+
+            if "stats" in property_measurements:
+                property_measurements["stats"].recompute(property_measurements["data"])
+            else:
+                detector.update(property_measurements)
+
+        streaming_analysis.last_observedAt_received.setdefault(analysis["subscription_id"], {})[STATION_ID] = int(dates[HISTORY_POINTS - 1]) // 1000
+
+    for i in range(HISTORY_POINTS, len(dates)):
+        date = aux_func.epoch_to_date(int(dates[i]) // 1000)
+
+        for analysis in aquaspice_utils.config["analysis"]:
+            reading = dict({"id": STATION_ID, "type": "MeasurementStation"},
+                           **{property_name: {"type": "Property", "value": float(series[property_name][i]), "observedAt": date} for property_name in PROPERTIES})
+            streaming_analysis.process_reading(reading, analysis["subscription_id"], lambda *args: None, corrected)
+
+    return results
+
+class TestOfflineKernels(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_config = aquaspice_utils.config
+        aquaspice_utils.config = make_config()
+        clear_state()
+
+    def tearDown(self):
+        aquaspice_utils.config = self.previous_config
+        clear_state()
+
+    def test_same_decisions_as_streaming_across_the_gaps(self):
+        series, dates = make_series(HISTORY_POINTS + STREAMED_POINTS)
+        streamed = stream(series, dates)
+
+        for analysis in aquaspice_utils.config["analysis"]:
+            detector = streaming_analysis.analysis_detector(analysis)
+            outliers = 0
+
+            for property_name in PROPERTIES:
+                flags, corrected, reasons = detector.score_series(property_name, series[property_name][HISTORY_POINTS:], dates[HISTORY_POINTS:],
+                                                                  series[property_name][:HISTORY_POINTS])
+                streamed_flags, streamed_corrected, streamed_reasons = streamed[analysis["algorithm"], property_name]
+
+                self.assertEqual([str(x) for x in flags], streamed_flags, (analysis["algorithm"], property_name))
+                np.testing.assert_allclose(np.asarray(corrected, dtype = np.float64), streamed_corrected, rtol = 0, atol = 1e-9)
+                self.assertEqual(list(reasons), streamed_reasons, (analysis["algorithm"], property_name))
+                outliers += sum(x in ("True", "Yes") for x in streamed_flags)
+
+            # Every detector flags some of the spikes
+            self.assertGreater(outliers, 0, analysis["algorithm"])
+
+        # The gaps of at least RESET_GAP_MINUTES reset the windows, the others do not
+        self.assertEqual(len(aux_func.series_segments(series["depth"][HISTORY_POINTS:], dates[HISTORY_POINTS:], series["depth"][:HISTORY_POINTS])), 5)
+
+if __name__ == "__main__":
+    unittest.main()
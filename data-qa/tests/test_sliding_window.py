@@ -0,0 +1,173 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import sliding_window as sw
+
+# Dates every 15 minutes (epoch ms)
+START = 1672531200000
+STEP = 15 * 60 * 1000
+
+def fill(buffer, values, first = 0):
+    '''
+    Append values with consecutive dates (the first one `first` steps after START)
+    '''
+    for i, value in enumerate(values):
+        buffer.append(float(value), START + (first + i) * STEP)
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_wraparound_keeps_the_last_samples_in_order(self):
+        buffer = sw.RingBuffer(5)
+        fill(buffer, range(13))
+
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(buffer.total, 13)
+        np.testing.assert_array_equal(buffer.last(), [8, 9, 10, 11, 12])
+        np.testing.assert_array_equal(buffer.last(2), [11, 12])
+        np.testing.assert_array_equal(buffer.last_dates(), START + np.arange(8, 13) * STEP)
+        self.assertEqual(buffer.newest_date(), START + 12 * STEP)
+
+    def test_last_is_a_read_only_view(self):
+        buffer = sw.RingBuffer(4)
+        fill(buffer, range(6))
+
+        view = buffer.last()
+        self.assertFalse(view.flags.writeable)
+        self.assertIsNotNone(view.base)
+        with self.assertRaises(ValueError):
+            view[0] = 0
+
+    def test_evicted_samples_readable_in_the_spare_slots(self):
+        buffer = sw.RingBuffer(4, spare = 2)
+        fill(buffer, range(10))
+
+        self.assertEqual(buffer.oldest_index(), 4)
+        self.assertEqual(buffer.value_at(4), 4)
+        self.assertEqual(buffer.value_at(9), 9)
+
+    def test_duplicated_and_late_samples(self):
+        buffer = sw.RingBuffer(10)
+        fill(buffer, [1, 2, 4])
+
+        # Same date: the first sample received is kept
+        self.assertFalse(buffer.append(9.0, START + 2 * STEP))
+        np.testing.assert_array_equal(buffer.last(), [1, 2, 4])
+
+        # Late sample, inserted in order
+        generation = buffer.generation
+        self.assertTrue(buffer.append(3.0, START + 2 * STEP - STEP // 2))
+        np.testing.assert_array_equal(buffer.last(), [1, 2, 3, 4])
+        self.assertGreater(buffer.generation, generation)
+
+    def test_reset(self):
+        buffer = sw.RingBuffer(5)
+        fill(buffer, range(7))
+        generation = buffer.generation
+
+        buffer.reset()
+        self.assertEqual(len(buffer), 0)
+        self.assertIsNone(buffer.newest_date())
+        self.assertEqual(len(buffer.last()), 0)
+        self.assertGreater(buffer.generation, generation)
+
+        fill(buffer, [20, 21], first = 30)
+        np.testing.assert_array_equal(buffer.last(), [20, 21])
+
+    def test_discard_before(self):
+        buffer = sw.RingBuffer(5)
+        fill(buffer, range(8))
+
+        buffer.discard_before(START + 6 * STEP)
+        np.testing.assert_array_equal(buffer.last(), [6, 7])
+
+        buffer.discard_before(START + 100 * STEP)
+        self.assertEqual(len(buffer), 0)
+
+    def test_load_sorts_deduplicates_and_keeps_the_capacity(self):
+        buffer = sw.RingBuffer(4)
+        dates = START + np.array([5, 1, 3, 3, 2, 4, 0]) * STEP
+        buffer.load([5, 1, 3, 30, 2, 4, 0], dates)
+
+        np.testing.assert_array_equal(buffer.last(), [2, 3, 4, 5])
+        np.testing.assert_array_equal(buffer.last_dates(), START + np.arange(2, 6) * STEP)
+
+        # Appending after a load wraps around as usual
+        fill(buffer, [6, 7, 8], first = 6)
+        np.testing.assert_array_equal(buffer.last(), [5, 6, 7, 8])
+
+class TestSeriesView(unittest.TestCase):
+
+    def setUp(self):
+        # Two analyses of the same (station, property)
+        self.store = {}
+        self.first, created_first = sw.shared_series(self.store, "station", "depth", 5)
+        self.second, created_second = sw.shared_series(self.store, "station", "depth", 5)
+
+        self.assertTrue(created_first)
+        self.assertFalse(created_second)
+        self.assertIs(self.first.buffer, self.second.buffer)
+
+    def test_lagging_view_reads_up_to_its_newest_sample(self):
+        fill(self.first, range(4))
+        fill(self.second, range(2))
+
+        # The first analysis is ahead, the second one sees the samples it appended (the buffer holds them once)
+        self.assertEqual(len(self.first.buffer), 4)
+        np.testing.assert_array_equal(self.first.last(), [0, 1, 2, 3])
+        np.testing.assert_array_equal(self.second.last(), [0, 1])
+        np.testing.assert_array_equal(self.second.last_dates(1), [START + STEP])
+
+        # Catching up on a sample already appended by the other analysis
+        self.assertFalse(self.second.append(2.0, START + 2 * STEP))
+        np.testing.assert_array_equal(self.second.last(), [0, 1, 2])
+
+    def test_lagging_view_across_the_wraparound(self):
+        # The second analysis follows 2 samples behind
+        for i in range(9):
+            fill(self.first, [i], first = i)
+            if i >= 2:
+                fill(self.second, [i - 2], first = i - 2)
+
+        self.assertEqual(self.first.buffer.total, 9)
+
+        # Evicted from the capacity of the first analysis, still readable by the lagging one (spare slots)
+        np.testing.assert_array_equal(self.first.last(), [4, 5, 6, 7, 8])
+        np.testing.assert_array_equal(self.second.last(), [2, 3, 4, 5, 6])
+        self.assertEqual(len(self.second), 5)
+
+    def test_reset_is_shared(self):
+        fill(self.first, range(6))
+        fill(self.second, range(6))
+        generation = self.second.generation
+
+        # Gap: the first analysis restarts its windows with the sample after it
+        self.first.reset(START + 10 * STEP)
+        self.first.append(10.0, START + 10 * STEP)
+
+        self.assertEqual(len(self.first), 1)
+        self.assertEqual(len(self.second), 0)
+        self.assertNotEqual(self.second.generation, generation)
+
+        # The second analysis receives the same sample
+        self.second.reset(START + 10 * STEP)
+        self.assertFalse(self.second.append(10.0, START + 10 * STEP))
+        np.testing.assert_array_equal(self.second.last(), [10])
+
+    def test_load_and_views_created_later(self):
+        self.first.load(np.arange(3.0), START + np.arange(3) * STEP)
+        np.testing.assert_array_equal(self.first.last(), [0, 1, 2])
+
+        # A view created afterwards starts at the end of the history, even if other analyses appended since
+        fill(self.first, [3, 4], first = 3)
+        view, created = sw.shared_series(self.store, "station", "depth", 5)
+
+        self.assertFalse(created)
+        np.testing.assert_array_equal(view.last(), [0, 1, 2])
+        np.testing.assert_array_equal(view.export()[0], [0, 1, 2])
+
+if __name__ == "__main__":
+    unittest.main()
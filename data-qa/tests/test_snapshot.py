@@ -0,0 +1,236 @@
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import auxiliar_functions as aux_func
+import context_broker_client_utils as aquaspice_utils
+import snapshot as snap
+import streaming_analysis
+
+# Only the errors of the analysis are logged
+aux_func.setup_logging({}, level = "ERROR")
+
+STATION_IDS = ["urn:ngsi-ld:MeasurementStation:AquaSpice:T1", "urn:ngsi-ld:MeasurementStation:AquaSpice:T2"]
+PROPERTIES = ["temperature", "depth", "conductivity"]
+START = datetime.datetime(2023, 1, 1, tzinfo = datetime.timezone.utc)
+
+def make_config(snapshot_dir):
+    return {
+        "query_points": 400,
+        "property_sliding_window": {property_name: 200 for property_name in PROPERTIES},
+        "z_score_threshold": 4,
+        "hampel_filter_threshold": 3,
+        "iqr_threshold": {"default": 2, "failsafe": 1.8},
+        "watercps_error_flagging": {"harbour_docks": {"temperature": {"min_value": 2, "max_value": 35, "delta_value": 5},
+                                                      "depth": {"min_value": 100, "max_value": 3000, "delta_value": 500},
+                                                      "conductivity": {"min_value": 300, "max_value": 30000, "delta_value": 5000}}},
+        "snapshot_dir": snapshot_dir,
+        "snapshot_max_age": 3600,
+        "analysis": [{"algorithm": algorithm,
+                      "subscription_id": f"urn:ngsi-ld:Subscription:{algorithm}_test",
+                      "entityType": "MeasurementStation",
+                      "analyzedProperties": PROPERTIES + ["location"],
+                      "anomalyTypeId": f"_anomaly_{algorithm}",
+                      "notCorrectedProperties": ["location"]} for algorithm in ["z_score", "hampel_filter", "watercps_threshold"]]
+    }
+
+def make_readings(num_samples, seed = 0):
+    '''
+    Readings of every station every 15 minutes, seeded series with spikes (outliers)
+    '''
+    rng = np.random.default_rng(seed)
+    base = {"temperature": (15, 2, 0.2), "depth": (1000, 80, 10), "conductivity": (5000, 300, 40)}
+    series = {}
+
+    for station_id in STATION_IDS:
+        for property_name, (level, amplitude, noise) in base.items():
+            values = level + amplitude * np.sin(np.arange(num_samples) / 96 * 2 * np.pi) + rng.normal(0, noise, num_samples)
+            spikes = rng.choice(num_samples, num_samples // 30, replace = False)
+            values[spikes] += rng.choice([-1, 1], len(spikes)) * amplitude * rng.uniform(3, 12, len(spikes))
+            series[station_id, property_name] = np.round(values, 3)
+
+    readings = []
+    for i in range(num_samples):
+        date = (START + datetime.timedelta(minutes = 15 * i)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        readings.append([dict({"id": station_id, "type": "MeasurementStation"},
+                              **{property_name: {"type": "Property", "value": float(series[station_id, property_name][i]), "observedAt": date}
+                                 for property_name in PROPERTIES}) for station_id in STATION_IDS])
+
+    return readings
+
+def clear_state():
+    '''
+    Empty the in-memory state of the analysis (as after a restart)
+    '''
+    for state in [streaming_analysis.entities_data, streaming_analysis.hampel_filter_measurements, streaming_analysis.watercps_measurements,
+                  streaming_analysis.station_series, streaming_analysis.anomaly_status, streaming_analysis.last_date_received,
+                  streaming_analysis.last_observedAt_received]:
+        state.clear()
+
+def stream(readings):
+    '''
+    Analyse the readings (one notification per time step and analysis), returns the corrected readings and anomalies produced
+    '''
+    events = []
+
+    def anomaly(*args):
+        events.append(("anomaly",) + args[:3])
+
+    def corrected(id, entityType, reading, corrected_variables, analysis, is_outlier, reason_watercps):
+        events.append(("corrected", id, analysis["algorithm"], reading[PROPERTIES[0]]["observedAt"],
+                       json.dumps({k: [str(is_outlier[k]), corrected_variables[k].get("value"), reason_watercps[k]] for k in is_outlier})))
+
+    for notification in readings:
+        for analysis in aquaspice_utils.config["analysis"]:
+            # Windows created empty (no history query)
+            for station_id in STATION_IDS:
+                streaming_analysis.create_history(station_id, analysis, start_from_0 = True)
+
+            streaming_analysis.process_batch([dict(reading) for reading in notification], analysis["subscription_id"], anomaly, corrected)
+
+    return events
+
+def detector_state():
+    '''
+    In-memory state of every (algorithm, station, property): samples seen by the analysis and derived statistics
+    '''
+    state = {}
+
+    for algorithm, measurements in streaming_analysis.algorithm_state.items():
+        for station, properties in measurements.items():
+            for property_name, property_measurements in properties.items():
+                values, dates = property_measurements["data"].export()
+                state[algorithm, station, property_name] = {
+                    "values": values.tolist(),
+                    "dates": dates.tolist(),
+                    "end_date": property_measurements["data"].end_date,
+                    "num_data": property_measurements.get("num_data"),
+                    "last": property_measurements.get("last"),
+                    # Running statistics (rebuilt on restore, equal up to rounding)
+                    "stats": (property_measurements["stats"].count, property_measurements["stats"].mean) if "stats" in property_measurements else None
+                }
+
+    return state
+
+class TestSnapshotFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = {"query_points": 400, "property_sliding_window": {"depth": 200}}
+        self.series = [(np.arange(5.0), np.arange(5) * 900000), (np.arange(3.0) + 10, np.arange(3) * 900000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self):
+        return snap.write_snapshot(self.directory, self.series, {"settings": self.settings, "entries": []})
+
+    def rewrite_index(self, **fields):
+        path = os.path.join(self.directory, snap.INDEX_FILE)
+        with open(path, "r") as f:
+            index = json.load(f)
+        with open(path, "w") as f:
+            json.dump(dict(index, **fields), f)
+
+    def test_round_trip(self):
+        self.write()
+        index, values, dates = snap.read_snapshot(self.directory, 3600, self.settings)
+
+        self.assertEqual(index["version"], snap.SNAPSHOT_VERSION)
+        np.testing.assert_array_equal(values, [0, 1, 2, 3, 4, 10, 11, 12])
+        np.testing.assert_array_equal(dates, [0, 900000, 1800000, 2700000, 3600000, 0, 900000, 1800000])
+
+    def test_previous_arrays_are_removed(self):
+        self.write()
+        index = self.write()
+
+        self.assertEqual(sorted(x for x in os.listdir(self.directory) if x.endswith(".npy")), sorted([index["values"], index["dates"]]))
+
+    def test_version_mismatch(self):
+        self.write()
+        self.rewrite_index(version = snap.SNAPSHOT_VERSION - 1)
+
+        self.assertIsNone(snap.read_snapshot(self.directory, 3600, self.settings))
+
+    def test_settings_mismatch(self):
+        self.write()
+
+        self.assertIsNone(snap.read_snapshot(self.directory, 3600, dict(self.settings, query_points = 500)))
+        self.assertIsNone(snap.read_snapshot(self.directory, 3600, dict(self.settings, property_sliding_window = {"depth": 180})))
+
+    def test_too_old(self):
+        self.write()
+        self.rewrite_index(created = 0)
+
+        self.assertIsNone(snap.read_snapshot(self.directory, 3600, self.settings))
+
+    def test_missing_or_unreadable(self):
+        self.assertIsNone(snap.read_snapshot(self.directory, 3600, self.settings))
+
+        with open(os.path.join(self.directory, snap.INDEX_FILE), "w") as f:
+            f.write("{")
+        self.assertIsNone(snap.read_snapshot(self.directory, 3600, self.settings))
+
+class TestSnapshotRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.previous_config = aquaspice_utils.config
+        aquaspice_utils.config = make_config(self.directory)
+        clear_state()
+
+    def tearDown(self):
+        aquaspice_utils.config = self.previous_config
+        clear_state()
+        shutil.rmtree(self.directory)
+
+    def test_restored_state_gives_the_same_decisions(self):
+        readings = make_readings(700)
+
+        # Without restart
+        expected = stream(readings)
+
+        # Restart after 450 time steps (windows wrapped around), state restored from the snapshot
+        clear_state()
+        events = stream(readings[:450])
+        streaming_analysis.save_snapshot()
+        state = detector_state()
+        anomaly_status = json.loads(json.dumps(streaming_analysis.anomaly_status))
+        clear_state()
+
+        self.assertEqual(streaming_analysis.restore_snapshot(), set(STATION_IDS))
+        restored = detector_state()
+        self.assertEqual(sorted(restored), sorted(state))
+
+        for key in state:
+            if state[key]["stats"] is not None:
+                self.assertEqual(restored[key]["stats"][0], state[key]["stats"][0])
+                self.assertAlmostEqual(restored[key]["stats"][1], state[key]["stats"][1], delta = 1e-9 * abs(state[key]["stats"][1]))
+            self.assertEqual(dict(restored[key], stats = None), dict(state[key], stats = None), key)
+        self.assertEqual(streaming_analysis.anomaly_status, anomaly_status)
+        # One series per (station, property), shared by the analyses
+        self.assertEqual(len(streaming_analysis.station_series[STATION_IDS[0]]), len(PROPERTIES))
+
+        events += stream(readings[450:])
+
+        self.assertGreater(sum(event[0] == "anomaly" for event in expected), 0)
+        self.assertEqual(events, expected)
+
+    def test_snapshot_with_other_settings_is_ignored(self):
+        stream(make_readings(50))
+        streaming_analysis.save_snapshot()
+        clear_state()
+
+        aquaspice_utils.config["property_sliding_window"] = {property_name: 180 for property_name in PROPERTIES}
+        self.assertEqual(streaming_analysis.restore_snapshot(), set())
+        self.assertEqual(streaming_analysis.station_series, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import auxiliar_functions as aux_func
+import detectors
+import z_score_functions as zscore_func
+
+# Only the errors of the analysis are logged
+aux_func.setup_logging({}, level = "ERROR")
+
+STATION_ID = "urn:ngsi-ld:MeasurementStation:AquaSpice:T1"
+
+ANALYSIS = {
+    "algorithm": "z_score",
+    "subscription_id": "urn:ngsi-ld:Subscription:z_score_detection_1",
+    "entityType": "MeasurementStation",
+    "analyzedProperties": ["conductivity"],
+    "anomalyTypeId": "_anomaly_z_score",
+    "notCorrectedProperties": ["location"]
+}
+
+def make_config(sliding_window, query_points):
+    return {
+        "query_points": query_points,
+        "property_sliding_window": {"conductivity": sliding_window},
+        "z_score_threshold": 4,
+        "iqr_threshold": {"default": 2, "failsafe": 1.8}
+    }
+
+def make_series(num_samples, gap_at, seed = 0):
+    '''
+    Seeded series with spikes (outliers) and a data gap (reset of the windows), dates every 15 minutes (epoch ms)
+    '''
+    rng = np.random.default_rng(seed)
+    values = np.round(5000 + 300 * np.sin(np.arange(num_samples) / 96 * 2 * np.pi) + rng.normal(0, 40, num_samples), 3)
+    spikes = rng.choice(np.arange(50, num_samples), num_samples // 40, replace = False)
+    values[spikes] += rng.choice([-1, 1], len(spikes)) * rng.uniform(900, 3600, len(spikes))
+
+    minutes = 15 * np.arange(num_samples) + np.where(np.arange(num_samples) >= gap_at, 5 * 60, 0)
+    return values, 1672531200000 + minutes.astype(np.int64) * 60 * 1000
+
+def stream(config, values, dates):
+    '''
+    Score the samples one by one through the streaming detector (same steps as streaming_analysis.process_batch:
+    the first sample and the sample after a gap restart the windows, the others are scored, then appended)
+    '''
+    measurements = {}
+    zscore_func.z_score_module(config, STATION_ID, ANALYSIS, measurements, {}, {}, start_from_0 = True)
+    detector = detectors.DETECTORS["z_score"](config, ANALYSIS, measurements)
+    property_measurements = detector.station(STATION_ID)["conductivity"]
+
+    outliers = np.zeros(len(values), dtype = bool)
+    corrected = values.copy()
+
+    for i, (value, date) in enumerate(zip(values, dates)):
+        reset = (i > 0) and ((date // 1000 - dates[i - 1] // 1000) // 60 >= aux_func.RESET_GAP_MINUTES)
+
+        if detector.first_execution(property_measurements) or reset:
+            property_measurements["data"].reset(date)
+        else:
+            outliers[i] = detector.score([STATION_ID], "conductivity", [value])[0][0]
+            if outliers[i]:
+                corrected[i] = detector.correction(property_measurements, "conductivity")
+
+        property_measurements["data"].append(float(value), int(date))
+        detector.update(property_measurements)
+        property_measurements["iqr_index"].sync(property_measurements["data"])
+
+    return outliers, corrected
+
+class TestZScoreWindows(unittest.TestCase):
+
+    def check_same_decisions(self, sliding_window, query_points):
+        config = make_config(sliding_window, query_points)
+        values, dates = make_series(1500, gap_at = 800)
+
+        streamed = stream(config, values, dates)
+        series = zscore_func.outlier_function_z_score_series(config, "conductivity", config["z_score_threshold"], values, dates)
+
+        self.assertGreater(streamed[0].sum(), 0)
+        np.testing.assert_array_equal(streamed[0], series[0])
+        np.testing.assert_array_equal(streamed[1], series[1])
+
+    def test_stats_window_larger_than_query_points(self):
+        # 2 * sliding_window + 2 > query_points: the running statistics only cover the samples in memory
+        self.check_same_decisions(201, 300)
+        self.check_same_decisions(250, 400)
+
+    def test_stats_window_smaller_than_query_points(self):
+        self.check_same_decisions(180, 4000)
+
+if __name__ == "__main__":
+    unittest.main()